@@ -0,0 +1,34 @@
+"""
+Django settings for benchmarking PhotoApp with ``manage.py bench``.
+
+Uses SQLite and local-memory caching so that benchmarks run without
+Postgres or memcached, and turns off debugging so that timings resemble
+production.
+"""
+
+from PhotoApp.settings import *
+
+DEBUG = False
+
+TEMPLATE_DEBUG = False
+
+THUMBNAIL_DEBUG = False
+
+TEMPLATE_LOADERS = get_template_loaders(DEBUG)
+
+ALLOWED_HOSTS = ['testserver']
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'bench.sqlite3'),
+    }
+}
+
+SOUTH_TESTS_MIGRATE = False
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
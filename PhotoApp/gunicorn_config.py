@@ -0,0 +1,15 @@
+"""
+gunicorn settings for PhotoApp.
+
+Each worker warms up after loading the application and before it accepts
+requests, so the first request after a deploy or a worker restart is as
+fast as any other. Album downloads can outlast the worker timeout, so
+they tell the arbiter that their worker is alive as they stream.
+"""
+
+
+def post_worker_init(worker):
+    from PhotoManager.warmup import warm_up
+    from PhotoManager.zipstream import set_heartbeat
+    warm_up(worker.wsgi)
+    set_heartbeat(worker.notify)
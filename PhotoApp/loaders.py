@@ -0,0 +1,21 @@
+"""
+Template loader settings for PhotoApp.
+
+Settings modules build ``TEMPLATE_LOADERS`` with ``get_template_loaders``
+once they've decided on ``DEBUG``, so that a module which turns debugging
+off after importing ``PhotoApp.settings`` gets the cached loader too.
+"""
+
+TEMPLATE_LOADERS = (
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+)
+
+
+def get_template_loaders(debug):
+    """The template loaders for a process. Outside of debugging, each
+    process compiles each template once and keeps it.
+    """
+    if debug:
+        return TEMPLATE_LOADERS
+    return (('django.template.loaders.cached.Loader', TEMPLATE_LOADERS),)
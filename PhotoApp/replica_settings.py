@@ -0,0 +1,29 @@
+"""
+Django settings for testing PhotoApp's read replica routing with
+``manage.py test``.
+
+Adds a second SQLite database, standing in for a replica that the routing
+tests read from, and uses local-memory caching, so that the tests run
+without Postgres or memcached. Only the routing tests use the replica.
+"""
+
+from PhotoApp.settings import *
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'primary.sqlite3'),
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'replica.sqlite3'),
+    },
+}
+
+SOUTH_TESTS_MIGRATE = False
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
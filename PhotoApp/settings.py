@@ -49,6 +49,8 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'PhotoManager.middleware.MetricsMiddleware',
+    'PhotoManager.middleware.ReplicaMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -57,6 +59,14 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
 
+#template loader settings; outside of debugging, each process compiles
+#each template once and keeps it. Settings modules that change DEBUG call
+#get_template_loaders again.
+
+from PhotoApp.loaders import get_template_loaders
+
+TEMPLATE_LOADERS = get_template_loaders(DEBUG)
+
 ROOT_URLCONF = 'PhotoApp.urls'
 
 WSGI_APPLICATION = 'PhotoApp.wsgi.application'
@@ -73,9 +83,23 @@ DATABASES = {
         'PASSWORD': 'djangopass',
         'HOST': 'localhost',
         'PORT': '',
+        'CONN_MAX_AGE': 300,
     }
 }
 
+DATABASE_ROUTERS = ['PhotoManager.routers.ReplicaRouter']
+
+#read replica settings; list the aliases of any replicas in DATABASES
+
+PHOTOMANAGER_REPLICA_DATABASES = ()
+
+PHOTOMANAGER_REPLICA_STICKINESS = 5
+
+#persistent connection settings; connections idle for longer than this
+#are checked before they're reused
+
+PHOTOMANAGER_DB_HEALTH_CHECK_IDLE = 10
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
@@ -96,6 +120,12 @@ USE_TZ = True
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 STATIC_URL = '/static/'
 
+STATICFILES_STORAGE = 'PhotoManager.assets.ManifestStaticFilesStorage'
+
+PHOTOMANAGER_STATIC_BUILD_ROOT = os.path.join(BASE_DIR, 'static_build')
+
+PHOTOMANAGER_STATIC_MANIFEST = True
+
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 
@@ -112,6 +142,87 @@ CACHES = {
     }
 }
 
+#sorl-thumbnail settings
+
+THUMBNAIL_ENGINE = 'PhotoManager.engines.Engine'
+
+THUMBNAIL_BACKEND = 'PhotoManager.backends.ThumbnailBackend'
+
+THUMBNAIL_KVSTORE = 'PhotoManager.kvstores.KVStore'
+
+#image decoding settings
+
+PHOTOMANAGER_DECODE_MAX_PIXELS = 120 * 1000 * 1000
+
+PHOTOMANAGER_DECODE_MEMORY = None
+
+PHOTOMANAGER_DECODE_TIMEOUT = 5
+
+#contact sheet settings
+
+PHOTOMANAGER_CONTACT_SHEETS = False
+
+#request profiling settings, used when
+#PhotoManager.middleware.ProfilingMiddleware is installed
+
+PHOTOMANAGER_PROFILE_SAMPLE_RATE = 1.0
+
+PHOTOMANAGER_PROFILE_CPROFILE_RATE = 0.0
+
+PHOTOMANAGER_PROFILE_SLOW_MS = 1000
+
+PHOTOMANAGER_PROFILE_DIR = None
+
+#metrics settings
+
+PHOTOMANAGER_METRICS_DIR = None
+
+PHOTOMANAGER_METRICS_ALLOWED_IPS = ('127.0.0.1',)
+
+#authentication settings
+
+AUTHENTICATION_BACKENDS = ('PhotoManager.auth.CachedModelBackend',)
+
+PHOTOMANAGER_PERMISSION_CACHE_TIMEOUT = 60 * 60
+
+#upload layout settings; 'author', 'hash' or 'date'. Move existing
+#photos with manage.py relocate_uploads after changing the layout
+
+PHOTOMANAGER_UPLOAD_LAYOUT = 'author'
+
+PHOTOMANAGER_RELOCATE_WORKERS = 8
+
+#quota settings; how many bytes and photos each user may store, or None
+#for no limit. Limits can be raised or lowered per user in the admin
+
+PHOTOMANAGER_QUOTA_BYTES = None
+
+PHOTOMANAGER_QUOTA_PHOTOS = None
+
+PHOTOMANAGER_UPLOAD_OVERHEAD = 16 * 1024
+
+#batch photo edit settings; the most photos one request may change
+
+PHOTOMANAGER_BATCH_MAX_PHOTOS = 5000
+
+#backup settings
+
+PHOTOMANAGER_BACKUP_WORKERS = 8
+
+#static gallery export settings
+
+PHOTOMANAGER_GALLERY_THUMBNAIL = '100x100'
+
+PHOTOMANAGER_GALLERY_DISPLAY_SIZE = '1024x1024'
+
+#shared album settings
+
+PHOTOMANAGER_SHARE_MAX_AGE = 60
+
+PHOTOMANAGER_SHARE_CACHE_MAX_AGE = 24 * 60 * 60
+
+PHOTOMANAGER_SHARE_PURGE_URLS = ('http://127.0.0.1/purge',)
+
 #login decorator required setting
 LOGIN_URL = '/account/login/'
 
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from PhotoManager.models import Tag, Photo, Album
+from PhotoManager.models import Tag, Photo, Album, Usage
 
 
 class TagAdmin(admin.ModelAdmin):
@@ -29,6 +29,18 @@ class AlbumAdmin(admin.ModelAdmin):
     )
 
 
+class UsageAdmin(admin.ModelAdmin):
+    list_display = (
+        '__unicode__',
+        'bytes',
+        'photos',
+        'max_bytes',
+        'max_photos',
+    )
+    readonly_fields = ('bytes', 'photos')
+
+
 admin.site.register(Tag, TagAdmin)
 admin.site.register(Photo, PhotoAdmin)
 admin.site.register(Album, AlbumAdmin)
+admin.site.register(Usage, UsageAdmin)
@@ -0,0 +1,177 @@
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+from cStringIO import StringIO
+from django.conf import settings
+from django.contrib.staticfiles.storage import StaticFilesStorage
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Where build_static writes the fingerprinted and compressed assets, for
+# nginx to serve at STATIC_URL.
+STATIC_BUILD_ROOT = getattr(
+    settings, 'PHOTOMANAGER_STATIC_BUILD_ROOT',
+    os.path.join(settings.BASE_DIR, 'static_build'))
+
+MANIFEST_NAME = 'manifest.json'
+
+# Whether asset URLs use the fingerprinted names that build_static
+# recorded. Turn it off to serve assets under their own names, e.g. while
+# developing in a checkout where build_static has been run.
+STATIC_MANIFEST = getattr(settings, 'PHOTOMANAGER_STATIC_MANIFEST', True)
+
+# Assets worth compressing; the rest are already compressed.
+COMPRESSIBLE_EXTENSIONS = (
+    '.css', '.js', '.map', '.svg', '.eot', '.ttf', '.html', '.txt', '.json')
+
+# The number of hex digits of each asset's MD5 put into its name.
+HASH_LENGTH = 12
+
+CSS_URL_PATTERN = re.compile(
+    r'''(url\(\s*['"]?)([^'")?#]+)([^'")]*['"]?\s*\))''')
+SOURCE_MAP_PATTERN = re.compile(r'(sourceMappingURL=)([^\s*]+)')
+
+
+def get_hashed_name(name, content):
+    root, extension = posixpath.splitext(name)
+    return '%s.%s%s' % (
+        root, hashlib.md5(content).hexdigest()[:HASH_LENGTH], extension)
+
+
+def rewrite_css(name, content, manifest):
+    """Point the relative URLs in a stylesheet at the fingerprinted names
+    of the assets that they refer to.
+    """
+    directory = posixpath.dirname(name)
+
+    def replace(match):
+        url = match.group(2)
+        if re.match(r'^([a-z]+:|/)', url):
+            return match.group(0)
+        target = posixpath.normpath(posixpath.join(directory, url))
+        if target not in manifest:
+            return match.group(0)
+        return match.group(1) + posixpath.relpath(
+            manifest[target], directory or '.') + ''.join(match.groups()[2:])
+    content = CSS_URL_PATTERN.sub(replace, content)
+    return SOURCE_MAP_PATTERN.sub(replace, content)
+
+
+def compress(content):
+    """The gzip and brotli encodings of an asset that are smaller than
+    it, keyed by their file extensions.
+    """
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(content)
+    variants = {'.gz': buf.getvalue()}
+    if brotli is not None:
+        variants['.br'] = brotli.compress(content)
+    return dict((extension, data) for extension, data in variants.items()
+                if len(data) < len(content))
+
+
+def write(path, content):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def build(source=settings.STATIC_ROOT, destination=STATIC_BUILD_ROOT):
+    """Copy every asset under source to destination twice: once under its
+    own name, and once under a name including a hash of its contents.
+    Each copy is accompanied by gzip and brotli variants, and stylesheets
+    refer to the hashed names of the fonts and images they use. Returns
+    the manifest of hashed names, which is also written to destination.
+    """
+    names = []
+    for root, dirs, files in os.walk(source):
+        for filename in files:
+            names.append(os.path.relpath(
+                os.path.join(root, filename), source).replace(os.sep, '/'))
+    # Stylesheets go last, so that the assets they refer to are hashed
+    # before they're rewritten.
+    names.sort(key=lambda name: (name.endswith('.css'), name))
+
+    manifest = {}
+    for name in names:
+        with open(os.path.join(source, name), 'rb') as f:
+            content = f.read()
+        if name.endswith('.css'):
+            content = rewrite_css(name, content, manifest)
+        manifest[name] = get_hashed_name(name, content)
+        variants = {'': content}
+        if name.endswith(COMPRESSIBLE_EXTENSIONS):
+            variants.update(compress(content))
+        for output in (name, manifest[name]):
+            for extension, data in variants.items():
+                write(os.path.join(destination, output + extension), data)
+
+    write(os.path.join(destination, MANIFEST_NAME),
+          json.dumps(manifest, indent=1, sort_keys=True))
+    return manifest
+
+
+NGINX_TEMPLATE = '''\
+# Generated by manage.py build_static.
+location %(url)s {
+    alias %(root)s/;
+    gzip_static on;
+    gzip_vary on;%(brotli)s
+    expires 1h;
+
+    # Fingerprinted names change whenever their contents do.
+    location ~ "\\.[0-9a-f]{%(length)d}\\.[^/.]+$" {
+        expires off;
+        add_header Cache-Control "public, max-age=31536000, immutable";
+    }
+}
+'''
+
+
+def render_nginx_config(root=STATIC_BUILD_ROOT, url=settings.STATIC_URL,
+                        use_brotli=brotli is not None):
+    """An nginx location block serving the built assets, precompressed,
+    with far-future cache headers on their fingerprinted names.
+    """
+    return NGINX_TEMPLATE % {
+        'url': url,
+        'root': os.path.abspath(root),
+        'brotli': '\n    brotli_static on;' if use_brotli else '',
+        'length': HASH_LENGTH,
+    }
+
+
+class ManifestStaticFilesStorage(StaticFilesStorage):
+    """Serves assets under the fingerprinted names that build_static
+    recorded in its manifest. With PHOTOMANAGER_STATIC_MANIFEST off, and
+    for assets that haven't been built, assets are served under their own
+    names.
+    """
+    def __init__(self, *args, **kwargs):
+        super(ManifestStaticFilesStorage, self).__init__(*args, **kwargs)
+        self.manifest = None
+
+    def load_manifest(self):
+        if not STATIC_MANIFEST:
+            return {}
+        try:
+            with open(os.path.join(STATIC_BUILD_ROOT, MANIFEST_NAME)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def url(self, name):
+        if self.manifest is None:
+            self.manifest = self.load_manifest()
+        return super(ManifestStaticFilesStorage, self).url(
+            self.manifest.get(name, name))
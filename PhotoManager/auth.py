@@ -0,0 +1,60 @@
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import User, Group
+from django.core.cache import cache
+
+
+# How long, in seconds, a user's permissions are cached between requests.
+# Changes to a user's groups or permissions clear them straight away.
+PERMISSION_CACHE_TIMEOUT = getattr(
+    settings, 'PHOTOMANAGER_PERMISSION_CACHE_TIMEOUT', 60 * 60)
+
+
+def get_permissions_key(user_id):
+    return 'photomanager-permissions-%d' % user_id
+
+
+def clear_permissions(user_ids):
+    """Forget the cached permissions of the given users."""
+    cache.delete_many([get_permissions_key(pk) for pk in user_ids])
+
+
+def get_changed_user_ids(sender, instance, reverse, pk_set, **kwargs):
+    """The ids of the users whose permissions are affected by a change to
+    their groups, their own permissions, or their groups' permissions, as
+    sent with m2m_changed. For clears, this must be called before the
+    clear happens.
+    """
+    if sender is Group.permissions.through:
+        if not reverse:
+            group_ids = [instance.pk]
+        elif pk_set is not None:
+            group_ids = pk_set
+        else:
+            group_ids = instance.group_set.values_list('pk', flat=True)
+        return User.objects.filter(groups__in=list(group_ids)).\
+            values_list('pk', flat=True)
+    if not reverse:
+        return [instance.pk]
+    if pk_set is not None:
+        return pk_set
+    return instance.user_set.values_list('pk', flat=True)
+
+
+class CachedModelBackend(ModelBackend):
+    """The model authentication backend, keeping each user's permissions in
+    the cache between requests instead of querying their own and their
+    groups' permissions on every request that checks one.
+    """
+    def get_all_permissions(self, user_obj, obj=None):
+        if user_obj.is_anonymous() or obj is not None:
+            return set()
+        if not hasattr(user_obj, '_perm_cache'):
+            key = get_permissions_key(user_obj.pk)
+            permissions = cache.get(key)
+            if permissions is None:
+                permissions = super(CachedModelBackend, self).\
+                    get_all_permissions(user_obj)
+                cache.set(key, permissions, PERMISSION_CACHE_TIMEOUT)
+            user_obj._perm_cache = permissions
+        return user_obj._perm_cache
@@ -0,0 +1,76 @@
+import logging
+from functools import partial
+from django.core.files.images import get_image_dimensions
+from sorl.thumbnail import base
+from sorl.thumbnail.helpers import toint
+from sorl.thumbnail.images import BaseImageFile
+from sorl.thumbnail.parsers import parse_geometry
+from decoding import DecodeUnavailable, DecoderBusy, enqueue
+from models import Photo
+import metrics
+import profiling
+
+
+logger = logging.getLogger(__name__)
+
+# A transparent 1x1 GIF, for photos that don't have a placeholder yet.
+BLANK_IMAGE = (
+    'data:image/gif;base64,'
+    'R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7'
+)
+
+
+class PlaceholderImageFile(BaseImageFile):
+    """Stands in for a thumbnail that couldn't be generated, showing the
+    photo's placeholder at the size that the thumbnail would have had.
+    """
+    def __init__(self, url, size):
+        self._url = url
+        self.size = size
+
+    def exists(self):
+        return True
+
+    @property
+    def url(self):
+        return self._url
+
+
+class ThumbnailBackend(base.ThumbnailBackend):
+    """A sorl-thumbnail backend that degrades gracefully when there isn't
+    memory to decode the original. The photo's placeholder is served
+    instead, and the thumbnail is generated in the background once memory
+    frees up.
+    """
+    def get_thumbnail(self, file_, geometry_string, **options):
+        metrics.rendition_lookups.inc()
+        try:
+            with profiling.timed('thumbnail'):
+                return super(ThumbnailBackend, self).get_thumbnail(
+                    file_, geometry_string, **options)
+        except DecodeUnavailable, e:
+            logger.warning('Serving a placeholder for %s: %s', file_, e)
+            if isinstance(e, DecoderBusy):
+                enqueue(partial(
+                    self.get_thumbnail, file_, geometry_string, **options))
+            return self.get_placeholder(file_, geometry_string, **options)
+
+    def _create_thumbnail(self, source_image, geometry_string, options,
+                          thumbnail):
+        metrics.rendition_misses.inc()
+        return super(ThumbnailBackend, self)._create_thumbnail(
+            source_image, geometry_string, options, thumbnail)
+
+    def get_placeholder(self, file_, geometry_string, **options):
+        name = getattr(file_, 'name', file_)
+        url = Photo.objects.filter(image=name).exclude(placeholder='').\
+            values_list('placeholder', flat=True).first()
+        width, height = get_image_dimensions(file_)
+        geometry = parse_geometry(geometry_string, float(width) / height)
+        if options.get('crop'):
+            size = geometry
+        else:
+            factor = min(
+                float(geometry[0]) / width, float(geometry[1]) / height)
+            size = (toint(width * factor), toint(height * factor))
+        return PlaceholderImageFile(url or BLANK_IMAGE, size)
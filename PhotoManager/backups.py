@@ -0,0 +1,248 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+from itertools import chain
+from multiprocessing.pool import ThreadPool
+from datetime import datetime
+from django.conf import settings
+from django.contrib.auth.models import User, Group
+from django.core import serializers
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from models import Tag, Photo, Album, AlbumPhoto, Usage
+from quotas import reconcile
+
+
+# How many files are read from, or written to, storage at once.
+BACKUP_WORKERS = getattr(settings, 'PHOTOMANAGER_BACKUP_WORKERS', 8)
+
+# How much of a file is copied at a time.
+CHUNK_SIZE = 1024 * 1024
+
+# The models backed up, in an order that lets each be restored after the
+# ones it refers to.
+BACKUP_MODELS = (Group, User, Usage, Tag, Photo, Album, AlbumPhoto)
+
+
+class CorruptBackup(Exception):
+    """A blob of a backup doesn't match its checksum."""
+
+
+def get_blob_path(root, digest):
+    return os.path.join(root, 'blobs', digest[:2], digest)
+
+
+def write_blob(root, f):
+    """Copy a file into a backup under the SHA-256 of its contents,
+    returning that and its size. A blob the backup already has is left
+    as it is.
+    """
+    blobs = os.path.join(root, 'blobs')
+    if not os.path.isdir(blobs):
+        os.makedirs(blobs)
+    sha256 = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=blobs, delete=False) as temp:
+        try:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                sha256.update(chunk)
+                size += len(chunk)
+                temp.write(chunk)
+        except:
+            os.remove(temp.name)
+            raise
+    digest = sha256.hexdigest()
+    path = get_blob_path(root, digest)
+    if os.path.exists(path):
+        os.remove(temp.name)
+    else:
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # Another thread made it first.
+                pass
+        os.rename(temp.name, path)
+    return digest, size
+
+
+def read_blob(root, digest):
+    """The contents of a blob, verified against its checksum, a chunk at a
+    time.
+    """
+    sha256 = hashlib.sha256()
+    with open(get_blob_path(root, digest), 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+            sha256.update(chunk)
+            yield chunk
+    if sha256.hexdigest() != digest:
+        raise CorruptBackup('Blob %s does not match its checksum' % digest)
+
+
+def get_manifest_names(root):
+    """The names of a backup's manifests, oldest first."""
+    directory = os.path.join(root, 'manifests')
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name for name in os.listdir(directory)
+                  if name.endswith('.json'))
+
+
+def load_manifest(root, name=None):
+    """A backup's manifest of the given name, or its latest one. Returns
+    None if it has none.
+    """
+    if name is None:
+        names = get_manifest_names(root)
+        if not names:
+            return None
+        name = names[-1]
+    with open(os.path.join(root, 'manifests', name)) as f:
+        return json.load(f)
+
+
+def write_records(root):
+    """Serialize the library's rows into a blob, returning its checksum.
+    Users, groups and permissions are referred to by natural keys, so that
+    the rows can be restored into a database set up independently.
+    """
+    objects = chain(*[model._default_manager.order_by('pk').iterator()
+                      for model in BACKUP_MODELS])
+    with tempfile.TemporaryFile() as temp:
+        with gzip.GzipFile(fileobj=temp, mode='wb', mtime=0) as f:
+            serializers.serialize(
+                'json', objects, stream=f, use_natural_keys=True)
+        temp.seek(0)
+        return write_blob(root, temp)[0]
+
+
+def backup(root, storage=default_storage, workers=BACKUP_WORKERS):
+    """Write a new backup of the library's rows, and the originals of its
+    photos, to the directory root. Files are stored by checksum, and only
+    the photos that the previous manifest doesn't already account for are
+    read from storage. The names of uploaded files never change, so a file
+    of the same name, and size if it's been recorded, is taken to be the
+    same. Returns the new manifest's name and how many files were copied.
+    """
+    now = datetime.now()
+    previous = load_manifest(root) or {'files': {}}
+    files = {}
+    copy = []
+    for name, size in Photo.objects.values_list('image', 'image_size'):
+        known = previous['files'].get(name)
+        if known is not None and size in (known['size'], None) and \
+                os.path.exists(get_blob_path(root, known['sha256'])):
+            files[name] = known
+        else:
+            copy.append(name)
+
+    def store(name):
+        with storage.open(name, 'rb') as f:
+            digest, size = write_blob(root, f)
+        return name, {'sha256': digest, 'size': size}
+
+    pool = ThreadPool(workers)
+    try:
+        files.update(pool.imap_unordered(store, copy))
+    finally:
+        pool.close()
+        pool.join()
+
+    manifest = {
+        'created': now.isoformat(),
+        'records': write_records(root),
+        'files': files,
+    }
+    directory = os.path.join(root, 'manifests')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    name = now.strftime('%Y%m%dT%H%M%S.%f.json')
+    with open(os.path.join(directory, name + '.tmp'), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(os.path.join(directory, name + '.tmp'),
+              os.path.join(directory, name))
+    return name, len(copy)
+
+
+def verify(root, manifest, workers=BACKUP_WORKERS):
+    """The checksums of a manifest's blobs that are missing or corrupt."""
+    def check(digest):
+        try:
+            for chunk in read_blob(root, digest):
+                pass
+        except (IOError, CorruptBackup):
+            return digest
+        return None
+
+    digests = set(entry['sha256'] for entry in manifest['files'].values())
+    digests.add(manifest['records'])
+    pool = ThreadPool(workers)
+    try:
+        return sorted(filter(None, pool.imap_unordered(check, digests)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_checksum(storage, name):
+    sha256 = hashlib.sha256()
+    with storage.open(name, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def restore(root, manifest, storage=default_storage, workers=BACKUP_WORKERS):
+    """Restore the files and rows of a manifest. Each file is checked
+    against its checksum as it's read from the backup; files already in
+    storage with the right contents are left alone. Pyramids aren't backed
+    up, so photos whose pyramids aren't in storage are restored without
+    them, for generate_renditions to build again. Users' usage is
+    recounted from the restored photos, keeping their own limits. Returns
+    how many files were written.
+    """
+    def restore_file(item):
+        name, entry = item
+        if storage.exists(name):
+            if get_checksum(storage, name) == entry['sha256']:
+                return False
+            storage.delete(name)
+        with tempfile.TemporaryFile() as temp:
+            for chunk in read_blob(root, entry['sha256']):
+                temp.write(chunk)
+            temp.seek(0)
+            storage.save(name, File(temp))
+        return True
+
+    pool = ThreadPool(workers)
+    try:
+        written = sum(pool.imap_unordered(
+            restore_file, manifest['files'].items()))
+    finally:
+        pool.close()
+        pool.join()
+
+    with tempfile.TemporaryFile() as temp:
+        for chunk in read_blob(root, manifest['records']):
+            temp.write(chunk)
+        temp.seek(0)
+        with gzip.GzipFile(fileobj=temp, mode='rb') as f:
+            with transaction.atomic():
+                for obj in serializers.deserialize('json', f):
+                    photo = obj.object
+                    if isinstance(photo, Photo) and photo.deep_zoom and \
+                            not default_storage.exists(photo.deep_zoom):
+                        photo.deep_zoom = ''
+                    obj.save()
+                # Rows were saved with their primary keys, so the
+                # sequences that generate new ones need catching up.
+                cursor = connection.cursor()
+                for sql in connection.ops.sequence_reset_sql(
+                        no_style(), BACKUP_MODELS):
+                    cursor.execute(sql)
+    reconcile()
+    return written
@@ -0,0 +1,171 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+from models import Tag, Photo, Album, get_chunks, get_share_tokens, \
+    deleting_in_bulk
+from quotas import get_photo_size, update_usage
+import sharing
+import tagging
+
+
+# The most photos that one batch may change.
+BATCH_MAX_PHOTOS = getattr(settings, 'PHOTOMANAGER_BATCH_MAX_PHOTOS', 5000)
+
+# The changes a batch may ask for, and the type of each.
+BATCH_CHANGES = {
+    'add_tags': list,
+    'add_tag_names': list,
+    'remove_tags': list,
+    'description': basestring,
+    'add_to_albums': list,
+    'remove_from_albums': list,
+    'delete': bool,
+}
+
+
+class BatchError(Exception):
+    """A batch of changes can't be applied as asked."""
+
+
+def get_ids(values, name):
+    if not all(isinstance(value, (int, long)) and not isinstance(value, bool)
+               for value in values):
+        raise BatchError('%s must be a list of ids.' % name)
+    return values
+
+
+def get_names(values, name):
+    if not all(isinstance(value, basestring) for value in values):
+        raise BatchError('%s must be a list of strings.' % name)
+    try:
+        return tagging.clean_texts(values)
+    except ValueError, e:
+        raise BatchError(str(e))
+
+
+def parse_batch(batch):
+    """Check a batch of changes, as decoded from JSON, and return its photo
+    ids and its changes.
+    """
+    if not isinstance(batch, dict) or \
+            not isinstance(batch.get('photos'), list):
+        raise BatchError('A batch needs a list of photos.')
+    photo_ids = get_ids(batch['photos'], 'photos')
+    if len(photo_ids) > BATCH_MAX_PHOTOS:
+        raise BatchError(
+            'A batch may change at most %d photos.' % BATCH_MAX_PHOTOS)
+    changes = dict((key, value) for key, value in batch.items()
+                   if key != 'photos')
+    for key, value in changes.items():
+        if key not in BATCH_CHANGES:
+            raise BatchError('Unknown change %s.' % key)
+        if not isinstance(value, BATCH_CHANGES[key]):
+            raise BatchError('Invalid value for %s.' % key)
+        if key == 'add_tag_names':
+            changes[key] = get_names(value, key)
+        elif BATCH_CHANGES[key] is list:
+            get_ids(value, key)
+    return photo_ids, changes
+
+
+def get_albums(user, album_ids):
+    albums = list(Album.objects.filter(pk__in=album_ids, author=user))
+    if len(albums) != len(set(album_ids)):
+        raise BatchError('Albums may only be changed by their owners.')
+    return albums
+
+
+def apply_batch(user, photo_ids, changes):
+    """Apply a set of changes to a user's photos, all in one transaction,
+    with a handful of queries per few hundred photos rather than several
+    per photo. Photos that don't exist, or that belong to someone else,
+    are left alone. Returns a result for each photo id: 'updated',
+    'deleted', 'not found' or 'forbidden'.
+    """
+    tag_ids = set(changes.get('add_tags', []) + changes.get('remove_tags', []))
+    if Tag.objects.filter(pk__in=tag_ids).count() != len(tag_ids):
+        raise BatchError('Unknown tag.')
+
+    # Purges, the signal receivers' included, wait until the transaction
+    # commits, so that no request can cache a page from before the changes.
+    # Each album is purged once.
+    with sharing.deferring_purges(), transaction.atomic():
+        add_to = get_albums(user, changes.get('add_to_albums', []))
+        remove_from = get_albums(user, changes.get('remove_from_albums', []))
+        authors = {}
+        for chunk in get_chunks(set(photo_ids)):
+            authors.update(Photo.objects.filter(pk__in=chunk).
+                           values_list('pk', 'author_id'))
+        pks = [pk for pk in authors if authors[pk] == user.pk]
+
+        # Shared pages don't hear about bulk updates, so the albums the
+        # photos were in, or are added to, are purged once everything is
+        # committed.
+        share_tokens = set()
+        if sharing.SHARE_PURGE_URLS:
+            for chunk in get_chunks(pks):
+                share_tokens.update(get_share_tokens(
+                    Album.objects.filter(albumphoto__photo__in=chunk)))
+            share_tokens.update(get_share_tokens(
+                Album.objects.filter(pk__in=[album.pk for album in add_to])))
+
+        through = Photo.tags.through
+        for chunk in get_chunks(pks):
+            if changes.get('remove_tags'):
+                through.objects.filter(
+                    photo__in=chunk,
+                    tag__in=changes['remove_tags']).delete()
+            fields = {'date_modified': timezone.now()}
+            if 'description' in changes:
+                fields['description'] = changes['description']
+            Photo.objects.filter(pk__in=chunk).update(**fields)
+        add_tags = list(changes.get('add_tags', []))
+        if changes.get('add_tag_names'):
+            add_tags += tagging.get_or_create_tags(
+                changes['add_tag_names']).values()
+        tagging.add_tags(pks, add_tags)
+
+        for album in add_to:
+            album.add_photos(*pks)
+        for album in remove_from:
+            album.remove_photos(*pks)
+
+        if changes.get('delete'):
+            # Taking the photos out of their albums first redraws each
+            # album's contact sheets once, rather than once per photo.
+            albums = set()
+            for chunk in get_chunks(pks):
+                albums.update(
+                    Album.objects.filter(albumphoto__photo__in=chunk))
+            for album in albums:
+                album.remove_photos(*pks)
+            # The photos' share tokens were collected above, and they come
+            # off their author's usage in one UPDATE, rather than one of
+            # each per photo from the delete receivers.
+            size = count = 0
+            for chunk in get_chunks(pks):
+                photos = Photo.objects.filter(pk__in=chunk)
+                totals = photos.aggregate(
+                    size=Sum('image_size'), count=Count('pk'))
+                size += totals['size'] or 0
+                count += totals['count']
+                for photo in photos.filter(image_size=None).only(
+                        'image', 'image_size'):
+                    size += get_photo_size(photo)
+                with deleting_in_bulk(chunk):
+                    photos.delete()
+            update_usage(user.pk, -size, -count)
+        sharing.purge(share_tokens)
+
+    done = 'deleted' if changes.get('delete') else 'updated'
+    results = []
+    for pk in photo_ids:
+        if pk not in authors:
+            result = 'not found'
+        elif authors[pk] != user.pk:
+            result = 'forbidden'
+        else:
+            result = done
+        results.append({'photo': pk, 'result': result})
+    return results
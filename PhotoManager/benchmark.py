@@ -0,0 +1,129 @@
+import math
+import random
+import resource
+from cStringIO import StringIO
+from time import time
+from django.contrib.auth.models import User, Permission
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from models import Tag, Photo, Album
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    import Image
+    import ImageDraw
+
+
+BENCH_PASSWORD = 'benchpass'
+
+
+def make_image(rng, width=320, height=240):
+    """Generate a small JPEG of randomly coloured rectangles."""
+    image = Image.new('RGB', (width, height), (
+        rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)))
+    draw = ImageDraw.Draw(image)
+    for i in range(8):
+        x, y = rng.randint(0, width), rng.randint(0, height)
+        draw.rectangle(
+            (x, y, x + rng.randint(10, width), y + rng.randint(10, height)),
+            fill=(rng.randint(0, 255), rng.randint(0, 255),
+                  rng.randint(0, 255)))
+    buf = StringIO()
+    image.save(buf, format='JPEG', quality=85)
+    return buf.getvalue()
+
+
+def generate_library(users=1, albums=10, photos=50, tags=20,
+                     photos_per_album=10, tags_per_photo=3, seed=0,
+                     distinct_images=True):
+    """Fill the database and storage with a synthetic photo library:
+    the given number of users, each with their own albums and photos, all
+    drawing on a shared pool of tags. Every user may use every
+    PhotoManager view, and logs in with BENCH_PASSWORD. Without
+    distinct_images, each user's photos all share one image file, which
+    makes large libraries much quicker to generate. Returns the list of
+    users created.
+    """
+    rng = random.Random(seed)
+    permissions = list(
+        Permission.objects.filter(content_type__app_label='PhotoManager'))
+    tag_pool = [
+        Tag.objects.get_or_create(text='bench-tag-%d' % i)[0]
+        for i in range(tags)
+    ]
+
+    created = []
+    for i in range(users):
+        user = User.objects.create_user(
+            'bench-user-%d-%d' % (seed, i), password=BENCH_PASSWORD)
+        user.user_permissions.add(*permissions)
+        created.append(user)
+
+        user_photos = []
+        for j in range(photos):
+            photo = Photo(author=user, description='Photo %d' % j)
+            if distinct_images or not user_photos:
+                photo.image.save(
+                    'bench-%d.jpg' % j, ContentFile(make_image(rng)),
+                    save=False)
+            else:
+                photo.image = user_photos[0].image.name
+            photo.save()
+            if tag_pool:
+                photo.tags.add(*rng.sample(
+                    tag_pool, min(tags_per_photo, len(tag_pool))))
+            user_photos.append(photo)
+
+        for j in range(albums):
+            album = Album.objects.create(
+                title='Album %d' % j,
+                description='A generated album.',
+                author=user
+            )
+            album.add_photos(*rng.sample(
+                user_photos, min(photos_per_album, len(user_photos))))
+    return created
+
+
+def percentile(values, percent):
+    """The nearest-rank percentile of a list of values."""
+    values = sorted(values)
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+class Timer(object):
+    """Collects the latency and query count of repeated samples of one
+    operation.
+    """
+    def __init__(self):
+        self.latencies = []
+        self.queries = []
+
+    def measure(self, func, *args, **kwargs):
+        with CaptureQueriesContext(connection) as context:
+            start = time()
+            result = func(*args, **kwargs)
+            self.latencies.append(time() - start)
+        self.queries.append(len(context.captured_queries))
+        return result
+
+    def summary(self):
+        latencies = [latency * 1000 for latency in self.latencies]
+        return {
+            'samples': len(latencies),
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'mean_ms': round(sum(latencies) / len(latencies), 3),
+            'queries_p50': percentile(self.queries, 50),
+            'queries_max': max(self.queries),
+        }
+
+
+def peak_rss():
+    """The peak resident set size of this process, in kilobytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
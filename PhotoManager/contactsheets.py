@@ -0,0 +1,154 @@
+import hashlib
+import json
+import threading
+from contextlib import contextmanager
+from cStringIO import StringIO
+from django.conf import settings
+from django.core.files.base import ContentFile
+from sorl.thumbnail import default, get_thumbnail
+from backends import PlaceholderImageFile
+from decoding import DecoderBusy, ImageTooLarge, enqueue
+from models import Album, Photo, ContactSheet
+from renditions import generate_renditions
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+
+# Contact sheets are off unless enabled in the settings.
+CONTACT_SHEETS = getattr(settings, 'PHOTOMANAGER_CONTACT_SHEETS', False)
+
+# The thumbnail geometry that album grids are drawn with.
+CONTACT_SHEET_TILE = getattr(
+    settings, 'PHOTOMANAGER_CONTACT_SHEET_TILE', '100x100')
+
+# The number of thumbnails per row, and per sheet.
+CONTACT_SHEET_COLUMNS = getattr(
+    settings, 'PHOTOMANAGER_CONTACT_SHEET_COLUMNS', 10)
+CONTACT_SHEET_PAGE_SIZE = getattr(
+    settings, 'PHOTOMANAGER_CONTACT_SHEET_PAGE_SIZE', 100)
+
+# The number of hex digits of each sheet's MD5 put into its name.
+HASH_LENGTH = 12
+
+_deferred = threading.local()
+
+
+def get_pages(photo_ids):
+    """Split an album's photo ids into pages of one contact sheet each."""
+    return [
+        photo_ids[i:i + CONTACT_SHEET_PAGE_SIZE]
+        for i in range(0, len(photo_ids), CONTACT_SHEET_PAGE_SIZE)
+    ]
+
+
+def render_contact_sheet(photos):
+    """Pack the thumbnails of the given photos into a single JPEG. Returns
+    the JPEG data, and a layout listing the position and size of each
+    photo's thumbnail within it. Thumbnails are drawn from the photos'
+    stored renditions, which are generated first if need be; a photo too
+    large to ever decode is left blank. Raises DecoderBusy if there isn't
+    memory to generate a rendition right now.
+    """
+    tile_width, tile_height = map(int, CONTACT_SHEET_TILE.split('x'))
+    rows = (len(photos) + CONTACT_SHEET_COLUMNS - 1) // CONTACT_SHEET_COLUMNS
+    columns = min(len(photos), CONTACT_SHEET_COLUMNS)
+    sheet = Image.new(
+        'RGB', (columns * tile_width, rows * tile_height), 'white')
+
+    layout = []
+    for index, photo in enumerate(photos):
+        try:
+            generate_renditions(photo.image, sizes=(CONTACT_SHEET_TILE,))
+        except ImageTooLarge:
+            pass
+        thumbnail = get_thumbnail(photo.image, CONTACT_SHEET_TILE)
+        x = (index % CONTACT_SHEET_COLUMNS) * tile_width
+        y = (index // CONTACT_SHEET_COLUMNS) * tile_height
+        if not isinstance(thumbnail, PlaceholderImageFile):
+            sheet.paste(default.engine.get_image(thumbnail), (x, y))
+        layout.append({
+            'photo': photo.pk,
+            'x': x,
+            'y': y,
+            'width': thumbnail.width,
+            'height': thumbnail.height,
+        })
+
+    buf = StringIO()
+    sheet.save(buf, format='JPEG', quality=85, optimize=True)
+    return buf.getvalue(), layout
+
+
+def get_sheet_name(album, page, data):
+    """The name of a sheet, which changes with its contents, so that
+    browsers and proxies never show an old sheet against a new layout.
+    """
+    return '%d-%d-%s.jpg' % (
+        album.pk, page, hashlib.md5(data).hexdigest()[:HASH_LENGTH])
+
+
+@contextmanager
+def deferring_updates():
+    """Hold back the contact sheet updates asked for during the block,
+    and bring each album's sheets up to date once when it ends, so that an
+    album changed in several steps is redrawn only once.
+    """
+    if getattr(_deferred, 'albums', None) is not None:
+        yield
+        return
+    _deferred.albums = {}
+    try:
+        yield
+        albums = _deferred.albums
+    finally:
+        _deferred.albums = None
+    for album in albums.values():
+        update_contact_sheets(album)
+
+
+def update_contact_sheets(album):
+    """Bring an album's contact sheets up to date with its photos. Only
+    sheets whose page of photos has changed are redrawn. If there isn't
+    memory to draw them right now, they're redrawn by the background
+    decode queue instead.
+    """
+    deferred = getattr(_deferred, 'albums', None)
+    if deferred is not None:
+        deferred[album.pk] = album
+        return
+    photo_ids = list(album.get_photos().values_list('pk', flat=True))
+    pages = get_pages(photo_ids)
+    sheets = dict((sheet.page, sheet) for sheet in album.contact_sheets.all())
+
+    for page, page_ids in enumerate(pages):
+        sheet = sheets.pop(page, None)
+        if sheet is not None and sheet.photo_ids == page_ids:
+            continue
+
+        photos = Photo.objects.in_bulk(page_ids)
+        try:
+            data, layout = render_contact_sheet(
+                [photos[pk] for pk in page_ids])
+        except DecoderBusy:
+            enqueue(update_contact_sheets_by_pk, album.pk)
+            return
+        if sheet is None:
+            sheet = ContactSheet(album=album, page=page)
+        else:
+            sheet.image.delete(save=False)
+        sheet.layout = json.dumps(layout)
+        sheet.image.save(
+            get_sheet_name(album, page, data), ContentFile(data), save=False)
+        sheet.save()
+
+    for sheet in sheets.values():
+        sheet.image.delete(save=False)
+        sheet.delete()
+
+
+def update_contact_sheets_by_pk(pk):
+    for album in Album.objects.filter(pk=pk):
+        update_contact_sheets(album)
@@ -0,0 +1,33 @@
+from time import time
+from django.conf import settings
+from django.db import connections
+
+
+# Persistent connections that have sat idle for longer than this many
+# seconds are checked before a request reuses them.
+DB_HEALTH_CHECK_IDLE = getattr(
+    settings, 'PHOTOMANAGER_DB_HEALTH_CHECK_IDLE', 10)
+
+
+def check_connections(databases=None):
+    """Close any persistent connection that has gone bad while it sat
+    idle, such as when the database has restarted, so that the request
+    opens a fresh connection rather than failing on the stale one.
+    """
+    now = time()
+    for connection in databases or connections.all():
+        if connection.connection is None:
+            continue
+        last_used = getattr(connection, 'last_used', None)
+        if last_used is not None and now - last_used < DB_HEALTH_CHECK_IDLE:
+            continue
+        if not connection.is_usable():
+            connection.close()
+
+
+def mark_connections_used(databases=None):
+    """Note when each open connection was last used."""
+    now = time()
+    for connection in databases or connections.all():
+        if connection.connection is not None:
+            connection.last_used = now
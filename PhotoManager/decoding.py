@@ -0,0 +1,193 @@
+import logging
+import threading
+import Queue
+from contextlib import contextmanager
+from time import time
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_available_memory():
+    """The memory available to new allocations on this machine, in bytes,
+    or None if it can't be determined.
+    """
+    try:
+        with open('/proc/meminfo') as meminfo:
+            fields = dict(
+                line.split(':', 1) for line in meminfo if ':' in line)
+    except IOError:
+        return None
+    for field in ('MemAvailable', 'MemFree'):
+        if field in fields:
+            return int(fields[field].split()[0]) * 1024
+    return None
+
+
+# Images with more pixels than this are never decoded.
+DECODE_MAX_PIXELS = getattr(
+    settings, 'PHOTOMANAGER_DECODE_MAX_PIXELS', 120 * 1000 * 1000)
+
+# The memory that this process may spend on decoded images at once.
+# Defaults to a quarter of the memory available when the process starts.
+DECODE_MEMORY = getattr(settings, 'PHOTOMANAGER_DECODE_MEMORY', None) or \
+    (get_available_memory() or 1024 * 1024 * 1024) // 4
+
+# How long a request waits for memory to become free before giving up on
+# decoding and falling back to a placeholder.
+DECODE_TIMEOUT = getattr(settings, 'PHOTOMANAGER_DECODE_TIMEOUT', 5)
+
+# The decoded image plus one working copy of it, at up to four bytes per
+# pixel.
+BYTES_PER_PIXEL = 8
+
+# The most decodes that may wait in the background queue.
+DECODE_QUEUE_SIZE = getattr(settings, 'PHOTOMANAGER_DECODE_QUEUE_SIZE', 100)
+
+
+class DecodeUnavailable(Exception):
+    """An image can't be decoded within the decoding budget."""
+
+
+class ImageTooLarge(DecodeUnavailable):
+    """An image is too large to ever be decoded within the budget."""
+
+
+class DecoderBusy(DecodeUnavailable):
+    """Memory for decoding an image didn't become free in time."""
+
+
+class DecodeGovernor(object):
+    """A semaphore, weighted by bytes, that bounds the memory spent on
+    decoded images across all the threads of a process. Decodes that
+    would exceed the pixel limit, or that could never fit into the memory
+    budget, are refused outright without waiting.
+    """
+    def __init__(self, memory=DECODE_MEMORY, max_pixels=DECODE_MAX_PIXELS):
+        self.memory = memory
+        self.max_pixels = max_pixels
+        self.available = memory
+        self.condition = threading.Condition()
+
+    def get_max_pixels(self, scale=1):
+        """The most pixels an image may have to be decoded at all, when it
+        can be decoded at as little as 1/scale of its resolution: the
+        pixel limit, or as many as fit the memory budget at that scale,
+        whichever is fewer.
+        """
+        return min(self.max_pixels,
+                   self.memory // BYTES_PER_PIXEL * scale * scale)
+
+    def get_scale(self, size, scales):
+        """The smallest of some scales at which an image of the given size
+        can be decoded within the memory budget, or the largest of them if
+        it can't be at any.
+        """
+        scales = sorted(scales)
+        for scale in scales:
+            if self.get_cost(size, scale) <= self.memory:
+                return scale
+        return scales[-1]
+
+    def get_cost(self, size, scale=1):
+        """The memory needed to decode an image of the given size, when it
+        is decoded at 1/scale of its resolution.
+        """
+        width, height = size
+        return (
+            ((width + scale - 1) // scale) *
+            ((height + scale - 1) // scale) *
+            BYTES_PER_PIXEL)
+
+    def acquire(self, cost, timeout=None):
+        if cost > self.memory:
+            raise ImageTooLarge(
+                'Decoding needs %d bytes, more than the %d byte budget.' % (
+                    cost, self.memory))
+        deadline = None if timeout is None else time() + timeout
+        with self.condition:
+            while self.available < cost:
+                if deadline is None:
+                    self.condition.wait()
+                    continue
+                remaining = deadline - time()
+                if remaining <= 0:
+                    raise DecoderBusy(
+                        'No memory became free to decode within %ss.' %
+                        timeout)
+                self.condition.wait(remaining)
+            self.available -= cost
+
+    def release(self, cost):
+        with self.condition:
+            self.available += cost
+            self.condition.notify_all()
+
+    @contextmanager
+    def decoding(self, size, scale=1):
+        """Reserve memory for decoding an image of the given size for the
+        duration of the block. The size should come from the image's
+        header, before it is decoded. Requests give up after
+        DECODE_TIMEOUT seconds, while the background queue waits for as
+        long as it takes.
+        """
+        timeout = None if is_background() else DECODE_TIMEOUT
+        if size[0] * size[1] > self.max_pixels:
+            raise ImageTooLarge(
+                'A %dx%d image exceeds the %d pixel limit.' % (
+                    size[0], size[1], self.max_pixels))
+        cost = self.get_cost(size, scale)
+        self.acquire(cost, timeout)
+        try:
+            yield
+        finally:
+            self.release(cost)
+
+
+governor = DecodeGovernor()
+
+
+_queue = Queue.Queue(DECODE_QUEUE_SIZE)
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def _work():
+    while True:
+        func, args = _queue.get()
+        try:
+            func(*args)
+        except Exception:
+            logger.exception('Background decode failed.')
+        finally:
+            _queue.task_done()
+
+
+def is_background():
+    """Whether this is the thread that runs the background queue."""
+    return threading.current_thread() is _worker
+
+
+def enqueue(func, *args):
+    """Run func later, in this process's background decode thread. Jobs
+    are dropped when the queue is full; generate_renditions picks up
+    whatever was missed. Returns whether the job was queued.
+    """
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=_work, name='decode-queue')
+            _worker.daemon = True
+            _worker.start()
+    try:
+        _queue.put_nowait((func, args))
+    except Queue.Full:
+        logger.warning('Decode queue is full; dropping %r.', func)
+        return False
+    return True
+
+
+def queue_depth():
+    """The number of background decodes waiting to run."""
+    return _queue.qsize()
@@ -0,0 +1,133 @@
+import math
+from cStringIO import StringIO
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.images import get_image_dimensions
+from django.core.files.storage import default_storage
+from sorl.thumbnail import default
+from sorl.thumbnail.images import ImageFile
+from renditions import get_rendition_options
+from decoding import governor
+from engines import DRAFT_SCALES
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+
+# Photos with more pixels than this are shown through a deep zoom viewer
+# rather than downloaded whole.
+DEEP_ZOOM_PIXELS = getattr(
+    settings, 'PHOTOMANAGER_DEEP_ZOOM_PIXELS', 16 * 1000 * 1000)
+
+DEEP_ZOOM_TILE_SIZE = getattr(settings, 'PHOTOMANAGER_DEEP_ZOOM_TILE_SIZE', 254)
+DEEP_ZOOM_OVERLAP = 1
+DEEP_ZOOM_QUALITY = 85
+
+DZI_TEMPLATE = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+    'TileSize="%(tile_size)d" Overlap="%(overlap)d" Format="jpg">'
+    '<Size Width="%(width)d" Height="%(height)d"/>'
+    '</Image>\n'
+)
+
+
+def needs_deep_zoom(image_field):
+    """Whether an image is large enough to warrant a tile pyramid. Only
+    the image's header is read.
+    """
+    width, height = get_image_dimensions(image_field)
+    return width * height > DEEP_ZOOM_PIXELS
+
+
+def get_max_level(width, height):
+    """The level of a pyramid at which the image is at full resolution.
+    Level 0 is a single pixel, and each level doubles the one before it.
+    """
+    return int(math.ceil(math.log(max(width, height), 2)))
+
+
+def get_tile_boxes(width, height):
+    """Yield the column, row and crop box of each tile of an image of the
+    given size. Tiles overlap their neighbours by DEEP_ZOOM_OVERLAP pixels.
+    """
+    size = DEEP_ZOOM_TILE_SIZE
+    for col in range(int(math.ceil(float(width) / size))):
+        for row in range(int(math.ceil(float(height) / size))):
+            yield col, row, (
+                max(col * size - DEEP_ZOOM_OVERLAP, 0),
+                max(row * size - DEEP_ZOOM_OVERLAP, 0),
+                min((col + 1) * size + DEEP_ZOOM_OVERLAP, width),
+                min((row + 1) * size + DEEP_ZOOM_OVERLAP, height),
+            )
+
+
+def save(storage, name, content):
+    """Save a file under exactly the given name, replacing any file
+    already there. A pyramid's tiles are found by their paths alone, so
+    storage mustn't pick another name for them.
+    """
+    if storage.exists(name):
+        storage.delete(name)
+    return storage.save(name, content)
+
+
+def build_pyramid(photo, storage=default_storage):
+    """Cut a photo into a Deep Zoom (DZI) tile pyramid and save it to
+    storage. Each level is scaled down from the one above it, so the
+    original is only decoded once. JPEGs too large to decode at full
+    resolution within the memory budget are decoded at the largest scale
+    that fits, which becomes the pyramid's top level. Building it again
+    replaces it. Returns the name of the saved .dzi descriptor; the tiles
+    are saved alongside it under <name>_files/.
+    """
+    engine = default.engine
+    options = get_rendition_options()
+    image = engine.get_image(ImageFile(photo.image))
+    base = 'deepzoom/%d/%d' % (photo.author_id, photo.pk)
+    size = image.size
+    scale = governor.get_scale(size, (1,) + DRAFT_SCALES)
+    if scale > 1:
+        image.draft(image.mode, (size[0] // scale, size[1] // scale))
+        if image.size == size:
+            # The format can't be decoded at a reduced scale.
+            scale = 1
+    with governor.decoding(size, scale):
+        image = engine.orientation(image, None, options)
+        image = engine.colorspace(image, None, options)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        width, height = image.size
+        for level in range(get_max_level(width, height), -1, -1):
+            for col, row, box in get_tile_boxes(*image.size):
+                buf = StringIO()
+                image.crop(box).save(
+                    buf, format='JPEG', quality=DEEP_ZOOM_QUALITY)
+                save(
+                    storage,
+                    '%s_files/%d/%d_%d.jpg' % (base, level, col, row),
+                    ContentFile(buf.getvalue()))
+            image = image.resize(
+                ((image.size[0] + 1) // 2, (image.size[1] + 1) // 2),
+                Image.ANTIALIAS)
+
+    return save(storage, '%s.dzi' % base, ContentFile(DZI_TEMPLATE % {
+        'tile_size': DEEP_ZOOM_TILE_SIZE,
+        'overlap': DEEP_ZOOM_OVERLAP,
+        'width': width,
+        'height': height,
+    }))
+
+
+def generate_pyramid(photo):
+    """Build a tile pyramid for a photo if it's large enough to need one
+    and doesn't have one yet, and record it on the photo. The photo isn't
+    saved. Returns whether a pyramid was built.
+    """
+    if photo.deep_zoom or not needs_deep_zoom(photo.image):
+        return False
+    photo.deep_zoom = build_pyramid(photo)
+    return True
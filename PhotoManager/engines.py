@@ -0,0 +1,75 @@
+from sorl.thumbnail.conf import settings
+from sorl.thumbnail.engines import pil_engine
+from decoding import governor
+
+
+# EXIF orientations that turn the image on its side, swapping its width
+# and height.
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+# Scales that the JPEG decoder is able to apply while decoding.
+DRAFT_SCALES = (8, 4, 2)
+
+
+def get_draft_scale(size, geometry, crop):
+    """The largest scale the JPEG decoder can apply to an image of the
+    given size that still leaves it covering geometry, or 1.
+    """
+    factors = (float(geometry[0]) / size[0], float(geometry[1]) / size[1])
+    factor = max(factors) if crop else min(factors)
+    for scale in DRAFT_SCALES:
+        if factor * scale <= 1:
+            return scale
+    return 1
+
+
+class Engine(pil_engine.Engine):
+    """A sorl-thumbnail engine that shrinks images while they are loaded.
+    JPEGs are decoded at the smallest power-of-two scale that still covers
+    the requested thumbnail instead of at full resolution, which is far
+    cheaper in both time and memory for large photos.
+    """
+    def create(self, image, geometry, options):
+        size = self.get_image_size(image)
+        scale = self.draft(image, geometry, options)
+        with governor.decoding(size, scale):
+            return super(Engine, self).create(image, geometry, options)
+
+    def draft(self, image, geometry, options):
+        """Configure the decoder of an image that hasn't been loaded yet
+        to decode it at a reduced scale, and return the scale. Formats
+        that can't be decoded at a reduced scale are left untouched.
+        """
+        x_image, y_image = self.get_image_size(image)
+        x_geometry, y_geometry = geometry
+        if options.get('orientation', settings.THUMBNAIL_ORIENTATION) and \
+                self.get_orientation(image) in TRANSPOSED_ORIENTATIONS:
+            x_geometry, y_geometry = y_geometry, x_geometry
+        scale = get_draft_scale(
+            (x_image, y_image), (x_geometry, y_geometry), options['crop'])
+        if scale > 1:
+            image.draft(image.mode, (x_image // scale, y_image // scale))
+            if self.get_image_size(image) != (x_image, y_image):
+                return scale
+        return 1
+
+    def get_orientation(self, image):
+        """Return the EXIF orientation of an image, if it has one."""
+        try:
+            exif = image._getexif()
+        except AttributeError:
+            exif = None
+        if exif:
+            return exif.get(0x0112)
+        return None
+
+    def _scale(self, image, width, height):
+        # Pillow versions that support it can cheaply box-reduce by an
+        # integer factor before the antialiased resize, as long as at
+        # least twice the target resolution is kept.
+        if hasattr(image, 'reduce'):
+            factor = min(
+                image.size[0] // (2 * width), image.size[1] // (2 * height))
+            if factor > 1:
+                image = image.reduce(factor)
+        return super(Engine, self)._scale(image, width, height)
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import logging
+import os
+import posixpath
+from django.conf import settings
+from django.template.loader import render_to_string
+from sorl.thumbnail import get_thumbnail
+from decoding import DecodeUnavailable
+from renditions import generate_renditions
+
+
+logger = logging.getLogger(__name__)
+
+# The thumbnail geometry of a gallery's grid, and the geometry its photo
+# pages show photos at.
+GALLERY_THUMBNAIL = getattr(
+    settings, 'PHOTOMANAGER_GALLERY_THUMBNAIL', '100x100')
+GALLERY_DISPLAY_SIZE = getattr(
+    settings, 'PHOTOMANAGER_GALLERY_DISPLAY_SIZE', '1024x1024')
+
+RENDITIONS = ('thumbnail', 'display')
+
+# Where an export records what it wrote, so that the next export of the
+# same album can leave alone whatever hasn't changed.
+STATE_NAME = '.gallery.json'
+
+
+def write(path, content):
+    """Replace a file in one step, so that it's never served half written."""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(content)
+    os.rename(path + '.tmp', path)
+
+
+def load_state(directory):
+    try:
+        with open(os.path.join(directory, STATE_NAME)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {'photos': {}, 'files': {}}
+
+
+def has_image(directory, image):
+    return all(os.path.exists(os.path.join(directory, image[key]['name']))
+               for key in RENDITIONS)
+
+
+def export_image(photo, directory):
+    """Copy a photo's thumbnail and display renditions into a gallery,
+    generating them first if need be. Returns their names and sizes.
+    """
+    generate_renditions(
+        photo.image, sizes=(GALLERY_THUMBNAIL, GALLERY_DISPLAY_SIZE))
+    image = {'image': photo.image.name}
+    for key, geometry, suffix in (
+            ('thumbnail', GALLERY_THUMBNAIL, '-thumbnail'),
+            ('display', GALLERY_DISPLAY_SIZE, '')):
+        rendition = get_thumbnail(photo.image, geometry)
+        name = posixpath.join('images', '%d%s%s' % (
+            photo.pk, suffix, posixpath.splitext(rendition.name)[1]))
+        write(os.path.join(directory, name), rendition.read())
+        image[key] = {
+            'name': name, 'width': rendition.width, 'height': rendition.height}
+    return image
+
+
+def export_album(album, directory):
+    """Render an album into a static site in directory: an index page with
+    a grid of thumbnails, a page for each photo, and the renditions they
+    show. Renditions are only copied for photos whose images are new to
+    the directory, and pages are only rewritten when their contents
+    change; the files of photos that have left the album are removed.
+    Returns the names of the files written and removed, and the photos
+    whose renditions couldn't be generated and were left out.
+    """
+    state = load_state(directory)
+    images, files, written, skipped = {}, {}, [], []
+
+    photos = []
+    for photo in album.get_photos().prefetch_related('tags'):
+        image = state['photos'].get(str(photo.pk))
+        if image is None or image['image'] != photo.image.name or \
+                not has_image(directory, image):
+            try:
+                image = export_image(photo, directory)
+            except DecodeUnavailable, e:
+                logger.warning('Leaving photo %d out of the gallery: %s',
+                               photo.pk, e)
+                skipped.append(photo.pk)
+                continue
+            written.extend(image[key]['name'] for key in RENDITIONS)
+        images[str(photo.pk)] = image
+        for key in RENDITIONS:
+            files[image[key]['name']] = None
+        photos.append(dict(
+            image, pk=photo.pk, description=photo.description,
+            placeholder=photo.placeholder,
+            tags=[tag.text for tag in photo.tags.all()]))
+
+    def put(name, content):
+        content = content.encode('utf-8')
+        digest = hashlib.sha1(content).hexdigest()
+        files[name] = digest
+        if state['files'].get(name) != digest or \
+                not os.path.exists(os.path.join(directory, name)):
+            write(os.path.join(directory, name), content)
+            written.append(name)
+
+    context = {'album': album, 'photos': photos}
+    put('index.html', render_to_string(
+        'PhotoManager/gallery/index.html', context))
+    for i, photo in enumerate(photos):
+        put('photos/%d.html' % photo['pk'], render_to_string(
+            'PhotoManager/gallery/photo.html', dict(
+                context, photo=photo, index=i + 1,
+                previous=photos[i - 1] if i > 0 else None,
+                next=photos[i + 1] if i + 1 < len(photos) else None)))
+
+    removed = []
+    for name in set(state['files']) - set(files):
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
+        removed.append(name)
+
+    write(os.path.join(directory, STATE_NAME),
+          json.dumps({'photos': images, 'files': files}, indent=1))
+    return written, removed, skipped
@@ -0,0 +1,49 @@
+import logging
+from decoding import DecoderBusy, ImageTooLarge, enqueue, is_background
+from deepzoom import generate_pyramid, needs_deep_zoom
+from models import Photo
+from renditions import generate_renditions, generate_placeholder
+from zipstream import get_checksums
+
+
+logger = logging.getLogger(__name__)
+
+
+def process_photo(photo):
+    """Record the checksums of a newly uploaded photo, and generate its
+    renditions, placeholder and deep zoom pyramid. If there isn't memory
+    to decode it right now, the work is handed to the background decode
+    queue instead. Pyramids take too long to build within a request, so
+    they are always built on the queue.
+    """
+    if photo.image_crc32 is None:
+        photo.image_size, photo.image_crc32 = get_checksums(photo.image)
+    try:
+        generate_renditions(photo.image)
+        if not photo.placeholder:
+            photo.placeholder = generate_placeholder(photo.image)
+        if is_background():
+            generate_pyramid(photo)
+        elif not photo.deep_zoom and needs_deep_zoom(photo.image):
+            enqueue(generate_pyramid_by_pk, photo.pk)
+    except DecoderBusy:
+        enqueue(process_photo_by_pk, photo.pk)
+    except ImageTooLarge, e:
+        logger.warning('Not processing photo %d: %s', photo.pk, e)
+    Photo.objects.filter(pk=photo.pk).update(
+        placeholder=photo.placeholder, deep_zoom=photo.deep_zoom,
+        image_size=photo.image_size, image_crc32=photo.image_crc32)
+
+
+def process_photo_by_pk(pk):
+    for photo in Photo.objects.filter(pk=pk):
+        process_photo(photo)
+
+
+def generate_pyramid_by_pk(pk):
+    for photo in Photo.objects.filter(pk=pk):
+        try:
+            if generate_pyramid(photo):
+                Photo.objects.filter(pk=pk).update(deep_zoom=photo.deep_zoom)
+        except ImageTooLarge, e:
+            logger.warning('Not building a pyramid for photo %d: %s', pk, e)
@@ -0,0 +1,26 @@
+from django.core.cache import cache
+from sorl.thumbnail.conf import settings
+from sorl.thumbnail.kvstores import cached_db_kvstore
+from sorl.thumbnail.models import KVStore as KVStoreModel
+import profiling
+
+
+class KVStore(cached_db_kvstore.KVStore):
+    """sorl-thumbnail's cached database key-value store, counting how
+    often the cache in front of the database is hit and missed.
+    """
+    def _get_raw(self, key):
+        value = cache.get(key)
+        if value is None:
+            profiling.count('cache_misses')
+            try:
+                value = KVStoreModel.objects.get(key=key).value
+            except KVStoreModel.DoesNotExist:
+                # we set the cache to prevent further db lookups
+                value = cached_db_kvstore.EMPTY_VALUE
+            cache.set(key, value, settings.THUMBNAIL_CACHE_TIMEOUT)
+        else:
+            profiling.count('cache_hits')
+        if value == cached_db_kvstore.EMPTY_VALUE:
+            return None
+        return value
@@ -0,0 +1,31 @@
+from optparse import make_option
+from time import time
+from django.core.management.base import BaseCommand, CommandError
+from PhotoManager import backups
+
+
+class Command(BaseCommand):
+    args = '<directory>'
+    help = (
+        'Backs up the library\'s users, tags, photos and albums, and the '
+        'originals of its photos, to a directory. Files are stored by '
+        'checksum, and only those that the previous backup in the '
+        'directory doesn\'t have are copied.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--workers',
+            dest='workers',
+            type='int',
+            default=backups.BACKUP_WORKERS,
+            help='Number of files to read from storage at once.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: backup_library %s' % self.args)
+        start = time()
+        name, copied = backups.backup(args[0], workers=options['workers'])
+        self.stdout.write('Wrote manifest %s, copying %d files, in %.1fs.' % (
+            name, copied, time() - start))
@@ -0,0 +1,158 @@
+import json
+import random
+import subprocess
+import tempfile
+from collections import OrderedDict
+from optparse import make_option
+from shutil import rmtree
+from time import time
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+from django.test.utils import override_settings
+from django.utils.functional import empty
+from sorl.thumbnail import default
+from south.management.commands import patch_for_test_db_setup
+from PhotoManager.benchmark import BENCH_PASSWORD, Timer, generate_library, \
+    make_image, peak_rss
+from PhotoManager.models import Tag, Photo, Album
+from PhotoManager.renditions import generate_renditions
+
+
+def get_commit():
+    """The git commit being benchmarked, if there is one."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR,
+            stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks PhotoManager against a generated library in a '
+        'throwaway database and media directory, and reports latencies, '
+        'query counts and peak memory as JSON. Run it with '
+        '--settings=PhotoApp.bench_settings to use SQLite and local '
+        'memory caching.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option('--users', dest='users', type='int', default=2,
+                    help='Number of users to generate.'),
+        make_option('--albums', dest='albums', type='int', default=10,
+                    help='Number of albums per user.'),
+        make_option('--photos', dest='photos', type='int', default=50,
+                    help='Number of photos per user.'),
+        make_option('--tags', dest='tags', type='int', default=20,
+                    help='Number of tags shared between users.'),
+        make_option('--photos-per-album', dest='photos_per_album',
+                    type='int', default=10,
+                    help='Number of photos in each album.'),
+        make_option('--requests', dest='requests', type='int', default=50,
+                    help='Number of requests made to each view.'),
+        make_option('--uploads', dest='uploads', type='int', default=10,
+                    help='Number of photos uploaded.'),
+        make_option('--seed', dest='seed', type='int', default=0,
+                    help='Seed for generating the library.'),
+        make_option('--output', dest='output', default=None,
+                    help='Write the report to this file.'),
+    )
+
+    def handle(self, *args, **options):
+        patch_for_test_db_setup()
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True)
+        media_root = tempfile.mkdtemp(prefix='photomanager-bench-')
+        try:
+            with override_settings(MEDIA_ROOT=media_root):
+                default.storage._wrapped = empty
+                report = self.bench(options)
+        finally:
+            default.storage._wrapped = empty
+            rmtree(media_root, ignore_errors=True)
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(report + '\n')
+        else:
+            self.stdout.write(report)
+
+    def bench(self, options):
+        rng = random.Random(options['seed'])
+        start = time()
+        users = generate_library(
+            users=options['users'],
+            albums=options['albums'],
+            photos=options['photos'],
+            tags=options['tags'],
+            photos_per_album=options['photos_per_album'],
+            seed=options['seed'],
+        )
+        generate_seconds = time() - start
+
+        user = users[0]
+        client = Client()
+        client.login(username=user.username, password=BENCH_PASSWORD)
+        photos = list(Photo.objects.filter(author=user))
+        albums = list(Album.objects.filter(author=user))
+        tags = list(Tag.objects.filter(photo__author=user).distinct())
+
+        timers = OrderedDict(
+            (name, Timer()) for name in (
+                'thumbnail', 'home_view', 'album_view', 'photo_view',
+                'tag_view', 'upload'))
+
+        for photo in photos:
+            timers['thumbnail'].measure(generate_renditions, photo.image)
+
+        views = (
+            ('home_view', lambda: reverse('PhotoManager:pm-home')),
+            ('album_view', lambda: reverse(
+                'PhotoManager:pm-album', args=[rng.choice(albums).pk])),
+            ('photo_view', lambda: reverse(
+                'PhotoManager:pm-photo', args=[rng.choice(photos).pk])),
+            ('tag_view', lambda: reverse(
+                'PhotoManager:pm-tag', args=[rng.choice(tags).pk])),
+        )
+        for i in range(options['requests']):
+            for name, url in views:
+                response = timers[name].measure(client.get, url())
+                if response.status_code != 200:
+                    raise CommandError('%s returned %d.' % (
+                        name, response.status_code))
+
+        for i in range(options['uploads']):
+            response = timers['upload'].measure(
+                client.post, reverse('PhotoManager:pm-create_photo'), {
+                    'album': rng.choice(albums).pk,
+                    'description': 'Uploaded photo %d' % i,
+                    'image': SimpleUploadedFile(
+                        'upload-%d.jpg' % i, make_image(rng), 'image/jpeg'),
+                })
+            if response.status_code != 302:
+                raise CommandError(
+                    'Upload returned %d.' % response.status_code)
+
+        return {
+            'commit': get_commit(),
+            'database': connection.vendor,
+            'library': {
+                'users': options['users'],
+                'albums': options['albums'],
+                'photos': options['photos'],
+                'tags': options['tags'],
+                'photos_per_album': options['photos_per_album'],
+                'seed': options['seed'],
+                'generate_s': round(generate_seconds, 3),
+            },
+            'results': dict(
+                (name, timer.summary())
+                for name, timer in timers.items() if timer.latencies),
+            'peak_rss_kb': peak_rss(),
+        }
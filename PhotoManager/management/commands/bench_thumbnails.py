@@ -0,0 +1,92 @@
+from optparse import make_option
+from cStringIO import StringIO
+from time import time
+from os import urandom
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from sorl.thumbnail.engines import pil_engine
+from sorl.thumbnail.parsers import parse_geometry
+from PhotoManager import engines
+from PhotoManager.renditions import get_rendition_options, create_renditions
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+
+def make_jpeg(width, height):
+    """Generate a JPEG with enough detail to be expensive to decode."""
+    image = Image.frombytes('RGB', (64, 64), urandom(64 * 64 * 3))
+    image = image.resize((width, height), Image.BILINEAR)
+    buf = StringIO()
+    image.save(buf, format='JPEG', quality=90)
+    return buf.getvalue()
+
+
+class Command(BaseCommand):
+    help = (
+        'Compares the thumbnailing throughput of the stock sorl-thumbnail '
+        'engine with the shrink-on-load engine and the single-decode '
+        'rendition pipeline.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--width', dest='width', type='int', default=6000,
+            help='Width of the generated source image.'
+        ),
+        make_option(
+            '--height', dest='height', type='int', default=4000,
+            help='Height of the generated source image.'
+        ),
+        make_option(
+            '--sizes', dest='sizes', default='1024x1024,400x400,100x100',
+            help='Comma-separated thumbnail geometries to generate.'
+        ),
+        make_option(
+            '--iterations', dest='iterations', type='int', default=5,
+            help='Number of times each source image is thumbnailed.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        data = make_jpeg(options['width'], options['height'])
+        sizes = options['sizes'].split(',')
+        iterations = options['iterations']
+        thumbnail_options = get_rendition_options()
+
+        def per_size(engine):
+            for geometry_string in sizes:
+                image = engine.get_image(ContentFile(data))
+                geometry = parse_geometry(
+                    geometry_string, engine.get_image_ratio(image))
+                engine._get_raw_data(
+                    engine.create(image, geometry, thumbnail_options),
+                    'JPEG', thumbnail_options['quality'])
+
+        def single_decode(engine):
+            image = engine.get_image(ContentFile(data))
+            ratio = engine.get_image_ratio(image)
+            geometries = [parse_geometry(size, ratio) for size in sizes]
+            for geometry, rendition in create_renditions(
+                    image, geometries, thumbnail_options, engine):
+                engine._get_raw_data(
+                    rendition, 'JPEG', thumbnail_options['quality'])
+
+        runs = (
+            ('stock engine', per_size, pil_engine.Engine()),
+            ('shrink-on-load engine', per_size, engines.Engine()),
+            ('single-decode renditions', single_decode, engines.Engine()),
+        )
+        self.stdout.write('%dx%d source, sizes %s, %d iterations' % (
+            options['width'], options['height'], ', '.join(sizes),
+            iterations))
+        baseline = None
+        for name, run, engine in runs:
+            start = time()
+            for i in range(iterations):
+                run(engine)
+            elapsed = (time() - start) / iterations
+            baseline = baseline or elapsed
+            self.stdout.write('%-26s %8.1f ms/photo %6.2f photos/s %5.1fx' % (
+                name, elapsed * 1000, 1 / elapsed, baseline / elapsed))
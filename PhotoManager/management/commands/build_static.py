@@ -0,0 +1,39 @@
+import os
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from PhotoManager import assets
+
+
+class Command(BaseCommand):
+    help = (
+        'Copies the static assets to PHOTOMANAGER_STATIC_BUILD_ROOT under '
+        'fingerprinted names, with gzip and brotli variants, and writes '
+        'the nginx configuration that serves them.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--nginx-config',
+            dest='nginx_config',
+            default=os.path.join(assets.STATIC_BUILD_ROOT, 'nginx_static.conf'),
+            help='Where to write the nginx location block for the assets.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        manifest = assets.build()
+        with open(options['nginx_config'], 'w') as f:
+            f.write(assets.render_nginx_config())
+
+        original = compressed = 0
+        for name, hashed in manifest.items():
+            path = os.path.join(assets.STATIC_BUILD_ROOT, hashed)
+            size = os.path.getsize(path)
+            original += size
+            if os.path.exists(path + '.gz'):
+                size = os.path.getsize(path + '.gz')
+            compressed += size
+        self.stdout.write(
+            'Built %d assets: %d bytes, or %d bytes gzipped%s. Wrote %s.' % (
+                len(manifest), original, compressed,
+                '' if assets.brotli else ' (brotli is not installed)',
+                options['nginx_config']))
@@ -0,0 +1,44 @@
+import os
+from optparse import make_option
+from time import time
+from django.core.management.base import BaseCommand, CommandError
+from PhotoManager.warmup import get_template_names, check_template
+
+import PhotoManager
+
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(PhotoManager.__file__), 'templates')
+
+
+class Command(BaseCommand):
+    help = (
+        'Compiles the PhotoManager and registration templates, along with '
+        'any templates they extend or include, and fails if any of them '
+        'has an error. Run it when deploying.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--all',
+            dest='all',
+            action='store_true',
+            default=False,
+            help='Compile the templates of every installed app as well.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        directories = None if options['all'] else [TEMPLATE_DIR]
+        names = get_template_names(directories)
+        errors = []
+        start = time()
+        for name in names:
+            try:
+                check_template(name)
+            except Exception, e:
+                errors.append('%s: %s: %s' % (name, type(e).__name__, e))
+        if errors:
+            raise CommandError(
+                '%d of %d templates failed to compile:\n%s' % (
+                    len(errors), len(names), '\n'.join(errors)))
+        self.stdout.write('Compiled %d templates in %.3fs.' % (
+            len(names), time() - start))
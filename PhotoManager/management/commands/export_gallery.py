@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from PhotoManager.models import Album
+from PhotoManager.galleries import export_album
+
+
+class Command(BaseCommand):
+    args = '<album id> <directory>'
+    help = (
+        'Renders an album into a static site that any web server can '
+        'serve. Exporting to the same directory again only rewrites the '
+        'files of photos that have changed.'
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Usage: export_gallery %s' % self.args)
+        try:
+            album = Album.objects.get(pk=args[0])
+        except (Album.DoesNotExist, ValueError):
+            raise CommandError('There is no album %s.' % args[0])
+        written, removed, skipped = export_album(album, args[1])
+        for pk in skipped:
+            self.stderr.write('Left out photo %d, which could not be '
+                              'decoded right now.' % pk)
+        self.stdout.write('Wrote %d files and removed %d in %s.' % (
+            len(written), len(removed), args[1]))
@@ -0,0 +1,66 @@
+from datetime import timedelta
+from optparse import make_option
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from sorl.thumbnail import default
+from PhotoManager.orphans import find_references, find_orphans, get_batches
+
+
+class Command(BaseCommand):
+    help = (
+        'Deletes the originals, thumbnails, contact sheets and deep zoom '
+        'tiles in storage that no photo or album refers to any more, and '
+        'the thumbnail key-value store\'s entries for them.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--dry-run',
+            dest='dry_run',
+            action='store_true',
+            default=False,
+            help='Report what would be deleted without deleting it.'
+        ),
+        make_option(
+            '--batch-size',
+            dest='batch_size',
+            type='int',
+            default=1000,
+            help='Number of files to delete at a time.'
+        ),
+        make_option(
+            '--min-age',
+            dest='min_age',
+            type='float',
+            default=24,
+            help='Only delete files at least this many hours old, so that '
+                 'uploads in progress are left alone.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options['verbosity'])
+        dry_run = options['dry_run']
+        references, stale_keys = find_references(default_storage)
+        for batch in get_batches(stale_keys, options['batch_size']):
+            if not dry_run:
+                default.kvstore._delete_raw(*batch)
+
+        files = size = 0
+        orphans = find_orphans(
+            references, default_storage, timedelta(hours=options['min_age']))
+        for batch in get_batches(orphans, options['batch_size']):
+            for name in batch:
+                size += default_storage.size(name)
+                if verbosity > 1:
+                    self.stdout.write(name)
+                if not dry_run:
+                    default_storage.delete(name)
+            files += len(batch)
+            if verbosity > 1:
+                self.stdout.write('%s %d files so far.' % (
+                    'Found' if dry_run else 'Deleted', files))
+
+        self.stdout.write(
+            '%s %d orphaned files (%d bytes) and %d stale thumbnail '
+            'entries.' % ('Would delete' if dry_run else 'Deleted', files,
+                          size, len(stale_keys)))
@@ -0,0 +1,84 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from PhotoManager.models import Photo, Album
+from PhotoManager.renditions import generate_renditions, generate_placeholder
+from PhotoManager.deepzoom import generate_pyramid
+from PhotoManager.decoding import DecodeUnavailable
+from PhotoManager.zipstream import get_checksums
+from PhotoManager import contactsheets
+
+
+class Command(BaseCommand):
+    help = (
+        'Generates any missing checksums, renditions, placeholders and deep '
+        'zoom pyramids for the photos already in the library.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--author',
+            dest='author',
+            default=None,
+            help='Only generate renditions for photos by this user id.'
+        ),
+        make_option(
+            '--batch-size',
+            dest='batch_size',
+            type='int',
+            default=100,
+            help='Number of photos to process per database transaction.'
+        ),
+    )
+
+    def get_batches(self, photos, batch_size):
+        """Walk a queryset of photos in batches of primary keys, so that
+        neither a long-running cursor nor the whole library is held in
+        memory.
+        """
+        last_pk = 0
+        while True:
+            batch = list(photos.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                return
+            yield batch
+            last_pk = batch[-1].pk
+
+    def handle(self, *args, **options):
+        photos = Photo.objects.order_by('pk').only(
+            'image', 'author', 'placeholder', 'deep_zoom', 'image_crc32')
+        if options['author'] is not None:
+            photos = photos.filter(author_id=options['author'])
+
+        checksums = created = placeholders = pyramids = 0
+        for batch in self.get_batches(photos, options['batch_size']):
+            with transaction.atomic():
+                for photo in batch:
+                    if photo.image_crc32 is None:
+                        size, crc32 = get_checksums(photo.image)
+                        Photo.objects.filter(pk=photo.pk).update(
+                            image_size=size, image_crc32=crc32)
+                        checksums += 1
+                    try:
+                        created += len(generate_renditions(photo.image))
+                        if not photo.placeholder:
+                            Photo.objects.filter(pk=photo.pk).update(
+                                placeholder=generate_placeholder(photo.image))
+                            placeholders += 1
+                        if generate_pyramid(photo):
+                            Photo.objects.filter(pk=photo.pk).update(
+                                deep_zoom=photo.deep_zoom)
+                            pyramids += 1
+                    except DecodeUnavailable, e:
+                        self.stderr.write('Skipped photo %d: %s' % (
+                            photo.pk, e))
+        self.stdout.write(
+            'Generated %d checksums, %d renditions, %d placeholders and %d '
+            'pyramids.' % (checksums, created, placeholders, pyramids))
+
+        if contactsheets.CONTACT_SHEETS:
+            albums = Album.objects.order_by('pk')
+            if options['author'] is not None:
+                albums = albums.filter(author_id=options['author'])
+            for album in albums.iterator():
+                contactsheets.update_contact_sheets(album)
+            self.stdout.write('Updated contact sheets.')
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from PhotoManager.quotas import reconcile
+
+
+class Command(BaseCommand):
+    help = (
+        'Recounts how many bytes and photos every user has stored, and '
+        'corrects the running totals that quotas are checked against '
+        'wherever they\'ve drifted.'
+    )
+
+    def handle(self, *args, **options):
+        drifted = reconcile()
+        if int(options['verbosity']) > 1:
+            for usage in drifted:
+                self.stdout.write(
+                    'User %d had %d bytes in %d photos recorded.' % (
+                        usage.pk, usage.bytes, usage.photos))
+        self.stdout.write('Corrected the usage of %d users.' % len(drifted))
@@ -0,0 +1,64 @@
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from PhotoManager.models import Photo
+from PhotoManager import uploads
+
+
+class Command(BaseCommand):
+    help = (
+        'Moves the originals of the photos already in the library to an '
+        'upload layout, copying several at once and pointing the photos at '
+        'their new names a batch at a time. Set PHOTOMANAGER_UPLOAD_LAYOUT '
+        'to the same layout, so that new uploads follow it too.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--layout',
+            dest='layout',
+            default=uploads.UPLOAD_LAYOUT,
+            help='The layout to move originals to: %s.' %
+                 ', '.join(uploads.UPLOAD_LAYOUTS)
+        ),
+        make_option(
+            '--workers',
+            dest='workers',
+            type='int',
+            default=uploads.RELOCATE_WORKERS,
+            help='Number of files to copy at once.'
+        ),
+        make_option(
+            '--batch-size',
+            dest='batch_size',
+            type='int',
+            default=100,
+            help='Number of photos to move per database transaction.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        layout = options['layout']
+        if layout not in uploads.UPLOAD_LAYOUTS:
+            raise CommandError('Unknown layout %r; choose from %s.' % (
+                layout, ', '.join(uploads.UPLOAD_LAYOUTS)))
+        verbosity = int(options['verbosity'])
+        photos = Photo.objects.order_by('pk').only(
+            'image', 'author', 'date_created')
+        moved = last_pk = 0
+        pool = ThreadPool(options['workers'])
+        try:
+            while True:
+                batch = list(
+                    photos.filter(pk__gt=last_pk)[:options['batch_size']])
+                if not batch:
+                    break
+                last_pk = batch[-1].pk
+                moved += uploads.relocate(batch, layout, pool=pool)
+                if verbosity > 1:
+                    self.stdout.write('Moved %d photos, up to photo %d.' % (
+                        moved, last_pk))
+        finally:
+            pool.close()
+            pool.join()
+        self.stdout.write('Moved %d photos to the %s layout.' % (
+            moved, layout))
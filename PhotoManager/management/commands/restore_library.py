@@ -0,0 +1,61 @@
+from optparse import make_option
+from time import time
+from django.core.management.base import BaseCommand, CommandError
+from PhotoManager import backups
+
+
+class Command(BaseCommand):
+    args = '<directory>'
+    help = (
+        'Restores the library from a backup written by backup_library, '
+        'checking every file against its checksum.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--manifest',
+            dest='manifest',
+            default=None,
+            help='The manifest to restore. Defaults to the latest one.'
+        ),
+        make_option(
+            '--verify-only',
+            dest='verify_only',
+            action='store_true',
+            default=False,
+            help='Only check the backup against its checksums.'
+        ),
+        make_option(
+            '--workers',
+            dest='workers',
+            type='int',
+            default=backups.BACKUP_WORKERS,
+            help='Number of files to restore at once.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: restore_library %s' % self.args)
+        root = args[0]
+        try:
+            manifest = backups.load_manifest(root, options['manifest'])
+        except IOError, e:
+            raise CommandError('Could not read the manifest: %s' % e)
+        if manifest is None:
+            raise CommandError('%s holds no backups.' % root)
+
+        start = time()
+        corrupt = backups.verify(root, manifest, options['workers'])
+        if corrupt:
+            raise CommandError(
+                '%d blobs are missing or corrupt:\n%s' % (
+                    len(corrupt), '\n'.join(corrupt)))
+        if options['verify_only']:
+            self.stdout.write('Verified %d files in %.1fs.' % (
+                len(manifest['files']), time() - start))
+            return
+        written = backups.restore(root, manifest, workers=options['workers'])
+        self.stdout.write(
+            'Restored %d files, of %d, and the rows of the backup from %s '
+            'in %.1fs.' % (written, len(manifest['files']),
+                           manifest['created'], time() - start))
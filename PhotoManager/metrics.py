@@ -0,0 +1,384 @@
+import atexit
+import errno
+import fcntl
+import json
+import logging
+import os
+import re
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from time import time
+from django.conf import settings
+import decoding
+
+
+logger = logging.getLogger(__name__)
+
+# A directory shared by every worker process, where each one periodically
+# writes out its metrics so that any of them can report the totals. With
+# no directory, each process only reports its own metrics.
+METRICS_DIR = getattr(settings, 'PHOTOMANAGER_METRICS_DIR', None)
+
+# How often, in seconds, a process writes its metrics out to METRICS_DIR.
+METRICS_FLUSH_INTERVAL = getattr(
+    settings, 'PHOTOMANAGER_METRICS_FLUSH_INTERVAL', 5)
+
+# The addresses that may read the metrics endpoint.
+METRICS_ALLOWED_IPS = getattr(
+    settings, 'PHOTOMANAGER_METRICS_ALLOWED_IPS', ('127.0.0.1',))
+
+# The upper bounds of the latency histograms' buckets, in seconds.
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Each worker's file in METRICS_DIR is named by its process id and when it
+# started, so that a process that reuses the id of one that has exited
+# doesn't overwrite that one's values.
+WORKER_FILE = re.compile(r'^(\d+)-(\d+)\.json$')
+
+# The file in METRICS_DIR that the counters and histograms of workers that
+# have exited are added into, before their own files are removed.
+ARCHIVE_FILE = 'archive.json'
+ARCHIVE_LOCK = 'archive.lock'
+
+
+def is_alive(pid):
+    """Whether a process with the given id is running."""
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def dump_values(values):
+    return dict(
+        (name, [[list(map(list, labels)), value]
+                for labels, value in collected])
+        for name, collected in values.items())
+
+
+def load_values(values):
+    return dict(
+        (name, [(tuple(map(tuple, labels)), value)
+                for labels, value in collected])
+        for name, collected in values.items())
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, unicode(value).replace('\\', r'\\').
+                     replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels)
+
+
+class Metric(object):
+    """A named metric, with one value for each combination of labels."""
+    kind = None
+
+    def __init__(self, name, help, registry):
+        self.name = name
+        self.help = help
+        self.registry = registry
+        self.values = {}
+
+    def get_key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def collect(self):
+        """This process's values, as (labels, value) pairs."""
+        return self.values.items()
+
+    def merge(self, total, value):
+        return total + value
+
+    def samples(self, labels, value):
+        yield self.name, labels, value
+
+
+class Counter(Metric):
+    """A count that only goes up."""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        self.registry.changed()
+
+
+class Histogram(Metric):
+    """Counts of observations falling into fixed buckets, along with
+    their sum. Each value is a list of the count in every bucket,
+    including the implicit +Inf bucket, followed by the sum.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, registry, buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help, registry)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        with self.registry.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+        self.registry.changed()
+
+    def merge(self, total, value):
+        return [a + b for a, b in zip(total, value)]
+
+    def samples(self, labels, value):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), value):
+            cumulative += count
+            yield self.name + '_bucket', \
+                labels + (('le', bound),), cumulative
+        yield self.name + '_sum', labels, value[-1]
+        yield self.name + '_count', labels, cumulative
+
+
+class Gauge(Metric):
+    """A value that is read from a function whenever it's collected. The
+    values of the processes that are still running are summed.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, registry, func):
+        super(Gauge, self).__init__(name, help, registry)
+        self.func = func
+
+    def collect(self):
+        return [((), self.func())]
+
+
+class Registry(object):
+    """The metrics of this process. When given a directory, the registry
+    writes its values there every flush_interval seconds, and reports the
+    sum of the values of every process that has written there. The
+    counters and histograms of processes that have exited are kept in an
+    archive, so that totals never go down as workers come and go.
+    """
+    def __init__(self, directory=None, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.metrics = OrderedDict()
+        self.lock = threading.Lock()
+        self.next_flush = 0
+        self.pid = self.started = None
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help, self))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, self, buckets))
+
+    def gauge(self, name, help, func):
+        return self.register(Gauge(name, help, self, func))
+
+    def collect(self):
+        """This process's values of every metric, by name."""
+        with self.lock:
+            return dict(
+                (name, list(metric.collect()))
+                for name, metric in self.metrics.items())
+
+    def changed(self):
+        if self.directory is not None and time() >= self.next_flush:
+            self.flush()
+
+    def get_name(self):
+        """The name of this process's file. A process forked from this one
+        is given its own.
+        """
+        if self.pid != os.getpid():
+            self.pid, self.started = os.getpid(), int(time() * 1000)
+        return '%d-%d.json' % (self.pid, self.started)
+
+    def get_path(self, name=None):
+        return os.path.join(self.directory, name or self.get_name())
+
+    def read(self, name):
+        try:
+            with open(self.get_path(name)) as f:
+                return json.load(f)
+        except (IOError, ValueError), e:
+            if getattr(e, 'errno', None) != errno.ENOENT:
+                logger.warning('Could not read metrics from %s: %s', name, e)
+            return None
+
+    def write(self, name, data):
+        path = self.get_path(name)
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(data, f)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError), e:
+            logger.warning('Could not write metrics to %s: %s', path, e)
+            return False
+        return True
+
+    def remove(self, name):
+        try:
+            os.remove(self.get_path(name))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                logger.warning('Could not remove %s: %s', name, e)
+
+    def flush(self):
+        """Write this process's values out to the shared directory."""
+        self.next_flush = time() + self.flush_interval
+        self.write(self.get_name(), dump_values(self.collect()))
+
+    def add(self, totals, values, alive=True):
+        """Add a process's values into totals, leaving out its gauges if
+        it has exited.
+        """
+        for name, collected in values.items():
+            metric = self.metrics.get(name)
+            if metric is None or (metric.kind == 'gauge' and not alive):
+                continue
+            total = totals.setdefault(name, OrderedDict())
+            for labels, value in collected:
+                labels = tuple(labels)
+                if labels in total:
+                    value = metric.merge(total[labels], value)
+                total[labels] = value
+
+    def get_exited(self, names):
+        """Which of the given workers' files belong to processes that have
+        exited: either their process isn't running, or its id has since
+        been taken by a newer worker.
+        """
+        workers = [(name,) + tuple(map(int, WORKER_FILE.match(name).groups()))
+                   for name in names]
+        latest = {}
+        for name, pid, started in workers:
+            latest[pid] = max(latest.get(pid, 0), started)
+        return [name for name, pid, started in workers
+                if started < latest[pid] or not is_alive(pid)]
+
+    def archive(self, names):
+        """Add the counters and histograms of workers that have exited into
+        the archive, then remove their files. Processes archiving at the
+        same time take turns, and the archive records which files it has
+        taken in, so that none is added twice.
+        """
+        with open(self.get_path(ARCHIVE_LOCK), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            archive = self.read(ARCHIVE_FILE) or {'values': {}, 'merged': []}
+            # Files taken in last time, whose removal was interrupted.
+            for name in archive['merged']:
+                self.remove(name)
+            names = [name for name in names if name not in archive['merged']]
+            totals = {}
+            self.add(totals, load_values(archive['values']), alive=False)
+            merged = []
+            for name in names:
+                values = self.read(name)
+                if values is not None:
+                    self.add(totals, load_values(values), alive=False)
+                    merged.append(name)
+            archive = {
+                'values': dump_values(
+                    dict((name, total.items())
+                         for name, total in totals.items())),
+                'merged': merged,
+            }
+            if self.write(ARCHIVE_FILE, archive):
+                for name in merged:
+                    self.remove(name)
+
+    def get_sources(self):
+        """The values of this process, the archive and every other running
+        process, each paired with whether it's of running processes.
+        Workers found to have exited are archived first.
+        """
+        sources = [(self.collect(), True)]
+        if self.directory is None:
+            return sources
+        own = self.get_name()
+        names = [name for name in os.listdir(self.directory)
+                 if WORKER_FILE.match(name)]
+        if own not in names:
+            names.append(own)
+        exited = [name for name in self.get_exited(names) if name != own]
+        if exited:
+            self.archive(exited)
+        for name in [ARCHIVE_FILE] + names:
+            if name == own or name in exited:
+                continue
+            values = self.read(name)
+            if values is None:
+                continue
+            if name == ARCHIVE_FILE:
+                sources.append((load_values(values['values']), False))
+            else:
+                sources.append((load_values(values), True))
+        return sources
+
+    def aggregate(self):
+        """The values of every metric, summed across processes. The gauges
+        of processes that have exited are left out.
+        """
+        totals = dict((name, OrderedDict()) for name in self.metrics)
+        for values, alive in self.get_sources():
+            self.add(totals, values, alive)
+        return totals
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format."""
+        lines = []
+        totals = self.aggregate()
+        for name, metric in self.metrics.items():
+            lines.append('# HELP %s %s' % (name, metric.help))
+            lines.append('# TYPE %s %s' % (name, metric.kind))
+            for labels, value in sorted(totals[name].items()):
+                for sample, sample_labels, sample_value in \
+                        metric.samples(labels, value):
+                    lines.append('%s%s %r' % (
+                        sample, format_labels(sample_labels),
+                        float(sample_value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry(METRICS_DIR)
+
+if METRICS_DIR is not None:
+    atexit.register(registry.flush)
+
+request_duration = registry.histogram(
+    'photomanager_request_duration_seconds',
+    'Time taken to handle a request, by view.')
+responses = registry.counter(
+    'photomanager_responses_total',
+    'Responses sent, by view and status class.')
+uploads = registry.counter(
+    'photomanager_uploads_total',
+    'Photos uploaded.')
+stored_bytes = registry.counter(
+    'photomanager_stored_bytes_total',
+    'Bytes of uploaded photos stored.')
+rendition_lookups = registry.counter(
+    'photomanager_rendition_lookups_total',
+    'Thumbnails requested.')
+rendition_misses = registry.counter(
+    'photomanager_rendition_misses_total',
+    'Thumbnails requested that had to be generated.')
+decode_queue_depth = registry.gauge(
+    'photomanager_decode_queue_depth',
+    'Background decodes waiting to run.',
+    decoding.queue_depth)
+decode_memory = registry.gauge(
+    'photomanager_decode_memory_bytes',
+    'Memory reserved for decoding images.',
+    lambda: decoding.governor.memory - decoding.governor.available)
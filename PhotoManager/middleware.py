@@ -0,0 +1,139 @@
+import cProfile
+import json
+import logging
+import os
+import random
+import re
+from collections import Counter
+from time import time, strftime
+from django.db import connections
+import metrics
+import profiling
+import routers
+from profiling import PROFILE_SAMPLE_RATE, PROFILE_CPROFILE_RATE, \
+    PROFILE_SLOW_MS, PROFILE_DIR, normalize_sql
+
+
+logger = logging.getLogger('PhotoManager.profiling')
+
+
+class ProfilingMiddleware(object):
+    """Log the wall time, database time and queries, cache hits and
+    misses, and template and thumbnail time of a sample of requests, one
+    JSON object per line. A further sample of requests runs under
+    cProfile, and the stats of those that turn out to be slow are dumped
+    to PHOTOMANAGER_PROFILE_DIR. Requests outside the sample are left
+    alone.
+    """
+    def __init__(self):
+        profiling.instrument_templates()
+
+    def process_request(self, request):
+        if random.random() >= PROFILE_SAMPLE_RATE:
+            return None
+        request._profile = profiling.start_profile()
+        request._profile_queries = []
+        for connection in connections.all():
+            request._profile_queries.append((
+                connection, connection.use_debug_cursor,
+                len(connection.queries)))
+            connection.use_debug_cursor = True
+        request._profiler = None
+        if PROFILE_DIR and random.random() < PROFILE_CPROFILE_RATE:
+            request._profiler = cProfile.Profile()
+            request._profiler.enable()
+        request._profile_start = time()
+        return None
+
+    def process_response(self, request, response):
+        profile = getattr(request, '_profile', None)
+        if profile is None:
+            return response
+        wall_time = time() - request._profile_start
+        if request._profiler is not None:
+            request._profiler.disable()
+        profiling.stop_profile()
+        del request._profile
+
+        queries = []
+        for connection, use_debug_cursor, start in request._profile_queries:
+            queries.extend(connection.queries[start:])
+            connection.use_debug_cursor = use_debug_cursor
+        duplicates = Counter(query['sql'] for query in queries)
+        similar = Counter(normalize_sql(query['sql']) for query in queries)
+
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'wall_ms': round(wall_time * 1000, 1),
+            'db_ms': round(
+                sum(float(query['time']) for query in queries) * 1000, 1),
+            'queries': len(queries),
+            'duplicate_queries': sum(
+                n - 1 for n in duplicates.values() if n > 1),
+            'similar_queries': sum(n - 1 for n in similar.values() if n > 1),
+            'cache_hits': profile.counts['cache_hits'],
+            'cache_misses': profile.counts['cache_misses'],
+            'template_ms': round(profile.timings['template'] * 1000, 1),
+            'thumbnail_ms': round(profile.timings['thumbnail'] * 1000, 1),
+        }
+        slow = record['wall_ms'] > PROFILE_SLOW_MS
+        if slow and request._profiler is not None:
+            record['cprofile'] = self.dump_stats(request, request._profiler)
+        logger.log(
+            logging.WARNING if slow else logging.INFO, json.dumps(record))
+        return response
+
+    def dump_stats(self, request, profiler):
+        """Write a request's cProfile stats to PHOTOMANAGER_PROFILE_DIR,
+        returning the path they were written to.
+        """
+        path = os.path.join(PROFILE_DIR, '%s-%d-%s%s.prof' % (
+            strftime('%Y%m%dT%H%M%S'), os.getpid(), request.method,
+            re.sub(r'[^\w-]+', '_', request.path)))
+        profiler.dump_stats(path)
+        return path
+
+
+class MetricsMiddleware(object):
+    """Record the latency and status of every request, by view."""
+    def process_request(self, request):
+        request._metrics_start = time()
+        return None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._metrics_view = view_func.__name__
+        return None
+
+    def process_response(self, request, response):
+        start = getattr(request, '_metrics_start', None)
+        if start is None:
+            return response
+        view = getattr(request, '_metrics_view', 'none')
+        metrics.request_duration.observe(time() - start, view=view)
+        metrics.responses.inc(
+            view=view, status='%dxx' % (response.status_code // 100))
+        return response
+
+
+class ReplicaMiddleware(object):
+    """Send the reads of GET requests to the read-only views to a replica,
+    unless the user has written within the last few seconds. Any request
+    that might write marks the user with a short-lived cookie, which
+    keeps their reads on the primary until replication has caught up.
+    """
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        routers.use_replica(
+            request.method in ('GET', 'HEAD') and
+            view_func.__name__ in routers.REPLICA_VIEWS and
+            routers.REPLICA_COOKIE not in request.COOKIES)
+        return None
+
+    def process_response(self, request, response):
+        routers.use_replica(False)
+        if request.method not in ('GET', 'HEAD', 'OPTIONS', 'TRACE'):
+            response.set_cookie(
+                routers.REPLICA_COOKIE, '1',
+                max_age=routers.REPLICA_STICKINESS, httponly=True)
+        return response
@@ -1,7 +1,15 @@
+import json
+import threading
+from contextlib import contextmanager
 from django.db import models
+from django.core.files.storage import default_storage
+from django.db.models.signals import m2m_changed, pre_delete, post_delete, \
+    pre_save, post_save
+from django.core.signals import request_started, request_finished
 from sorl.thumbnail import ImageField
 from django.contrib.auth.models import User, Group
 from registration.signals import user_activated
+from uploads import upload_storage
 from django.dispatch import receiver
 
 
@@ -17,28 +25,57 @@ class Tag(models.Model):
 
 
 def set_upload_to(instance, filename):
-    """Determine the folder where an image will be uploaded. Images go
-    into folders that are named for their author's primary key id. This
-    gives each user a folder while avoiding the problem of usernames that
-    contain characters that can't go in file/folder names.
+    """Determine the name an image will be uploaded under. By default,
+    images go into folders that are named for their author's primary key
+    id. This gives each user a folder while avoiding the problem of
+    usernames that contain characters that can't go in file/folder names.
+    PHOTOMANAGER_UPLOAD_LAYOUT can instead shard them by the hash of their
+    contents or by date; see uploads.get_upload_name.
     """
-    return '%d/%s' % (instance.author.pk, filename)
+    from uploads import get_upload_name
+    return get_upload_name(instance, filename)
 
 
 class Photo(models.Model):
     """An individual photograph. This photo may exist in many albums and
     have many tags.
     """
-    image = ImageField(upload_to=set_upload_to)
+    image = ImageField(upload_to=set_upload_to, storage=upload_storage)
+    placeholder = models.TextField(blank=True, default='', editable=False)
+    deep_zoom = models.CharField(
+        max_length=255, blank=True, default='', editable=False)
+    image_size = models.BigIntegerField(null=True, editable=False)
+    image_crc32 = models.BigIntegerField(null=True, editable=False)
     description = models.TextField(blank=True)
     author = models.ForeignKey(User)
     tags = models.ManyToManyField(Tag, blank=True, null=True)
     date_created = models.DateTimeField(auto_now_add=True)
     date_modified = models.DateTimeField(auto_now=True)
 
+    class Meta(object):
+        index_together = [['author', 'date_created']]
+
     def __unicode__(self):
         return self.image.name
 
+    @property
+    def deep_zoom_url(self):
+        return default_storage.url(self.deep_zoom)
+
+
+# How far apart the positions of photos added to an album are, leaving
+# room to move photos between them without renumbering their neighbours.
+POSITION_GAP = 1 << 16
+
+# The most ids put in one IN clause, which keeps queries on many photos
+# within SQLite's limit on parameters.
+IN_CHUNK_SIZE = 500
+
+
+def get_chunks(items, size=IN_CHUNK_SIZE):
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
 
 class Album(models.Model):
     """A photo album. Albums may contain many photos, and these photos django
@@ -46,14 +83,312 @@ class Album(models.Model):
     """
     title = models.CharField(max_length=64)
     description = models.TextField(blank=True)
-    photos = models.ManyToManyField(Photo, blank=True, null=True)
+    photos = models.ManyToManyField(
+        Photo, blank=True, null=True, through='AlbumPhoto')
     author = models.ForeignKey(User)
+    share_token = models.CharField(
+        max_length=32, null=True, blank=True, unique=True, editable=False)
     date_created = models.DateTimeField(auto_now_add=True)
     date_modified = models.DateTimeField(auto_now=True)
 
+    class Meta(object):
+        index_together = [['author', 'date_created']]
+
     def __unicode__(self):
         return self.title
 
+    def get_photos(self):
+        """The album's photos, in order."""
+        return Photo.objects.filter(albumphoto__album=self).\
+            order_by('albumphoto__position', 'pk')
+
+    def send_photos_changed(self, action, pk_set):
+        """Tell m2m_changed receivers about a change to the album's
+        photos, as Django does for memberships it manages itself.
+        """
+        m2m_changed.send(
+            sender=AlbumPhoto, instance=self, action=action, reverse=False,
+            model=Photo, pk_set=pk_set, using=self._state.db)
+
+    def add_photos(self, *photos):
+        """Add photos, or their ids, to the end of the album. Photos
+        already in it stay where they are.
+        """
+        memberships = AlbumPhoto.objects.filter(album=self)
+        pks = [getattr(photo, 'pk', photo) for photo in photos]
+        existing = set()
+        for chunk in get_chunks(pks):
+            existing.update(memberships.filter(photo__in=chunk).
+                            values_list('photo_id', flat=True))
+        new = []
+        for pk in pks:
+            if pk not in existing:
+                existing.add(pk)
+                new.append(pk)
+        if not new:
+            return
+        self.send_photos_changed('pre_add', set(new))
+        last = memberships.aggregate(
+            last=models.Max('position'))['last'] or 0
+        AlbumPhoto.objects.bulk_create([
+            AlbumPhoto(album=self, photo_id=pk,
+                       position=last + (i + 1) * POSITION_GAP)
+            for i, pk in enumerate(new)])
+        self.send_photos_changed('post_add', set(new))
+
+    def remove_photos(self, *photos):
+        """Take photos, or their ids, out of the album."""
+        pks = set(getattr(photo, 'pk', photo) for photo in photos)
+        self.send_photos_changed('pre_remove', pks)
+        for chunk in get_chunks(pks):
+            AlbumPhoto.objects.filter(album=self, photo__in=chunk).delete()
+        self.send_photos_changed('post_remove', pks)
+
+    def clear_photos(self):
+        self.send_photos_changed('pre_clear', None)
+        AlbumPhoto.objects.filter(album=self).delete()
+        self.send_photos_changed('post_clear', None)
+
+    def set_photos(self, photos):
+        """Make the album hold exactly the given photos, keeping the order
+        of those it already has and adding the rest to the end. Its
+        contact sheets are redrawn once, after both changes.
+        """
+        from contactsheets import deferring_updates
+        pks = [getattr(photo, 'pk', photo) for photo in photos]
+        removed = set(self.photos.values_list('pk', flat=True)) - set(pks)
+        with deferring_updates():
+            if removed:
+                self.remove_photos(*removed)
+            self.add_photos(*pks)
+
+
+class AlbumPhoto(models.Model):
+    """A photo's place in an album. Photos are ordered by position, which
+    is sparse, so that a photo can be moved by changing its own position
+    alone.
+    """
+    album = models.ForeignKey(Album)
+    photo = models.ForeignKey(Photo)
+    position = models.BigIntegerField(default=0)
+
+    class Meta(object):
+        db_table = 'PhotoManager_album_photos'
+        unique_together = ('album', 'photo')
+        index_together = [['album', 'position']]
+
+    def __unicode__(self):
+        return u'%s in %s at %d' % (
+            self.photo_id, self.album_id, self.position)
+
+
+class Usage(models.Model):
+    """How much a user has stored, kept as running totals that change as
+    their photos come and go, so that quotas can be checked without adding
+    up their photos. A user's limits, when set, replace the default ones.
+    """
+    user = models.OneToOneField(
+        User, primary_key=True, related_name='usage')
+    bytes = models.BigIntegerField(default=0)
+    photos = models.IntegerField(default=0)
+    max_bytes = models.BigIntegerField(null=True, blank=True)
+    max_photos = models.IntegerField(null=True, blank=True)
+
+    def __unicode__(self):
+        return u'%s: %d bytes in %d photos' % (
+            self.user_id, self.bytes, self.photos)
+
+
+class ContactSheet(models.Model):
+    """A single image holding the thumbnails of one page of an album's
+    photos, so that an album grid can be drawn from a couple of images
+    rather than one per photo. The layout records where each photo's
+    thumbnail sits within the sheet.
+    """
+    album = models.ForeignKey(Album, related_name='contact_sheets')
+    page = models.PositiveIntegerField()
+    image = models.FileField(upload_to='sheets', max_length=255)
+    layout = models.TextField()
+    date_modified = models.DateTimeField(auto_now=True)
+
+    class Meta(object):
+        ordering = ['page']
+        unique_together = ('album', 'page')
+
+    def __unicode__(self):
+        return self.image.name
+
+    @property
+    def tiles(self):
+        return json.loads(self.layout)
+
+    @property
+    def photo_ids(self):
+        return [tile['photo'] for tile in self.tiles]
+
+
+@receiver(m2m_changed, sender=Album.photos.through)
+def update_album_contact_sheets(sender, **kwargs):
+    """Redraw the contact sheets of albums whose photos have changed."""
+    from contactsheets import CONTACT_SHEETS, update_contact_sheets
+    if CONTACT_SHEETS and \
+            kwargs['action'] in ('post_add', 'post_remove', 'post_clear'):
+        update_contact_sheets(kwargs['instance'])
+
+
+_bulk_deletes = threading.local()
+
+
+@contextmanager
+def deleting_in_bulk(pks):
+    """Within the block, the delete receivers below leave the photos with
+    the given pks alone, for callers that delete many photos at once and
+    have already seen to their albums, share tokens and usage in bulk.
+    """
+    _bulk_deletes.pks = set(pks)
+    try:
+        yield
+    finally:
+        _bulk_deletes.pks = set()
+
+
+def is_deleted_in_bulk(photo):
+    return photo.pk in getattr(_bulk_deletes, 'pks', ())
+
+
+@receiver(pre_delete, sender=Photo)
+def remember_photo_albums(sender, **kwargs):
+    """Note which albums a photo is in before deleting it, since its
+    album memberships are gone by the time it's been deleted.
+    """
+    from contactsheets import CONTACT_SHEETS
+    if CONTACT_SHEETS and not is_deleted_in_bulk(kwargs['instance']):
+        photo = kwargs['instance']
+        photo._album_ids = list(photo.album_set.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Photo)
+def update_photo_contact_sheets(sender, **kwargs):
+    """Redraw the contact sheets of albums that a deleted photo was in."""
+    from contactsheets import CONTACT_SHEETS, update_contact_sheets
+    if CONTACT_SHEETS and not is_deleted_in_bulk(kwargs['instance']):
+        album_ids = getattr(kwargs['instance'], '_album_ids', [])
+        for album in Album.objects.filter(pk__in=album_ids):
+            update_contact_sheets(album)
+
+
+def get_share_tokens(albums):
+    return list(albums.exclude(share_token=None).
+                values_list('share_token', flat=True))
+
+
+@receiver(pre_save, sender=Album)
+def remember_album_share_token(sender, **kwargs):
+    """Note the token an album was shared under before saving it, so that
+    the pages shared under a revoked token can be purged.
+    """
+    from sharing import SHARE_PURGE_URLS
+    album = kwargs['instance']
+    if SHARE_PURGE_URLS and album.pk and not kwargs['raw']:
+        album._share_tokens = get_share_tokens(
+            Album.objects.filter(pk=album.pk))
+
+
+@receiver(post_save, sender=Album)
+@receiver(post_delete, sender=Album)
+def purge_shared_album(sender, **kwargs):
+    """Purge the cached pages of a shared album that has changed."""
+    from sharing import SHARE_PURGE_URLS, purge
+    album = kwargs['instance']
+    if SHARE_PURGE_URLS and not kwargs.get('raw'):
+        tokens = set(getattr(album, '_share_tokens', []))
+        if album.share_token:
+            tokens.add(album.share_token)
+        purge(tokens)
+
+
+@receiver(m2m_changed, sender=Album.photos.through)
+def purge_shared_album_photos(sender, **kwargs):
+    """Purge the cached pages of shared albums whose photos have changed."""
+    from sharing import SHARE_PURGE_URLS, purge
+    album = kwargs['instance']
+    if SHARE_PURGE_URLS and album.share_token and \
+            kwargs['action'] in ('post_add', 'post_remove', 'post_clear'):
+        purge([album.share_token])
+
+
+@receiver(pre_delete, sender=Photo)
+def remember_photo_share_tokens(sender, **kwargs):
+    from sharing import SHARE_PURGE_URLS
+    photo = kwargs['instance']
+    if SHARE_PURGE_URLS and not is_deleted_in_bulk(photo):
+        photo._share_tokens = get_share_tokens(photo.album_set)
+
+
+@receiver(post_save, sender=Photo)
+@receiver(post_delete, sender=Photo)
+def purge_shared_photo(sender, **kwargs):
+    """Purge the cached pages of shared albums holding a changed photo."""
+    from sharing import SHARE_PURGE_URLS, purge
+    photo = kwargs['instance']
+    if SHARE_PURGE_URLS and not kwargs.get('raw') and \
+            not is_deleted_in_bulk(photo):
+        tokens = getattr(photo, '_share_tokens', None)
+        if tokens is None:
+            tokens = get_share_tokens(photo.album_set)
+        purge(tokens)
+
+
+@receiver(post_save, sender=Photo)
+def count_photo_usage(sender, **kwargs):
+    """Add a new photo to its author's storage usage, unless its upload
+    already reserved room for it.
+    """
+    from quotas import get_photo_size, update_usage
+    photo = kwargs['instance']
+    if kwargs['created'] and not kwargs['raw'] and \
+            not getattr(photo, '_usage_counted', False):
+        update_usage(photo.author_id, get_photo_size(photo), 1)
+
+
+@receiver(post_delete, sender=Photo)
+def uncount_photo_usage(sender, **kwargs):
+    """Take a deleted photo off its author's storage usage."""
+    from quotas import get_photo_size, update_usage
+    photo = kwargs['instance']
+    if not is_deleted_in_bulk(photo):
+        update_usage(photo.author_id, -get_photo_size(photo), -1)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+@receiver(m2m_changed, sender=Group.permissions.through)
+def clear_cached_permissions(sender, **kwargs):
+    """Forget the cached permissions of users whose groups, or whose or
+    whose groups' permissions, have changed.
+    """
+    from auth import clear_permissions, get_changed_user_ids
+    if kwargs['action'] in ('post_add', 'post_remove', 'pre_clear'):
+        clear_permissions(get_changed_user_ids(sender, **kwargs))
+
+
+@receiver(post_save, sender=User)
+def clear_new_user_permissions(sender, **kwargs):
+    """Make sure a new user never inherits the cached permissions of a
+    deleted user whose id has been reused.
+    """
+    if kwargs['created']:
+        from auth import clear_permissions
+        clear_permissions([kwargs['instance'].pk])
+
+
+@receiver(pre_delete, sender=Group)
+def clear_group_permissions(sender, **kwargs):
+    """Forget the cached permissions of the members of a deleted group."""
+    from auth import clear_permissions
+    clear_permissions(
+        kwargs['instance'].user_set.values_list('pk', flat=True))
+
 
 @receiver(user_activated)
 def add_new_user_to_member_group(sender, **kwargs):
@@ -61,3 +396,16 @@ def add_new_user_to_member_group(sender, **kwargs):
     group = Group.objects.get(name='Members')
     user.groups.add(group)
     user.save()
+
+
+@receiver(request_started)
+def check_database_connections(sender, **kwargs):
+    """Replace persistent connections that went bad while idle."""
+    from dbhealth import check_connections
+    check_connections()
+
+
+@receiver(request_finished)
+def mark_database_connections(sender, **kwargs):
+    from dbhealth import mark_connections_used
+    mark_connections_used()
@@ -0,0 +1,58 @@
+from django.db import transaction
+from models import Album, AlbumPhoto, POSITION_GAP
+
+
+def get_spacing(lower, upper, count):
+    """How far apart count positions between lower and upper can be, or
+    POSITION_GAP if nothing bounds them from above.
+    """
+    if upper is None:
+        return POSITION_GAP
+    return (upper - lower) // (count + 1)
+
+
+def move_photo(album, photo, after=None):
+    """Move a photo of an album to just after another of its photos, or to
+    the front if after is None. The photo is given a position halfway
+    between its new neighbours', so usually its row is the only one
+    written. When its neighbours are too close together for that, only as
+    many of the photos after it as it takes to find room are spread out
+    again. Returns how many rows were written. Raises
+    AlbumPhoto.DoesNotExist if either photo isn't in the album.
+    """
+    photo, after = getattr(photo, 'pk', photo), getattr(after, 'pk', after)
+    if photo == after:
+        return 0
+    with transaction.atomic():
+        # Moves within one album are made one at a time.
+        list(Album.objects.select_for_update().filter(pk=album.pk).
+             values_list('pk'))
+        memberships = AlbumPhoto.objects.filter(album=album)
+        moving = memberships.get(photo=photo)
+        others = memberships.exclude(pk=moving.pk).\
+            order_by('position', 'photo').values_list('pk', 'position')
+        if after is None:
+            first = list(others[:1])
+            if not first:
+                return 0
+            moving.position = first[0][1] - POSITION_GAP
+            moving.save(update_fields=['position'])
+            return 1
+
+        lower = memberships.get(photo=after).position
+        following = others.filter(position__gt=lower)
+        size = 0
+        while True:
+            rows = list(following[:size + 1])
+            upper = rows.pop()[1] if len(rows) > size else None
+            spacing = get_spacing(lower, upper, len(rows) + 1)
+            if spacing > 1:
+                break
+            size = max(size * 2, 1)
+
+        moving.position = lower + spacing
+        moving.save(update_fields=['position'])
+        for i, (pk, position) in enumerate(rows):
+            AlbumPhoto.objects.filter(pk=pk).update(
+                position=lower + spacing * (i + 2))
+        return len(rows) + 1
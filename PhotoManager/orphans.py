@@ -0,0 +1,139 @@
+import hashlib
+import json
+import posixpath
+from datetime import datetime
+from django.core.files.storage import default_storage
+from sorl.thumbnail.conf import settings as thumbnail_settings
+from sorl.thumbnail.images import ImageFile
+from sorl.thumbnail.models import KVStore
+from models import Photo, ContactSheet
+from uploads import UPLOAD_DIRECTORY
+
+
+def get_digest(name):
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return hashlib.md5(name).digest()[:8]
+
+
+class References(object):
+    """The names in storage that something still refers to. Names are
+    kept as 8 byte digests rather than whole, so that the references of a
+    large library fit in memory. A collision can only keep an orphan
+    around, never delete a file that's in use.
+    """
+    def __init__(self):
+        self.names = set()
+        self.directories = set()
+
+    def add(self, name):
+        self.names.add(get_digest(name))
+
+    def add_directory(self, name):
+        """Refer to everything under a directory."""
+        self.directories.add(get_digest(name))
+
+    def __contains__(self, name):
+        return get_digest(name) in self.names
+
+    def covers(self, directory):
+        return get_digest(directory) in self.directories
+
+
+def get_kv_prefix(identity):
+    return '||'.join([thumbnail_settings.THUMBNAIL_KEY_PREFIX, identity, ''])
+
+
+def find_references(storage=default_storage):
+    """The files that the database refers to: photos' originals and deep
+    zoom pyramids, contact sheets, and the thumbnails that sorl-thumbnail
+    has recorded for the originals. Also returns the keys of the
+    thumbnail key-value store's entries for images that are gone.
+    """
+    references = References()
+    source_keys = set()
+    photos = Photo.objects.values_list('image', 'deep_zoom').order_by()
+    for name, deep_zoom in photos.iterator():
+        references.add(name)
+        source_keys.add(ImageFile(name, storage).key)
+        if deep_zoom:
+            references.add(deep_zoom)
+            references.add_directory(
+                posixpath.splitext(deep_zoom)[0] + '_files')
+    sheets = ContactSheet.objects.values_list('image', flat=True).order_by()
+    for name in sheets.iterator():
+        references.add(name)
+
+    stale_keys = []
+    thumbnail_keys = set()
+    prefix = get_kv_prefix('thumbnails')
+    rows = KVStore.objects.filter(key__startswith=prefix).\
+        values_list('key', 'value').order_by()
+    for key, value in rows.iterator():
+        if key[len(prefix):] in source_keys:
+            thumbnail_keys.update(json.loads(value))
+        else:
+            stale_keys.append(key)
+    prefix = get_kv_prefix('image')
+    rows = KVStore.objects.filter(key__startswith=prefix).\
+        values_list('key', 'value').order_by()
+    for key, value in rows.iterator():
+        key_name = key[len(prefix):]
+        if key_name in thumbnail_keys:
+            references.add(json.loads(value)['name'])
+        elif key_name not in source_keys:
+            stale_keys.append(key)
+    return references, stale_keys
+
+
+def get_media_directories(storage=default_storage):
+    """The top-level directories of storage that the app writes to: one
+    per author and one of sharded uploads for originals, and those of
+    thumbnails, contact sheets and deep zoom pyramids. Anything else in
+    storage is left alone.
+    """
+    known = (UPLOAD_DIRECTORY, thumbnail_settings.THUMBNAIL_PREFIX.strip('/'),
+             'sheets', 'deepzoom')
+    return sorted(
+        directory for directory in storage.listdir('')[0]
+        if directory.isdigit() or directory in known)
+
+
+def walk(storage, directory, references):
+    """Yield the names of the files under a directory that nothing refers
+    to, one directory listing at a time. Directories whose whole contents
+    are referred to aren't listed at all.
+    """
+    directories, files = storage.listdir(directory)
+    for filename in sorted(files):
+        name = posixpath.join(directory, filename)
+        if name not in references:
+            yield name
+    for subdirectory in sorted(directories):
+        name = posixpath.join(directory, subdirectory)
+        if not references.covers(name):
+            for orphan in walk(storage, name, references):
+                yield orphan
+
+
+def find_orphans(references, storage=default_storage, min_age=None):
+    """Yield the names of the app's files in storage that nothing refers
+    to. Files younger than min_age are skipped, since they may belong to
+    an upload that hasn't been recorded in the database yet.
+    """
+    cutoff = None if min_age is None else datetime.now() - min_age
+    for directory in get_media_directories(storage):
+        for name in walk(storage, directory, references):
+            if cutoff is None or storage.modified_time(name) < cutoff:
+                yield name
+
+
+def get_batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
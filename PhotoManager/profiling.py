@@ -0,0 +1,107 @@
+import re
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from time import time
+from django.conf import settings
+
+
+# The fraction of requests that ProfilingMiddleware records and logs.
+PROFILE_SAMPLE_RATE = getattr(settings, 'PHOTOMANAGER_PROFILE_SAMPLE_RATE', 1.0)
+
+# The fraction of requests that are also run under cProfile. Their stats
+# are only kept when the request turns out to be slow.
+PROFILE_CPROFILE_RATE = getattr(
+    settings, 'PHOTOMANAGER_PROFILE_CPROFILE_RATE', 0.0)
+
+# Requests slower than this many milliseconds are logged as warnings, and
+# have their cProfile stats dumped.
+PROFILE_SLOW_MS = getattr(settings, 'PHOTOMANAGER_PROFILE_SLOW_MS', 1000)
+
+# Where the cProfile stats of slow requests are dumped.
+PROFILE_DIR = getattr(settings, 'PHOTOMANAGER_PROFILE_DIR', None)
+
+
+_local = threading.local()
+
+
+def normalize_sql(sql):
+    """Replace the literals in a query with placeholders, so that queries
+    that differ only in their parameters compare equal.
+    """
+    # Some backends can't interpolate parameters, and log them separately.
+    match = re.match(r"QUERY = u?'(.*)' - PARAMS = ", sql, re.DOTALL)
+    if match:
+        sql = match.group(1)
+    sql = re.sub(r"'[^']*'|%s|\b\d+\b", '?', sql)
+    return re.sub(r'\?(, \?)+', '?, ...', sql)
+
+
+class RequestProfile(object):
+    """The time spent, and the events counted, in each part of the code
+    while handling one request.
+    """
+    def __init__(self):
+        self.timings = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.depths = defaultdict(int)
+
+
+def get_profile():
+    """The profile of the request being handled by this thread, if it's
+    being profiled.
+    """
+    return getattr(_local, 'profile', None)
+
+
+def start_profile():
+    _local.profile = RequestProfile()
+    return _local.profile
+
+
+def stop_profile():
+    profile = get_profile()
+    _local.profile = None
+    return profile
+
+
+@contextmanager
+def timed(name):
+    """Add the time spent in the block to the current profile. Nested
+    blocks of the same name are only counted once.
+    """
+    profile = get_profile()
+    if profile is None:
+        yield
+        return
+    profile.depths[name] += 1
+    start = time()
+    try:
+        yield
+    finally:
+        profile.depths[name] -= 1
+        if not profile.depths[name]:
+            profile.timings[name] += time() - start
+
+
+def count(name, n=1):
+    """Add to one of the current profile's counters."""
+    profile = get_profile()
+    if profile is not None:
+        profile.counts[name] += n
+
+
+def instrument_templates():
+    """Time template rendering. Django doesn't signal renders outside of
+    tests, so Template.render is wrapped, once per process.
+    """
+    from django.template.base import Template
+    if getattr(Template.render, 'instrumented', False):
+        return
+    render = Template.render
+
+    def instrumented_render(self, context):
+        with timed('template'):
+            return render(self, context)
+    instrumented_render.instrumented = True
+    Template.render = instrumented_render
@@ -0,0 +1,134 @@
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.template.defaultfilters import filesizeformat
+from models import Photo, Usage
+
+
+# How many bytes, and how many photos, each user may store. None means no
+# limit. A user's own limits, set on their Usage, take precedence.
+QUOTA_BYTES = getattr(settings, 'PHOTOMANAGER_QUOTA_BYTES', None)
+QUOTA_PHOTOS = getattr(settings, 'PHOTOMANAGER_QUOTA_PHOTOS', None)
+
+# How much of an upload request may be multipart framing and other form
+# fields rather than the photo. Uploads are only refused by their declared
+# length when it's more than this over the room left; the photo itself is
+# checked by its exact size once it has arrived.
+UPLOAD_OVERHEAD = getattr(settings, 'PHOTOMANAGER_UPLOAD_OVERHEAD', 16 * 1024)
+
+
+class QuotaExceeded(Exception):
+    """An upload would take a user past one of their limits."""
+
+
+def get_photo_size(photo):
+    """The size of a photo's original: as recorded if it has been, or else
+    as storage has it. A missing file counts for nothing.
+    """
+    if photo.image_size is not None:
+        return photo.image_size
+    try:
+        return photo.image.size
+    except (OSError, IOError, ValueError):
+        return 0
+
+
+def format_size(size):
+    """A size for people to read, with an ordinary space in it."""
+    return filesizeformat(size).replace(u'\xa0', u' ')
+
+
+def get_usage(user_id):
+    """A user's usage, created at nothing used if they don't have one."""
+    try:
+        with transaction.atomic():
+            return Usage.objects.get_or_create(user_id=user_id)[0]
+    except IntegrityError:
+        # Another request created it first.
+        return Usage.objects.get(user_id=user_id)
+
+
+def get_limits(usage):
+    """The byte and photo limits that apply to a user's usage."""
+    return (QUOTA_BYTES if usage.max_bytes is None else usage.max_bytes,
+            QUOTA_PHOTOS if usage.max_photos is None else usage.max_photos)
+
+
+def update_usage(user_id, size, photos):
+    """Add to, or with negative numbers take from, a user's running
+    totals in a single UPDATE, so that concurrent uploads and deletes
+    never overwrite each other's changes.
+    """
+    changes = {'bytes': F('bytes') + size, 'photos': F('photos') + photos}
+    if not Usage.objects.filter(user_id=user_id).update(**changes) and \
+            photos > 0:
+        get_usage(user_id)
+        Usage.objects.filter(user_id=user_id).update(**changes)
+
+
+def check_quota(user_id, size):
+    """Raise QuotaExceeded if another photo of a size would take a user
+    past their limits, without reserving any room for it.
+    """
+    usage = get_usage(user_id)
+    max_bytes, max_photos = get_limits(usage)
+    if max_photos is not None and usage.photos + 1 > max_photos:
+        raise QuotaExceeded(
+            'You may store at most %d photos.' % max_photos)
+    if max_bytes is not None and usage.bytes + size > max_bytes:
+        raise QuotaExceeded(
+            'You may store at most %s of photos, and have %s left.' % (
+                format_size(max_bytes),
+                format_size(max(max_bytes - usage.bytes, 0))))
+
+
+def reserve(user_id, size):
+    """Count a photo of a size against a user's usage, if they have room
+    for it. The check and the increment are one conditional UPDATE, so
+    concurrent uploads can't both take the last of the room. Raises
+    QuotaExceeded otherwise.
+    """
+    usage = get_usage(user_id)
+    max_bytes, max_photos = get_limits(usage)
+    usages = Usage.objects.filter(user_id=user_id)
+    if max_bytes is not None:
+        usages = usages.filter(bytes__lte=max_bytes - size)
+    if max_photos is not None:
+        usages = usages.filter(photos__lte=max_photos - 1)
+    if not usages.update(bytes=F('bytes') + size, photos=F('photos') + 1):
+        check_quota(user_id, size)
+        # The room went between the two queries.
+        raise QuotaExceeded('You have no room left for this photo.')
+
+
+def reconcile():
+    """Recount every user's usage from their photos, recording the sizes
+    of photos whose sizes weren't recorded. Returns the usages that had
+    drifted, as they were before being corrected.
+    """
+    for photo in Photo.objects.filter(image_size=None).only('image'):
+        try:
+            size = photo.image.size
+        except (OSError, IOError):
+            continue
+        Photo.objects.filter(pk=photo.pk).update(image_size=size)
+
+    totals = dict(
+        (row['author'], (row['bytes'] or 0, row['photos']))
+        for row in Photo.objects.order_by().values('author').annotate(
+            bytes=Sum('image_size'), photos=Count('pk')))
+    drifted = []
+    for usage in Usage.objects.all():
+        if (usage.bytes, usage.photos) != totals.pop(usage.pk, (0, 0)):
+            drifted.append(usage)
+    for user_id in totals:
+        drifted.append(Usage(user_id=user_id))
+    for usage in drifted:
+        # Counted again, for as short a window as possible in which an
+        # upload could be missed.
+        total = Photo.objects.filter(author_id=usage.pk).aggregate(
+            bytes=Sum('image_size'), photos=Count('pk'))
+        get_usage(usage.pk)
+        Usage.objects.filter(user_id=usage.pk).update(
+            bytes=total['bytes'] or 0, photos=total['photos'])
+    return drifted
@@ -0,0 +1,154 @@
+from base64 import b64encode
+from django.conf import settings
+from sorl.thumbnail import default
+from sorl.thumbnail.conf import settings as thumbnail_settings, \
+    defaults as thumbnail_defaults
+from sorl.thumbnail.images import ImageFile
+from sorl.thumbnail.parsers import parse_geometry
+from decoding import governor
+from engines import get_draft_scale
+
+
+# The thumbnail geometries that the templates ask sorl-thumbnail for.
+RENDITION_SIZES = getattr(
+    settings, 'PHOTOMANAGER_RENDITION_SIZES', ('100x100',))
+
+# The size of the tiny image shown in place of a thumbnail until it loads.
+PLACEHOLDER_SIZE = getattr(settings, 'PHOTOMANAGER_PLACEHOLDER_SIZE', 8)
+
+
+def get_rendition_options(**options):
+    """Fill in thumbnail options the same way sorl-thumbnail's backend
+    does, so that renditions land under the names that the thumbnail
+    template tag will look for.
+    """
+    backend = default.backend
+    for key, value in backend.default_options.iteritems():
+        options.setdefault(key, value)
+    for key, attr in backend.extra_options:
+        value = getattr(thumbnail_settings, attr)
+        if value != getattr(thumbnail_defaults, attr):
+            options.setdefault(key, value)
+    return options
+
+
+def get_scale_factor(size, geometry, options):
+    """The factor by which an image of the given size is scaled to fit
+    geometry.
+    """
+    factors = (float(geometry[0]) / size[0], float(geometry[1]) / size[1])
+    return max(factors) if options['crop'] else min(factors)
+
+
+def get_decode_scale(size, sizes=RENDITION_SIZES, **options):
+    """The scale at which a JPEG of the given size is decoded to generate
+    its renditions, whichever way up it is.
+    """
+    if not hasattr(default.engine, 'draft'):
+        return 1
+    options = get_rendition_options(**options)
+    ratio = float(size[0]) / size[1]
+    scales = []
+    for geometry_string in sizes:
+        geometry = parse_geometry(geometry_string, ratio)
+        scales.append(get_draft_scale(size, geometry, options['crop']))
+        scales.append(get_draft_scale(size, geometry[::-1], options['crop']))
+    return min(scales) if scales else 1
+
+
+def create_renditions(image, geometries, options, engine=default.engine):
+    """Scale an image that hasn't been loaded yet to each of the given
+    geometries. The image is decoded once, at the smallest scale that
+    covers the largest geometry, its EXIF orientation is applied once, and
+    each rendition is then scaled down from the one before it, largest
+    first. Returns (geometry, rendition) pairs in that order. The decode's
+    memory is given back before returning, so it isn't held while the
+    renditions are written out.
+    """
+    size = engine.get_image_size(image)
+    geometries = sorted(
+        geometries,
+        key=lambda geometry: get_scale_factor(size, geometry, options),
+        reverse=True)
+    if not geometries:
+        return []
+
+    scale = 1
+    if hasattr(engine, 'draft'):
+        scale = engine.draft(image, geometries[0], options)
+    renditions = []
+    with governor.decoding(size, scale):
+        image = engine.orientation(image, None, options)
+        image = engine.colorspace(image, None, options)
+        for geometry in geometries:
+            image = engine.scale(image, geometry, options)
+            renditions.append(
+                (geometry, engine.crop(image, geometry, options)))
+    return renditions
+
+
+def generate_renditions(image_field, sizes=RENDITION_SIZES, **options):
+    """Generate every missing rendition of an image from a single decode,
+    and register them with sorl-thumbnail's key-value store so that the
+    thumbnail template tag finds them without touching the original.
+    Renditions already in storage are registered rather than written
+    again. Returns the list of thumbnails that were created.
+    """
+    engine = default.engine
+    backend = default.backend
+    options = get_rendition_options(**options)
+    source = ImageFile(image_field)
+
+    missing = {}
+    for geometry_string in sizes:
+        thumbnail = ImageFile(
+            backend._get_thumbnail_filename(source, geometry_string, options),
+            default.storage)
+        if default.kvstore.get(thumbnail):
+            continue
+        if thumbnail.exists():
+            # Written before, but since dropped from the key-value store.
+            # Writing it again would have storage save it under another
+            # name, so it's registered as it is, as sorl-thumbnail does.
+            default.kvstore.get_or_set(source)
+            default.kvstore.set(thumbnail, source)
+        else:
+            missing[geometry_string] = thumbnail
+    if not missing:
+        return []
+
+    image = engine.get_image(source)
+    source.set_size(engine.get_image_size(image))
+    default.kvstore.get_or_set(source)
+    ratio = engine.get_image_ratio(image)
+    thumbnails = {}
+    for geometry_string, thumbnail in missing.iteritems():
+        geometry = parse_geometry(geometry_string, ratio)
+        thumbnails.setdefault(geometry, []).append(thumbnail)
+
+    renditions = create_renditions(image, thumbnails.keys(), options, engine)
+    # Let the full decode go before the renditions are written out.
+    del image
+    created = []
+    for geometry, rendition in renditions:
+        for thumbnail in thumbnails[geometry]:
+            engine.write(rendition, options, thumbnail)
+            thumbnail.set_size(engine.get_image_size(rendition))
+            default.kvstore.set(thumbnail, source)
+            created.append(thumbnail)
+    return created
+
+
+def generate_placeholder(image_field):
+    """Return a tiny version of an image as a data URI of a couple of
+    hundred bytes, which can be inlined into a page and stretched to
+    stand in for the image's thumbnail until it loads.
+    """
+    engine = default.engine
+    options = get_rendition_options()
+    image = engine.get_image(ImageFile(image_field))
+    geometry = (PLACEHOLDER_SIZE, PLACEHOLDER_SIZE)
+    for geometry, placeholder in create_renditions(
+            image, [geometry], options, engine):
+        data = engine._get_raw_data(placeholder, 'PNG', options['quality'])
+        return 'data:image/png;base64,' + b64encode(data)
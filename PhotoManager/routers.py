@@ -0,0 +1,56 @@
+import random
+import threading
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+
+# The database aliases of the read replicas. With none, everything goes to
+# the default database.
+REPLICA_DATABASES = tuple(
+    getattr(settings, 'PHOTOMANAGER_REPLICA_DATABASES', ()))
+
+# The views whose GET requests may read from a replica.
+REPLICA_VIEWS = getattr(settings, 'PHOTOMANAGER_REPLICA_VIEWS', (
+    'home_view', 'album_view', 'photo_view', 'tag_view'))
+
+# For how many seconds after a user writes to the database their reads stay
+# on the primary, so that they see their own writes despite replication lag.
+REPLICA_STICKINESS = getattr(settings, 'PHOTOMANAGER_REPLICA_STICKINESS', 5)
+
+# The cookie that marks a user as recently having written.
+REPLICA_COOKIE = 'pm_primary'
+
+
+_local = threading.local()
+
+
+def use_replica(replica):
+    """Send this thread's reads to a replica, or back to the primary."""
+    _local.replica = replica
+
+
+class ReplicaRouter(object):
+    """Routes reads to a randomly chosen replica while use_replica is on
+    for the current thread, which ReplicaMiddleware turns on for the
+    read-only views. All writes go to the primary.
+    """
+    def __init__(self, replicas=REPLICA_DATABASES):
+        self.replicas = replicas
+
+    def db_for_read(self, model, **hints):
+        if not self.replicas:
+            return None
+        if getattr(_local, 'replica', False):
+            return random.choice(self.replicas)
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        if not self.replicas:
+            return None
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = (DEFAULT_DB_ALIAS,) + self.replicas
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
@@ -0,0 +1,98 @@
+import logging
+import socket
+import threading
+import urllib2
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.utils.cache import patch_cache_control
+from django.utils.crypto import get_random_string
+
+
+logger = logging.getLogger(__name__)
+
+# How long, in seconds, browsers, and shared caches like nginx or a CDN,
+# may keep a shared album's pages. Shared caches are purged whenever the
+# album changes, so they can keep pages for much longer.
+SHARE_MAX_AGE = getattr(settings, 'PHOTOMANAGER_SHARE_MAX_AGE', 60)
+SHARE_CACHE_MAX_AGE = getattr(
+    settings, 'PHOTOMANAGER_SHARE_CACHE_MAX_AGE', 24 * 60 * 60)
+
+# The purge endpoints of the caches in front of the shared pages. Each is
+# sent a GET for its URL followed by the path of a shared album, plus a
+# trailing *, to purge every page of that album.
+SHARE_PURGE_URLS = getattr(settings, 'PHOTOMANAGER_SHARE_PURGE_URLS', ())
+
+# How long to wait for a cache to respond to a purge.
+SHARE_PURGE_TIMEOUT = 2
+
+
+def create_token():
+    return get_random_string(32)
+
+
+def get_surrogate_keys(album, photo=None):
+    """The keys tagging a shared page in caches that purge by key: one for
+    the album, and one for the photo of a photo's page. An album's page
+    isn't tagged with its photos, since a key for each of hundreds of
+    photos is more than nginx or a CDN will take in a header, and any
+    change to them purges the album anyway.
+    """
+    keys = ['album-%d' % album.pk]
+    if photo is not None:
+        keys.append('photo-%d' % photo.pk)
+    return ' '.join(keys)
+
+
+def make_public(response, album, photo=None):
+    """Let any cache keep a shared page, for anyone who asks for it."""
+    patch_cache_control(
+        response, public=True, max_age=SHARE_MAX_AGE,
+        s_maxage=SHARE_CACHE_MAX_AGE)
+    response['Surrogate-Key'] = get_surrogate_keys(album, photo)
+    return response
+
+
+_deferred = threading.local()
+
+
+@contextmanager
+def deferring_purges():
+    """Hold back the purges asked for during the block, and send each of
+    them once when it ends. A transaction inside the block is then purged
+    only after it commits, so a request arriving before the commit can't
+    cache the old page again. Nothing is purged if the block raises.
+    """
+    if getattr(_deferred, 'tokens', None) is not None:
+        yield
+        return
+    _deferred.tokens = set()
+    try:
+        yield
+        tokens = _deferred.tokens
+    finally:
+        _deferred.tokens = None
+    purge(tokens)
+
+
+def purge(tokens):
+    """Purge every cached page of the albums shared under the given
+    tokens. Caches that can't be reached are logged and skipped; their
+    pages expire after SHARE_CACHE_MAX_AGE regardless.
+    """
+    deferred = getattr(_deferred, 'tokens', None)
+    if deferred is not None:
+        deferred.update(tokens)
+        return
+    for token in tokens:
+        path = reverse('PhotoManager:pm-shared_album', kwargs={'token': token})
+        for url in SHARE_PURGE_URLS:
+            try:
+                urllib2.urlopen(url + path + '*', timeout=SHARE_PURGE_TIMEOUT)
+            except urllib2.HTTPError, e:
+                # Nothing of the album's was cached.
+                if e.code != 404:
+                    logger.warning('Could not purge %s from %s: %s',
+                                   path, url, e)
+            except (urllib2.URLError, socket.error), e:
+                logger.warning('Could not purge %s from %s: %s', path, url, e)
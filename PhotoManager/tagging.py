@@ -0,0 +1,107 @@
+from django.db import IntegrityError, transaction
+from models import Tag, Photo, get_chunks
+
+
+# The longest text a tag may have.
+TAG_MAX_LENGTH = Tag._meta.get_field('text').max_length
+
+# How many times an insert is tried again when other requests insert some
+# of the same rows first.
+INSERT_ATTEMPTS = 5
+
+
+def clean_texts(texts):
+    """Tag texts stripped of surrounding space, without blanks or
+    duplicates, in the order given. Raises ValueError for a text too long
+    to be a tag.
+    """
+    cleaned, seen = [], set()
+    for text in texts:
+        text = text.strip()
+        if len(text) > TAG_MAX_LENGTH:
+            raise ValueError(
+                'Tags may be at most %d characters long.' % TAG_MAX_LENGTH)
+        if text and text not in seen:
+            seen.add(text)
+            cleaned.append(text)
+    return cleaned
+
+
+def insert_missing(model, keys, find, make, find_inserted=True):
+    """Insert a row for each of a set of keys that doesn't have one yet,
+    in one bulk insert. find(keys) returns a dict of the keys that already
+    have rows; make(key) builds an unsaved row. If another request inserts
+    some of the same rows first, the insert is rolled back to a savepoint
+    and tried again without them. Returns find's dict for every key.
+    """
+    found = find(keys)
+    for attempt in range(INSERT_ATTEMPTS):
+        missing = [key for key in keys if key not in found]
+        if not missing:
+            break
+        try:
+            with transaction.atomic():
+                model.objects.bulk_create([make(key) for key in missing])
+        except IntegrityError:
+            if attempt == INSERT_ATTEMPTS - 1:
+                raise
+        else:
+            if not find_inserted:
+                found.update(dict.fromkeys(missing))
+                break
+        found.update(find(missing))
+    return found
+
+
+def find_tags(texts):
+    tags = {}
+    for chunk in get_chunks(texts):
+        tags.update(Tag.objects.filter(text__in=chunk).
+                    values_list('text', 'pk'))
+    return tags
+
+
+def get_or_create_tags(texts):
+    """The ids of the tags with some texts, keyed by text, creating the
+    tags that don't exist yet. However many tags there are, this is one
+    query to find them, and one to insert and one to find the missing
+    ones, per few hundred. Tags created by another request at the same
+    time are used rather than duplicated.
+    """
+    texts = clean_texts(texts)
+    return insert_missing(Tag, texts, find_tags,
+                          lambda text: Tag(text=text))
+
+
+def add_tags(photo_ids, tag_ids):
+    """Tag photos with tags, by id, in one bulk insert into the photo and
+    tag through table. Photos that already have a tag are left as they
+    are.
+    """
+    through = Photo.tags.through
+    photo_ids, tag_ids = list(set(photo_ids)), list(set(tag_ids))
+    if not photo_ids or not tag_ids:
+        return
+
+    def find(pairs):
+        existing = set()
+        for chunk in get_chunks(list(set(pk for pk, tag_id in pairs))):
+            existing.update(through.objects.filter(
+                photo__in=chunk, tag__in=tag_ids).
+                values_list('photo_id', 'tag_id'))
+        return dict.fromkeys(existing)
+
+    pairs = [(pk, tag_id) for pk in photo_ids for tag_id in tag_ids]
+    insert_missing(through, pairs, find,
+                   lambda pair: through(photo_id=pair[0], tag_id=pair[1]),
+                   find_inserted=False)
+
+
+def tag_photos(photo_ids, texts):
+    """Tag photos with tags, by text, creating the tags that don't exist
+    yet. Tagging any number of photos with any number of tags takes a
+    handful of queries. Returns the ids of the tags, keyed by text.
+    """
+    tags = get_or_create_tags(texts)
+    add_tags(photo_ids, tags.values())
+    return tags
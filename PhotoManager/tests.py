@@ -1,13 +1,82 @@
 from django.test import TestCase
+from django.utils.unittest import skipUnless
+from django.contrib.sessions.models import Session
 from django.test.client import Client
 from django.core.exceptions import ValidationError
 from django.core.files import File
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, Permission, Group
 from django.conf import settings
-from datetime import datetime
-from models import Tag, Photo, Album
+from datetime import datetime, timedelta
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from sorl.thumbnail import get_thumbnail, delete, default
+from sorl.thumbnail.images import ImageFile
+from models import Tag, Photo, Album, AlbumPhoto, ContactSheet, Usage
+from engines import Engine
+from renditions import generate_renditions, generate_placeholder, \
+    get_rendition_options
+import contactsheets
+import deepzoom
+import ingest
+from deepzoom import build_pyramid, generate_pyramid
+import decoding
+from decoding import DecodeGovernor, ImageTooLarge, DecoderBusy
+from benchmark import BENCH_PASSWORD, generate_library, percentile, \
+    make_image
+import middleware
+from middleware import ProfilingMiddleware, ReplicaMiddleware
+import routers
+from routers import ReplicaRouter
+from dbhealth import check_connections, mark_connections_used
+from warmup import warm_up, get_template_names, check_template
+from django.core.management.base import CommandError
+from django.template.base import TemplateDoesNotExist, TemplateSyntaxError
+from django.core.handlers.wsgi import WSGIHandler
+import assets
+import gzip
+import zipfile
+import zlib
+import zipstream
+import backups
+import galleries
+import sharing
+import orphans
+import uploads
+import quotas
+import ordering
+import batch
+import tagging
+import urllib2
+from ingest import process_photo
+from django.utils.functional import empty
+from profiling import normalize_sql
+import metrics
+from metrics import Registry
 from shutil import rmtree
+from django import db
+from django.db import connection
+from django.db.models import Count, Min, Sum
+from django.test.utils import CaptureQueriesContext
+from PhotoApp.loaders import TEMPLATE_LOADERS, get_template_loaders
+from django.test.client import RequestFactory
+from django.http import HttpResponse
+from cStringIO import StringIO
+from collections import OrderedDict
+from time import time
+from random import Random
+import difflib
+import hashlib
+import json
+import logging
+import tempfile
 import os
+import re
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
 
 
 class TestTagModel(TestCase):
@@ -146,7 +215,7 @@ class TestAlbumModel(TestCase):
             author=self.u
         )
         album.save()
-        album.photos.add(photo1, photo2, photo3)
+        album.add_photos(photo1, photo2, photo3)
         album.save()
 
         self.assertIn(photo1, album.photos.all())
@@ -222,6 +291,23 @@ class TestHomeView(TestCase):
         self.assertIn('Test Album', response.content)
         self.assertIn('Test Description', response.content)
 
+    def test_home_view_cover(self):
+        """Move a photo to the front of an album and assert that it becomes
+        the album's cover.
+        """
+        album = Album.objects.filter(author__username='django').\
+            exclude(photos=None)[0]
+        photos = list(album.get_photos())
+        self.assertEqual(self.get_cover(album), photos[0])
+        ordering.move_photo(album, photos[-1])
+        self.assertEqual(self.get_cover(album), photos[-1])
+
+    def get_cover(self, album):
+        response = self.client.get(self.url)
+        for listed in response.context['albums']:
+            if listed.pk == album.pk:
+                return listed.cover
+
 
 class TestTagView(TestCase):
     """Test the tag view.
@@ -597,8 +683,9 @@ class TestCreatePhotoView(TestCase):
         """
         response = self.client.post(self.url, self.form_data, follow=True)
         self.assertRedirects(response, self.redirect)
-        Photo.objects.get(
+        photo = Photo.objects.get(
             description=self.form_data['description'])
+        self.assertTrue(photo.placeholder.startswith('data:image/png'))
 
     def test_create_photo_missing_image(self):
         """Create an photo that's missing an image and assert that the
@@ -613,6 +700,37 @@ class TestCreatePhotoView(TestCase):
             description=self.form_data['description']
         )
 
+    def test_create_photo_over_decode_budget(self):
+        """Upload a photo too large to ever fit the decoding budget, and
+        assert that it's refused rather than left without renditions.
+        """
+        memory = decoding.governor.memory
+        decoding.governor.memory = decoding.governor.available = 1000
+        try:
+            response = self.client.post(self.url, self.form_data)
+        finally:
+            decoding.governor.memory = decoding.governor.available = memory
+        self.assertRedirects(response, self.redirect)
+        self.assertFalse(Photo.objects.filter(
+            description=self.form_data['description']).exists())
+
+    def test_create_photo_decoded_reduced(self):
+        """Upload a JPEG too large to decode at full resolution within the
+        decoding budget, but not at the scale its renditions are decoded
+        at, and assert that it's accepted and given renditions.
+        """
+        memory = decoding.governor.memory
+        # The 600x600 image's 100x100 renditions are decoded at 150x150.
+        decoding.governor.memory = decoding.governor.available = 200000
+        try:
+            response = self.client.post(self.url, self.form_data)
+        finally:
+            decoding.governor.memory = decoding.governor.available = memory
+        self.assertRedirects(response, self.redirect)
+        photo = Photo.objects.get(description=self.form_data['description'])
+        self.assertTrue(photo.placeholder.startswith('data:image/png'))
+        delete(photo.image)
+
 
 class TestModifyPhotoView(TestCase):
     """Test the modify photo view."""
@@ -730,6 +848,18 @@ class TestCreateTagView(TestCase):
         response = self.client.post(self.url, self.form_data)
         self.assertRedirects(response, self.redirect, target_status_code=200)
 
+    def test_create_existing_tag(self):
+        """Tag a photo with a tag that already exists, twice, and assert
+        that the photo is tagged with it once.
+        """
+        tag = Tag.objects.create(text='TestTag')
+        for i in range(2):
+            response = self.client.post(self.url, self.form_data)
+            self.assertRedirects(
+                response, self.redirect, target_status_code=200)
+        self.assertEqual(Tag.objects.filter(text='TestTag').count(), 1)
+        self.assertEqual(list(self.photo.tags.filter(text='TestTag')), [tag])
+
     def test_create_tag_without_text(self):
         """Attempt to create a tag without text and assert that the
         operation fails.
@@ -739,3 +869,2296 @@ class TestCreateTagView(TestCase):
         self.assertRedirects(response, self.redirect, target_status_code=200)
         photo = Photo.objects.get(pk=self.photo.pk)
         self.assertNotIn('', [tag.text for tag in photo.tags.all()])
+
+
+class TestThumbnailEngine(TestCase):
+    """Test the shrink-on-load thumbnail engine."""
+    def setUp(self):
+        self.engine = Engine()
+        buf = StringIO()
+        Image.new('RGB', (2000, 1000), 'red').save(buf, format='JPEG')
+        self.data = buf.getvalue()
+
+    def create(self, geometry, **options):
+        options.setdefault('crop', False)
+        options.update(get_rendition_options(**options))
+        image = self.engine.get_image(ContentFile(self.data))
+        return self.engine.create(image, geometry, options)
+
+    def test_draft_decodes_at_reduced_scale(self):
+        """Assert that a JPEG is decoded at the smallest scale that still
+        covers the requested geometry.
+        """
+        image = self.engine.get_image(ContentFile(self.data))
+        self.engine.draft(image, (100, 100), {'crop': False})
+        self.assertEqual(image.size, (250, 125))
+        image = self.engine.get_image(ContentFile(self.data))
+        self.engine.draft(image, (300, 300), {'crop': 'center'})
+        self.assertEqual(image.size, (1000, 500))
+
+    def test_create_thumbnail(self):
+        """Assert that thumbnails created from a reduced decode have the
+        requested dimensions.
+        """
+        self.assertEqual(self.create((100, 100)).size, (100, 50))
+        self.assertEqual(
+            self.create((100, 100), crop='center').size, (100, 100))
+
+
+class TestRenditions(TestCase):
+    """Test generating every rendition of a photo from a single decode."""
+    def setUp(self):
+        self.u = User(username='admin', password='password')
+        self.u.save()
+        self.photo = Photo(author=self.u, image=File(open('test_image.jpg')))
+        self.photo.save()
+        default.kvstore.delete(ImageFile(self.photo.image))
+
+    def tearDown(self):
+        """After each test, remove the image file and its thumbnails."""
+        delete(self.photo.image)
+        rmtree(
+            os.path.join(settings.MEDIA_ROOT, str(self.u.pk)),
+            ignore_errors=True
+        )
+
+    def test_generate_renditions(self):
+        """Generate renditions for a photo and assert that sorl-thumbnail
+        finds them in its key value store.
+        """
+        created = generate_renditions(
+            self.photo.image, sizes=('300x300', '100x100'))
+        self.assertEqual(
+            sorted(tuple(thumbnail.size) for thumbnail in created),
+            [(100, 100), (300, 300)])
+        for thumbnail in created:
+            self.assertTrue(thumbnail.exists())
+        self.assertEqual(
+            get_thumbnail(self.photo.image, '100x100').name,
+            [t.name for t in created if t.width == 100][0])
+
+    def test_generate_placeholder(self):
+        """Generate a placeholder for a photo and assert that it's a
+        small data URI.
+        """
+        placeholder = generate_placeholder(self.photo.image)
+        self.assertTrue(placeholder.startswith('data:image/png;base64,'))
+        self.assertLess(len(placeholder), 400)
+
+    def test_backfill_placeholders(self):
+        """Run the backfill command and assert that photos without a
+        placeholder are given one.
+        """
+        call_command('generate_renditions', batch_size=1, stdout=StringIO())
+        photo = Photo.objects.get(pk=self.photo.pk)
+        self.assertTrue(photo.placeholder.startswith('data:image/png'))
+
+    def test_generate_renditions_twice(self):
+        """Assert that renditions that already exist aren't regenerated."""
+        generate_renditions(self.photo.image, sizes=('100x100',))
+        self.assertEqual(
+            generate_renditions(self.photo.image, sizes=('100x100',)), [])
+
+    def test_generate_renditions_after_kvstore_loss(self):
+        """Drop a rendition from the key value store, generate it again,
+        and assert that the file in storage is reused rather than written
+        again under another name.
+        """
+        thumbnail, = generate_renditions(
+            self.photo.image, sizes=('100x100',))
+        directory, name = os.path.split(thumbnail.name)
+        default.kvstore.delete(thumbnail)
+        self.assertEqual(
+            generate_renditions(self.photo.image, sizes=('100x100',)), [])
+        self.assertEqual(default.kvstore.get(thumbnail).size, [100, 100])
+        self.assertEqual(
+            default.storage.listdir(directory)[1], [name])
+
+
+class TestContactSheets(TestCase):
+    """Test drawing album grids from contact sheets."""
+    def setUp(self):
+        contactsheets.CONTACT_SHEETS = True
+        contactsheets.CONTACT_SHEET_PAGE_SIZE = 2
+        self.client = Client()
+        self.u = User.objects.create_user('admin', password='password')
+        self.client.login(username='admin', password='password')
+        self.photos = []
+        for i in range(3):
+            photo = Photo(author=self.u, image=File(open('test_image.jpg')))
+            photo.save()
+            self.photos.append(photo)
+        self.album = Album(title='An Album', author=self.u)
+        self.album.save()
+
+    def tearDown(self):
+        """After each test, turn contact sheets back off and remove the
+        files created.
+        """
+        contactsheets.CONTACT_SHEETS = False
+        contactsheets.CONTACT_SHEET_PAGE_SIZE = 100
+        for sheet in ContactSheet.objects.all():
+            sheet.image.delete(save=False)
+        rmtree(
+            os.path.join(settings.MEDIA_ROOT, str(self.u.pk)),
+            ignore_errors=True
+        )
+
+    def test_add_photos(self):
+        """Add photos to an album and assert that they're laid out across
+        pages of contact sheets.
+        """
+        self.album.add_photos(*self.photos)
+        sheets = self.album.contact_sheets.all()
+        self.assertEqual(len(sheets), 2)
+        self.assertEqual(
+            sheets[0].photo_ids, [photo.pk for photo in self.photos[:2]])
+        self.assertEqual(sheets[1].photo_ids, [self.photos[2].pk])
+        self.assertEqual(
+            [(tile['x'], tile['y']) for tile in sheets[0].tiles],
+            [(0, 0), (100, 0)])
+        self.assertTrue(sheets[0].image.storage.exists(sheets[0].image.name))
+
+    def test_update_is_incremental(self):
+        """Add a photo to an album and assert that only the last page's
+        contact sheet is redrawn.
+        """
+        self.album.add_photos(*self.photos[:2])
+        first = self.album.contact_sheets.get(page=0)
+        self.album.add_photos(self.photos[2])
+        self.assertEqual(
+            self.album.contact_sheets.get(page=0).image.name,
+            first.image.name)
+        self.assertEqual(self.album.contact_sheets.count(), 2)
+
+    def test_remove_photos(self):
+        """Remove photos from an album and assert that its surplus contact
+        sheets are deleted.
+        """
+        self.album.add_photos(*self.photos)
+        self.album.remove_photos(self.photos[0])
+        self.assertEqual(self.album.contact_sheets.count(), 1)
+        self.photos[1].delete()
+        self.assertEqual(
+            self.album.contact_sheets.get().photo_ids, [self.photos[2].pk])
+
+    def test_redrawn_sheet_renamed(self):
+        """Change the photos on a page and assert that its redrawn sheet
+        gets a new name, and the old sheet's file is deleted.
+        """
+        buf = StringIO()
+        Image.new('RGB', (200, 100), 'red').save(buf, format='JPEG')
+        red = Photo.objects.create(
+            author=self.u, image=ContentFile(buf.getvalue(), 'red.jpg'))
+        self.album.add_photos(*self.photos[:2])
+        first = self.album.contact_sheets.get(page=0).image.name
+        self.album.remove_photos(self.photos[0])
+        self.album.add_photos(red)
+        sheet = self.album.contact_sheets.get(page=0)
+        self.assertNotEqual(sheet.image.name, first)
+        self.assertTrue(sheet.image.storage.exists(sheet.image.name))
+        self.assertFalse(sheet.image.storage.exists(first))
+
+    def test_set_photos_redraws_once(self):
+        """Replace an album's photos, and assert that its sheets are
+        brought up to date once rather than once per step.
+        """
+        self.album.add_photos(*self.photos[:2])
+        updates = []
+        update = contactsheets.update_contact_sheets
+
+        def update_contact_sheets(album):
+            if getattr(contactsheets._deferred, 'albums', None) is None:
+                updates.append(album.pk)
+            update(album)
+
+        contactsheets.update_contact_sheets = update_contact_sheets
+        try:
+            self.album.set_photos(self.photos[1:])
+        finally:
+            contactsheets.update_contact_sheets = update
+        self.assertEqual(updates, [self.album.pk])
+        self.assertEqual(
+            [sheet.photo_ids for sheet in self.album.contact_sheets.all()],
+            [[self.photos[1].pk, self.photos[2].pk]])
+
+    def test_decoder_busy(self):
+        """Add a photo without renditions to an album while there's no
+        memory to decode it, and assert that its sheet is redrawn by the
+        background queue rather than the request failing.
+        """
+        buf = StringIO()
+        Image.new('RGB', (200, 100), 'blue').save(buf, format='JPEG')
+        photo = Photo.objects.create(author=self.u, image=ContentFile(
+            buf.getvalue(), 'busy-%d.jpg' % int(time() * 1000000)))
+        queued = []
+        enqueue = contactsheets.enqueue
+        contactsheets.enqueue = lambda func, *args: queued.append(
+            (func, args))
+        memory = decoding.governor.memory
+        decoding.governor.available = 0
+        decoding.DECODE_TIMEOUT = 0.01
+        try:
+            self.album.add_photos(photo)
+        finally:
+            contactsheets.enqueue = enqueue
+            decoding.governor.available = memory
+            decoding.DECODE_TIMEOUT = 5
+        self.assertEqual(self.album.contact_sheets.count(), 0)
+        self.assertEqual(queued, [
+            (contactsheets.update_contact_sheets_by_pk, (self.album.pk,))])
+        contactsheets.update_contact_sheets_by_pk(self.album.pk)
+        self.assertEqual(
+            self.album.contact_sheets.get().photo_ids, [photo.pk])
+        delete(photo.image)
+
+    def test_album_view(self):
+        """Assert that the album view draws thumbnails from contact
+        sheets.
+        """
+        self.album.add_photos(*self.photos)
+        response = self.client.get('/pm/album/{}'.format(self.album.pk))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content.count('class="tile"'), 3)
+        for sheet in self.album.contact_sheets.all():
+            self.assertIn(sheet.image.url, response.content)
+
+
+class TestDeepZoom(TestCase):
+    """Test building deep zoom tile pyramids for very large photos."""
+    def setUp(self):
+        deepzoom.DEEP_ZOOM_PIXELS = 1000
+        self.client = Client()
+        self.u = User.objects.create_user('admin', password='password')
+        self.client.login(username='admin', password='password')
+        self.photo = Photo(author=self.u, image=File(open('test_image.jpg')))
+        self.photo.save()
+
+    def tearDown(self):
+        """After each test, restore the threshold and remove the files
+        created.
+        """
+        deepzoom.DEEP_ZOOM_PIXELS = 16 * 1000 * 1000
+        for path in ('deepzoom', str(self.u.pk)):
+            rmtree(
+                os.path.join(settings.MEDIA_ROOT, path),
+                ignore_errors=True
+            )
+
+    def test_generate_pyramid(self):
+        """Generate a pyramid for a photo over the threshold and assert
+        that its descriptor and every level's tiles are saved.
+        """
+        self.assertTrue(generate_pyramid(self.photo))
+        storage = self.photo.image.storage
+        self.assertIn('Width="600" Height="600"',
+                      storage.open(self.photo.deep_zoom).read())
+        tiles = self.photo.deep_zoom.replace('.dzi', '_files')
+        self.assertEqual(
+            sorted(storage.listdir(tiles + '/10')[1]),
+            ['%d_%d.jpg' % (col, row)
+             for col in range(3) for row in range(3)])
+        self.assertEqual(storage.listdir(tiles + '/0')[1], ['0_0.jpg'])
+
+    def test_pyramid_over_budget(self):
+        """Assert that a JPEG too large to decode at full resolution within
+        the decoding budget gets a pyramid topped by the largest scale that
+        fits.
+        """
+        memory = decoding.governor.memory
+        decoding.governor.memory = decoding.governor.available = 500000
+        try:
+            self.assertTrue(generate_pyramid(self.photo))
+        finally:
+            decoding.governor.memory = decoding.governor.available = memory
+        self.assertIn('Width="150" Height="150"', self.photo.image.storage.
+                      open(self.photo.deep_zoom).read())
+
+    def test_build_pyramid_again(self):
+        """Build a photo's pyramid twice and assert that the second build
+        replaces the first's files rather than saving beside them.
+        """
+        name = build_pyramid(self.photo)
+        self.assertEqual(build_pyramid(self.photo), name)
+        storage = self.photo.image.storage
+        tiles = name.replace('.dzi', '_files')
+        self.assertEqual(len(storage.listdir(tiles + '/10')[1]), 9)
+        self.assertEqual(storage.listdir(os.path.dirname(name))[1],
+                         [os.path.basename(name)])
+
+    def test_pyramid_built_in_background(self):
+        """Process an upload and assert that its pyramid is queued rather
+        than built in the request, and recorded once the queue builds it.
+        """
+        queued = []
+        enqueue = ingest.enqueue
+        ingest.enqueue = lambda func, *args: queued.append((func, args))
+        try:
+            process_photo(self.photo)
+        finally:
+            ingest.enqueue = enqueue
+        self.assertEqual(Photo.objects.get(pk=self.photo.pk).deep_zoom, '')
+        self.assertEqual(
+            queued, [(ingest.generate_pyramid_by_pk, (self.photo.pk,))])
+        ingest.generate_pyramid_by_pk(self.photo.pk)
+        self.assertTrue(
+            Photo.objects.get(pk=self.photo.pk).deep_zoom.endswith('.dzi'))
+
+    def test_generate_pyramid_under_threshold(self):
+        """Assert that photos under the threshold don't get a pyramid."""
+        deepzoom.DEEP_ZOOM_PIXELS = 600 * 600
+        self.assertFalse(generate_pyramid(self.photo))
+        self.assertEqual(self.photo.deep_zoom, '')
+
+    def test_photo_view(self):
+        """Assert that the photo view shows a deep zoom viewer for photos
+        that have a pyramid.
+        """
+        generate_pyramid(self.photo)
+        self.photo.save()
+        response = self.client.get('/pm/photo/{}'.format(self.photo.pk))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(self.photo.deep_zoom_url, response.content)
+        self.assertIn(self.photo.image.url, response.content)
+
+
+class TestDecodeGovernor(TestCase):
+    """Test the limits on decoding images."""
+    def setUp(self):
+        self.governor = DecodeGovernor(memory=8000, max_pixels=2000)
+
+    def test_pixel_limit(self):
+        """Assert that images over the pixel limit are refused."""
+        with self.assertRaises(ImageTooLarge):
+            with self.governor.decoding((100, 100)):
+                pass
+
+    def test_memory_limit(self):
+        """Assert that images that would never fit into the memory budget
+        are refused, and that decoding them at a reduced scale is not.
+        """
+        with self.assertRaises(ImageTooLarge):
+            self.governor.acquire(self.governor.get_cost((40, 40)))
+        with self.governor.decoding((40, 40), scale=2):
+            self.assertEqual(self.governor.available, 8000 - 20 * 20 * 8)
+        self.assertEqual(self.governor.available, 8000)
+
+    def test_max_pixels(self):
+        """Assert that the largest image admitted is bounded by both the
+        pixel limit and the memory budget.
+        """
+        self.assertEqual(self.governor.get_max_pixels(), 1000)
+        self.assertEqual(
+            DecodeGovernor(memory=80000, max_pixels=2000).get_max_pixels(),
+            2000)
+        self.assertEqual(
+            DecodeGovernor(memory=800, max_pixels=2000).get_max_pixels(2),
+            400)
+
+    def test_scale(self):
+        """Assert that the smallest scale that fits the memory budget is
+        picked, or the largest when none does.
+        """
+        self.assertEqual(self.governor.get_scale((30, 30), (1, 2, 4)), 1)
+        self.assertEqual(self.governor.get_scale((40, 40), (4, 2, 1)), 2)
+        self.assertEqual(self.governor.get_scale((400, 400), (1, 2, 4)), 4)
+
+    def test_busy(self):
+        """Assert that a decode gives up when memory doesn't become free
+        in time.
+        """
+        decoding.DECODE_TIMEOUT = 0.01
+        try:
+            with self.governor.decoding((30, 30)):
+                with self.assertRaises(DecoderBusy):
+                    with self.governor.decoding((30, 30)):
+                        pass
+        finally:
+            decoding.DECODE_TIMEOUT = 5
+
+
+class TestThumbnailBackend(TestCase):
+    """Test serving placeholders when thumbnails can't be decoded."""
+    def setUp(self):
+        self.u = User(username='admin', password='password')
+        self.u.save()
+        self.photo = Photo(
+            author=self.u,
+            image=File(open('test_image.jpg')),
+            placeholder='data:image/png;base64,AAAA'
+        )
+        self.photo.save()
+        default.kvstore.delete(ImageFile(self.photo.image))
+        self.memory = decoding.governor.memory
+        decoding.governor.memory = decoding.governor.available = 1000
+
+    def tearDown(self):
+        """After each test, restore the budget and remove the image."""
+        decoding.governor.memory = decoding.governor.available = self.memory
+        rmtree(
+            os.path.join(settings.MEDIA_ROOT, str(self.u.pk)),
+            ignore_errors=True
+        )
+
+    def test_placeholder(self):
+        """Assert that the photo's placeholder is served, at the size of
+        the thumbnail, when the original is over budget.
+        """
+        thumbnail = get_thumbnail(self.photo.image, '100x50')
+        self.assertEqual(thumbnail.url, self.photo.placeholder)
+        self.assertEqual(tuple(thumbnail.size), (50, 50))
+
+
+class TestBenchmark(TestCase):
+    """Test the synthetic library generator used for benchmarking."""
+    def tearDown(self):
+        """After each test, remove the generated images."""
+        for user in User.objects.filter(username__startswith='bench-'):
+            rmtree(
+                os.path.join(settings.MEDIA_ROOT, str(user.pk)),
+                ignore_errors=True
+            )
+
+    def test_generate_library(self):
+        """Generate a small library and assert that it has the requested
+        shape and that its users may log in and use every view.
+        """
+        users = generate_library(
+            users=2, albums=3, photos=4, tags=5, photos_per_album=2)
+        self.assertEqual(len(users), 2)
+        self.assertEqual(Photo.objects.filter(author=users[0]).count(), 4)
+        self.assertEqual(Album.objects.filter(author=users[1]).count(), 3)
+        self.assertEqual(
+            Tag.objects.filter(text__startswith='bench-').count(), 5)
+        album = Album.objects.filter(author=users[0])[0]
+        self.assertEqual(album.photos.count(), 2)
+        self.assertTrue(users[0].has_perm('PhotoManager.add_photo'))
+        client = Client()
+        self.assertTrue(client.login(
+            username=users[0].username, password=BENCH_PASSWORD))
+
+    def test_percentile(self):
+        """Assert that percentiles are taken by nearest rank."""
+        values = range(1, 21)
+        self.assertEqual(percentile(values, 50), 10)
+        self.assertEqual(percentile(values, 95), 19)
+        self.assertEqual(percentile(values, 100), 20)
+
+
+def describe_queries(queries):
+    """List queries, collapsing repeats of the same normalized query."""
+    counts = OrderedDict()
+    for sql in queries:
+        sql = normalize_sql(sql)
+        counts[sql] = counts.get(sql, 0) + 1
+    return '\n'.join(
+        '    %3dx %s' % (count, sql) for sql, count in counts.items())
+
+
+class TestViewBudgets(TestCase):
+    """Test that each view stays within a budget of queries and latency,
+    and that it makes the same number of queries however large the
+    library it's showing is.
+    """
+    library_sizes = (10, 100, 1000)
+
+    # The most queries, and milliseconds, that a warm request may take.
+    budgets = {
+        'home_view': (6, 500),
+        'album_view': (6, 1500),
+        'photo_view': (6, 500),
+        'tag_view': (6, 1500),
+    }
+
+    def tearDown(self):
+        """After each test, remove the generated images."""
+        for user in User.objects.filter(username__startswith='bench-'):
+            rmtree(
+                os.path.join(settings.MEDIA_ROOT, str(user.pk)),
+                ignore_errors=True
+            )
+
+    def get_urls(self, user):
+        """A URL for each view, showing as much of the user's library as
+        any single page of that view does.
+        """
+        album = Album.objects.filter(author=user).\
+            annotate(size=Count('photos')).order_by('-size')[0]
+        photo = Photo.objects.filter(author=user)[0]
+        tag = Tag.objects.filter(photo__author=user).\
+            annotate(size=Count('photo')).order_by('-size')[0]
+        return {
+            'home_view': '/pm/home/',
+            'album_view': '/pm/album/{}'.format(album.pk),
+            'photo_view': '/pm/photo/{}'.format(photo.pk),
+            'tag_view': '/pm/tag/{}'.format(tag.pk),
+        }
+
+    def profile(self, client, url):
+        """Request a URL once to warm caches and thumbnails, then again to
+        record the queries that it makes and how long it takes.
+        """
+        client.get(url)
+        with CaptureQueriesContext(connection) as context:
+            start = time()
+            response = client.get(url)
+            elapsed = (time() - start) * 1000
+        self.assertEqual(response.status_code, 200)
+        return [query['sql'] for query in context.captured_queries], elapsed
+
+    def test_view_budgets(self):
+        """Profile every view against libraries of increasing size, and
+        assert that none goes over budget or makes more queries as the
+        library grows.
+        """
+        profiles = dict((view, []) for view in self.budgets)
+        for size in self.library_sizes:
+            user, = generate_library(
+                albums=max(1, size // 10),
+                photos=size,
+                tags=max(1, size // 10),
+                photos_per_album=size // 2,
+                seed=size,
+                distinct_images=False
+            )
+            client = Client()
+            client.login(username=user.username, password=BENCH_PASSWORD)
+            for view, url in self.get_urls(user).items():
+                profiles[view].append((size, self.profile(client, url)))
+
+        failures = []
+        for view, (max_queries, max_ms) in sorted(self.budgets.items()):
+            smallest_size, (smallest_queries, ms) = profiles[view][0]
+            for size, (queries, ms) in profiles[view]:
+                if len(queries) > max_queries:
+                    failures.append(
+                        '%s made %d queries for a library of %d photos, '
+                        'over its budget of %d:\n%s' % (
+                            view, len(queries), size, max_queries,
+                            describe_queries(queries)))
+                elif len(queries) != len(smallest_queries):
+                    diff = difflib.unified_diff(
+                        map(normalize_sql, smallest_queries),
+                        map(normalize_sql, queries),
+                        '%d photos' % smallest_size, '%d photos' % size,
+                        lineterm='')
+                    failures.append(
+                        '%s made %d queries for a library of %d photos, '
+                        'but %d for %d photos:\n%s' % (
+                            view, len(smallest_queries), smallest_size,
+                            len(queries), size, '\n'.join(diff)))
+                if ms > max_ms:
+                    failures.append(
+                        '%s took %dms for a library of %d photos, over its '
+                        'budget of %dms.' % (view, ms, size, max_ms))
+        if failures:
+            self.fail('\n\n'.join(failures))
+
+
+class RecordingHandler(logging.Handler):
+    """A logging handler that keeps the messages it's given."""
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestProfilingMiddleware(TestCase):
+    """Test the request profiling middleware."""
+    def setUp(self):
+        """Capture the profiling log, and remember the sampling settings
+        so that tests can change them.
+        """
+        self.user = User.objects.create_user('test', password='test')
+        self.factory = RequestFactory()
+        self.handler = RecordingHandler()
+        self.logger = logging.getLogger('PhotoManager.profiling')
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.INFO)
+        self.saved_settings = (
+            middleware.PROFILE_SAMPLE_RATE, middleware.PROFILE_CPROFILE_RATE,
+            middleware.PROFILE_SLOW_MS, middleware.PROFILE_DIR)
+        self.profile_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Restore the logger and the sampling settings."""
+        self.logger.removeHandler(self.handler)
+        self.logger.setLevel(logging.NOTSET)
+        (middleware.PROFILE_SAMPLE_RATE, middleware.PROFILE_CPROFILE_RATE,
+            middleware.PROFILE_SLOW_MS, middleware.PROFILE_DIR) = \
+            self.saved_settings
+        rmtree(self.profile_dir)
+
+    def handle(self, view):
+        """Pass a request through the middleware around a view function,
+        returning the records logged for it.
+        """
+        profiler = ProfilingMiddleware()
+        request = self.factory.get('/pm/home/')
+        profiler.process_request(request)
+        response = profiler.process_response(request, view())
+        self.assertEqual(response.status_code, 200)
+        return [json.loads(message) for message in self.handler.messages]
+
+    def test_records_queries(self):
+        """Assert that a request's queries are counted, and that a query
+        repeated with the same parameters is flagged as a duplicate, and
+        one repeated with different parameters as similar.
+        """
+        other = User.objects.create_user('other', password='other')
+
+        def view():
+            User.objects.get(pk=self.user.pk)
+            User.objects.get(pk=self.user.pk)
+            User.objects.get(pk=other.pk)
+            return HttpResponse()
+        record, = self.handle(view)
+        self.assertEqual(record['path'], '/pm/home/')
+        self.assertEqual(record['status'], 200)
+        self.assertEqual(record['queries'], 3)
+        self.assertEqual(record['duplicate_queries'], 1)
+        self.assertEqual(record['similar_queries'], 2)
+        self.assertGreaterEqual(record['wall_ms'], record['db_ms'])
+        self.assertFalse(connection.use_debug_cursor)
+
+    def test_records_templates_and_thumbnails(self):
+        """Request an album page through the full middleware stack and
+        assert that template, thumbnail and cache activity are recorded.
+        """
+        photo = Photo(author=self.user, description='Profiled')
+        photo.image.save(
+            'profiled.jpg', ContentFile(make_image(Random(0))), save=False)
+        photo.save()
+        album = Album.objects.create(
+            title='Profiled', description='Profiled', author=self.user)
+        album.add_photos(photo)
+        self.user.user_permissions.add(*Permission.objects.filter(
+            content_type__app_label='PhotoManager'))
+
+        classes = ('PhotoManager.middleware.ProfilingMiddleware',) + \
+            settings.MIDDLEWARE_CLASSES
+        try:
+            with self.settings(MIDDLEWARE_CLASSES=classes):
+                client = Client()
+                client.login(username='test', password='test')
+                response = client.get('/pm/album/{}'.format(album.pk))
+            self.assertEqual(response.status_code, 200)
+        finally:
+            rmtree(os.path.join(settings.MEDIA_ROOT, str(self.user.pk)))
+        record = [json.loads(message) for message in self.handler.messages][-1]
+        self.assertGreater(record['template_ms'], 0)
+        self.assertGreater(record['thumbnail_ms'], 0)
+        self.assertGreater(record['cache_hits'] + record['cache_misses'], 0)
+
+    def test_sampling_off(self):
+        """Assert that requests outside the sample are left alone."""
+        middleware.PROFILE_SAMPLE_RATE = 0.0
+        records = self.handle(lambda: HttpResponse())
+        self.assertEqual(records, [])
+        self.assertFalse(connection.use_debug_cursor)
+
+    def test_dumps_slow_requests(self):
+        """Assert that the cProfile stats of a slow request are dumped."""
+        middleware.PROFILE_CPROFILE_RATE = 1.0
+        middleware.PROFILE_SLOW_MS = -1
+        middleware.PROFILE_DIR = self.profile_dir
+        record, = self.handle(lambda: HttpResponse())
+        self.assertTrue(record['cprofile'].startswith(self.profile_dir))
+        self.assertTrue(os.path.exists(record['cprofile']))
+
+
+class TestMetrics(TestCase):
+    """Test the metrics registry and endpoint."""
+    def setUp(self):
+        """Make a registry that shares a directory with another worker."""
+        self.directory = tempfile.mkdtemp()
+        self.registry = Registry(self.directory, flush_interval=3600)
+        self.requests = self.registry.counter('requests', 'Requests.')
+        self.latency = self.registry.histogram(
+            'latency', 'Latency.', buckets=(0.1, 1))
+        self.depth = self.registry.gauge('depth', 'Depth.', lambda: 2)
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def write_worker(self, pid, values, started=1):
+        """Pretend that another worker wrote out its metrics."""
+        name = '%d-%d.json' % (pid, started)
+        with open(os.path.join(self.directory, name), 'w') as f:
+            json.dump(values, f)
+        return name
+
+    def test_render(self):
+        """Assert that counters, histograms and gauges are rendered in the
+        Prometheus text format.
+        """
+        self.requests.inc(view='home')
+        self.requests.inc(2, view='home')
+        self.latency.observe(0.05)
+        self.latency.observe(0.5)
+        self.latency.observe(5)
+        text = self.registry.render()
+        self.assertIn('# TYPE requests counter', text)
+        self.assertIn('requests{view="home"} 3.0', text)
+        self.assertIn('latency_bucket{le="0.1"} 1.0', text)
+        self.assertIn('latency_bucket{le="1"} 2.0', text)
+        self.assertIn('latency_bucket{le="+Inf"} 3.0', text)
+        self.assertIn('latency_sum 5.55', text)
+        self.assertIn('latency_count 3.0', text)
+        self.assertIn('depth 2.0', text)
+
+    def test_aggregate_workers(self):
+        """Assert that the values of other workers are added in, but that
+        the gauges of workers that have exited are not.
+        """
+        self.requests.inc(view='home')
+        self.latency.observe(0.05)
+        worker = {
+            'requests': [[[['view', 'home']], 4], [[['view', 'tag']], 1]],
+            'latency': [[[], [0, 1, 0, 0.5]]],
+            'depth': [[[], 5]],
+        }
+        self.write_worker(os.getppid(), worker)
+        exited = self.write_worker(999999999, worker)
+        for i in range(2):
+            totals = self.registry.aggregate()
+            self.assertEqual(totals['requests'][(('view', 'home'),)], 9)
+            self.assertEqual(totals['requests'][(('view', 'tag'),)], 2)
+            self.assertEqual(totals['latency'][()], [1, 2, 0, 1.05])
+            self.assertEqual(totals['depth'][()], 7)
+            # The exited worker's counters are kept in the archive.
+            self.assertNotIn(exited, os.listdir(self.directory))
+
+    def test_reused_pid(self):
+        """Assert that a worker that reuses the process id of one that has
+        exited, this one's included, doesn't replace its values, and that
+        the exited one's gauges are left out.
+        """
+        worker = {'requests': [[[['view', 'home']], 4]], 'depth': [[[], 5]]}
+        self.write_worker(os.getppid(), worker, started=1)
+        self.write_worker(os.getppid(), worker, started=2)
+        self.write_worker(os.getpid(), worker, started=1)
+        self.registry.flush()
+        totals = self.registry.aggregate()
+        self.assertEqual(totals['requests'][(('view', 'home'),)], 12)
+        self.assertEqual(totals['depth'][()], 7)
+        self.assertEqual(len(os.listdir(self.directory)), 4)
+
+    def test_flush(self):
+        """Assert that a flushed registry writes out its values in the
+        form that other workers read.
+        """
+        self.requests.inc(view='home')
+        self.latency.observe(0.5)
+        self.registry.flush()
+        with open(self.registry.get_path()) as f:
+            values = json.load(f)
+        self.assertEqual(values['requests'], [[[['view', 'home']], 1]])
+        self.assertEqual(values['latency'], [[[], [0, 1, 0, 0.5]]])
+        self.assertEqual(values['depth'], [[[], 2]])
+
+    def test_endpoint(self):
+        """Request a page, then assert that the metrics endpoint reports
+        it, and that it refuses other addresses.
+        """
+        self.client.get('/pm/')
+        response = self.client.get('/pm/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            'photomanager_request_duration_seconds_count'
+            '{view="frontpage_view"}', response.content)
+        self.assertIn('photomanager_decode_queue_depth', response.content)
+        response = self.client.get('/pm/metrics', REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 403)
+
+
+class TestQueryPlans(TestCase):
+    """Test that the queries on the hot paths are answered from indexes,
+    rather than by scanning or sorting whole tables.
+    """
+    # Queries that group their rows, and so have to sort them afterwards.
+    grouped_queries = ('home_view albums',)
+
+    def setUp(self):
+        """Generate a library large enough for the planner to care, and
+        gather statistics on it.
+        """
+        self.users = generate_library(
+            users=2, albums=20, photos=500, tags=50, photos_per_album=50,
+            distinct_images=False)
+        cursor = connection.cursor()
+        cursor.execute('ANALYZE')
+
+    def tearDown(self):
+        """Remove the generated images."""
+        for user in self.users:
+            rmtree(os.path.join(settings.MEDIA_ROOT, str(user.pk)))
+
+    def explain(self, queryset):
+        """Return the lines of a query's plan."""
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        else:
+            cursor.execute('EXPLAIN ' + sql, params)
+        return [row[-1] for row in cursor.fetchall()]
+
+    def get_problems(self, plan, grouped=False):
+        """The steps of a plan that read or sort a whole table."""
+        if connection.vendor == 'sqlite':
+            patterns = [r'^SCAN (TABLE )?\w+$', r'TEMP B-TREE FOR ORDER BY']
+        else:
+            patterns = [r'Seq Scan on', r'\bSort\b']
+        if grouped:
+            patterns.pop()
+        return [line for line in plan
+                if any(re.search(pattern, line) for pattern in patterns)]
+
+    def test_hot_paths_use_indexes(self):
+        """Explain each hot-path query and assert that none of them scans
+        a table, or sorts rows that an index could have kept in order.
+        """
+        user = self.users[0]
+        album = Album.objects.filter(author=user)[0]
+        photo = album.photos.all()[0]
+        tag = photo.tags.all()[0]
+        queries = {
+            'home_view albums': Album.objects.
+                filter(author__exact=user.pk).
+                annotate(cover_id=Min('photos')).
+                order_by('-date_created'),
+            'album_view photos': album.photos.all(),
+            'photo albums': photo.album_set.all(),
+            'tag_view photos': Photo.objects.
+                filter(author__exact=user, tags__id=tag.pk),
+            'user photos': Photo.objects.
+                filter(author=user).order_by('-date_created'),
+        }
+        failures = []
+        for name, queryset in sorted(queries.items()):
+            plan = self.explain(queryset)
+            problems = self.get_problems(plan, name in self.grouped_queries)
+            if problems:
+                failures.append('%s has %s in its plan:\n    %s' % (
+                    name, ', '.join(problems), '\n    '.join(plan)))
+        if failures:
+            self.fail('\n\n'.join(failures))
+
+
+class TestReplicaRouter(TestCase):
+    """Test the routing of reads to replicas."""
+    def setUp(self):
+        self.router = ReplicaRouter(('replica',))
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        routers.use_replica(False)
+
+    def test_routing(self):
+        """Assert that reads only go to the replica while it's in use, and
+        that writes always go to the primary.
+        """
+        self.assertEqual(self.router.db_for_read(Photo), 'default')
+        routers.use_replica(True)
+        self.assertEqual(self.router.db_for_read(Photo), 'replica')
+        self.assertEqual(self.router.db_for_write(Photo), 'default')
+        self.assertIsNone(ReplicaRouter(()).db_for_read(Photo))
+
+    def route(self, request, view):
+        """Pass a request to a view through the middleware, returning
+        whether the view's reads went to the replica, and the response.
+        """
+        middleware = ReplicaMiddleware()
+        middleware.process_view(request, view, (), {})
+        replica = self.router.db_for_read(Photo) == 'replica'
+        return replica, middleware.process_response(request, HttpResponse())
+
+    def test_middleware(self):
+        """Assert that only GET requests to the read-only views go to the
+        replica, and only for users who haven't just written.
+        """
+        def album_view(request):
+            pass
+
+        def modify_album_view(request):
+            pass
+
+        replica, response = self.route(
+            self.factory.get('/pm/album/1'), album_view)
+        self.assertTrue(replica)
+        self.assertNotIn(routers.REPLICA_COOKIE, response.cookies)
+        self.assertEqual(self.router.db_for_read(Photo), 'default')
+
+        replica, response = self.route(
+            self.factory.get('/pm/album/modify/1'), modify_album_view)
+        self.assertFalse(replica)
+
+        replica, response = self.route(
+            self.factory.post('/pm/album/modify/1'), modify_album_view)
+        self.assertFalse(replica)
+        self.assertEqual(
+            response.cookies[routers.REPLICA_COOKIE]['max-age'],
+            routers.REPLICA_STICKINESS)
+
+        request = self.factory.get('/pm/album/1')
+        request.COOKIES[routers.REPLICA_COOKIE] = '1'
+        replica, response = self.route(request, album_view)
+        self.assertFalse(replica)
+
+
+@skipUnless('replica' in settings.DATABASES,
+            'Run with PhotoApp.replica_settings to test against a replica.')
+class TestReplicaRouting(TestCase):
+    """Test read replica routing against a second database, standing in
+    for a replica that hasn't caught up with the primary.
+    """
+    multi_db = True
+
+    def setUp(self):
+        """Route reads to the replica database, then create a user and an
+        album on the primary, and an older copy of both on the replica.
+        """
+        self.routers = db.router.routers
+        db.router.routers = [ReplicaRouter(('replica',))]
+        self.user = User.objects.create_user('test', password='test')
+        self.user.user_permissions.add(*Permission.objects.filter(
+            content_type__app_label='PhotoManager'))
+        self.album = Album.objects.create(
+            title='Stale', description='', author=self.user)
+        self.client.login(username='test', password='test')
+        self.replicate(self.user, self.album, *Session.objects.all())
+        Album.objects.filter(pk=self.album.pk).update(title='Fresh')
+
+    def tearDown(self):
+        db.router.routers = self.routers
+
+    def replicate(self, *objects):
+        for obj in objects:
+            obj.save(using='replica')
+
+    def test_reads_from_replica(self):
+        """Assert that the album page is read from the replica."""
+        response = self.client.get('/pm/album/{}'.format(self.album.pk))
+        self.assertEqual(response.context['album'].title, 'Stale')
+
+    def test_reads_own_writes(self):
+        """Assert that after modifying an album, the user is shown it from
+        the primary, until the stickiness wears off.
+        """
+        response = self.client.post(
+            '/pm/album/modify/{}'.format(self.album.pk),
+            {'title': 'Modified', 'description': ''}, follow=True)
+        self.assertEqual(response.context['album'].title, 'Modified')
+        del self.client.cookies[routers.REPLICA_COOKIE]
+        response = self.client.get('/pm/album/{}'.format(self.album.pk))
+        self.assertEqual(response.context['album'].title, 'Stale')
+
+
+class FakeConnection(object):
+    """Stands in for a database connection in the health check tests."""
+    def __init__(self, usable):
+        self.connection = object()
+        self.usable = usable
+
+    def is_usable(self):
+        return self.usable
+
+    def close(self):
+        self.connection = None
+
+
+class TestConnectionHealth(TestCase):
+    """Test the health checks of persistent database connections."""
+    def test_close_unusable(self):
+        """Assert that unusable connections are closed, and usable ones
+        kept.
+        """
+        good, bad = FakeConnection(True), FakeConnection(False)
+        check_connections([good, bad])
+        self.assertIsNotNone(good.connection)
+        self.assertIsNone(bad.connection)
+
+    def test_skip_recently_used(self):
+        """Assert that connections used recently aren't checked."""
+        bad = FakeConnection(False)
+        mark_connections_used([bad])
+        check_connections([bad])
+        self.assertIsNotNone(bad.connection)
+        bad.last_used -= 3600
+        check_connections([bad])
+        self.assertIsNone(bad.connection)
+
+
+class TestWarmUp(TestCase):
+    """Test the warm-up of new worker processes."""
+    def test_warm_up(self):
+        """Warm up a fresh handler, and assert that its middleware is
+        loaded and its database connection opened.
+        """
+        handler = WSGIHandler()
+        timings = warm_up(handler)
+        self.assertEqual(timings.keys(), [
+            'import_views', 'compile_templates', 'open_connections',
+            'prime_caches'])
+        self.assertIsNotNone(handler._request_middleware)
+        self.assertIsNotNone(connection.connection)
+        self.assertIsNot(default.kvstore._wrapped, empty)
+
+    def test_template_names(self):
+        """Assert that the app's templates are found."""
+        names = get_template_names()
+        self.assertIn('PhotoManager/album.html', names)
+        self.assertIn('PhotoManager/homepage.html', names)
+
+
+class TestCompileTemplates(TestCase):
+    """Test the compile_templates management command."""
+    def setUp(self):
+        """Make a template directory to hold broken templates."""
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def write_template(self, name, content):
+        with open(os.path.join(self.directory, name), 'w') as f:
+            f.write(content)
+
+    def test_compile_templates(self):
+        """Assert that the app's own templates all compile."""
+        out = StringIO()
+        call_command('compile_templates', stdout=out)
+        self.assertIn('Compiled', out.getvalue())
+
+    def test_broken_templates(self):
+        """Assert that syntax errors, and extending or including missing
+        templates, are caught.
+        """
+        self.write_template('syntax.html', '{% if %}{% endif %}')
+        self.write_template('extends.html', '{% extends "missing.html" %}')
+        self.write_template('include.html', '{% include "missing.html" %}')
+        with self.settings(TEMPLATE_DIRS=(self.directory,)):
+            self.assertRaises(
+                TemplateSyntaxError, check_template, 'syntax.html')
+            self.assertRaises(
+                TemplateDoesNotExist, check_template, 'extends.html')
+            self.assertRaises(
+                TemplateDoesNotExist, check_template, 'include.html')
+            self.assertRaises(
+                CommandError, call_command, 'compile_templates', all=True)
+
+    def test_template_loaders(self):
+        """Assert that templates are cached by settings that turn DEBUG
+        off after importing the default settings, and not while debugging.
+        """
+        from PhotoApp import bench_settings
+        self.assertEqual(bench_settings.TEMPLATE_LOADERS, (
+            ('django.template.loaders.cached.Loader', TEMPLATE_LOADERS),))
+        self.assertEqual(get_template_loaders(True), TEMPLATE_LOADERS)
+
+
+class TestStaticBuild(TestCase):
+    """Test the fingerprinted, precompressed static asset build."""
+    def setUp(self):
+        """Make a small tree of assets to build."""
+        self.source = tempfile.mkdtemp()
+        self.destination = tempfile.mkdtemp()
+        self.build_root = assets.STATIC_BUILD_ROOT
+        os.makedirs(os.path.join(self.source, 'css'))
+        os.makedirs(os.path.join(self.source, 'fonts'))
+        with open(os.path.join(self.source, 'fonts', 'icons.ttf'), 'w') as f:
+            f.write('font' * 100)
+        with open(os.path.join(self.source, 'css', 'site.css'), 'w') as f:
+            f.write(
+                "@font-face{src:url('../fonts/icons.ttf?#iefix')}"
+                "a{background:url(data:image/gif;base64,R0lG)}" * 20)
+
+    def tearDown(self):
+        assets.STATIC_BUILD_ROOT = self.build_root
+        rmtree(self.source)
+        rmtree(self.destination)
+
+    def test_build(self):
+        """Assert that assets are copied under fingerprinted names, with
+        gzipped variants, and that stylesheets refer to the fingerprinted
+        names.
+        """
+        manifest = assets.build(self.source, self.destination)
+        self.assertRegexpMatches(
+            manifest['css/site.css'], r'^css/site\.[0-9a-f]{12}\.css$')
+        font = manifest['fonts/icons.ttf']
+        with open(os.path.join(self.destination, manifest['css/site.css'])) \
+                as f:
+            css = f.read()
+        self.assertIn("url('../%s?#iefix')" % font, css)
+        self.assertIn('url(data:image/gif;base64,R0lG)', css)
+        with gzip.open(os.path.join(
+                self.destination, font + '.gz')) as f:
+            self.assertEqual(f.read(), 'font' * 100)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.destination, 'css', 'site.css')))
+
+    def test_nginx_config(self):
+        """Assert that the nginx configuration serves precompressed assets,
+        and caches fingerprinted names forever.
+        """
+        config = assets.render_nginx_config(self.destination, '/static/')
+        self.assertIn('alias %s/;' % self.destination, config)
+        self.assertIn('gzip_static on;', config)
+        self.assertIn('max-age=31536000, immutable', config)
+
+    def test_storage(self):
+        """Assert that the storage serves the fingerprinted names of built
+        assets, and the names of the rest unchanged, even while debugging.
+        """
+        manifest = assets.build(self.source, self.destination)
+        assets.STATIC_BUILD_ROOT = self.destination
+        with self.settings(DEBUG=True):
+            storage = assets.ManifestStaticFilesStorage()
+            self.assertEqual(storage.url('css/site.css'),
+                             '/static/' + manifest['css/site.css'])
+            self.assertEqual(
+                storage.url('css/other.css'), '/static/css/other.css')
+
+    def test_storage_without_manifest(self):
+        """Assert that turning the manifest off serves every asset under
+        its own name, however DEBUG is set.
+        """
+        assets.build(self.source, self.destination)
+        assets.STATIC_BUILD_ROOT = self.destination
+        assets.STATIC_MANIFEST = False
+        try:
+            with self.settings(DEBUG=False):
+                storage = assets.ManifestStaticFilesStorage()
+                self.assertEqual(
+                    storage.url('css/site.css'), '/static/css/site.css')
+        finally:
+            assets.STATIC_MANIFEST = True
+
+
+class TestPermissionCache(TestCase):
+    """Test the caching of users' permissions between requests."""
+    def setUp(self):
+        """Create a user whose permissions come from a group."""
+        self.group = Group.objects.create(name='Editors')
+        self.group.permissions.add(*Permission.objects.filter(
+            content_type__app_label='PhotoManager'))
+        self.user = User.objects.create_user('test', password='test')
+        self.user.groups.add(self.group)
+        self.album = Album.objects.create(
+            title='Cached', description='', author=self.user)
+        self.url = '/pm/album/modify/{}'.format(self.album.pk)
+        self.client.login(username='test', password='test')
+
+    def test_cached_between_requests(self):
+        """Assert that a second request checks the user's permissions
+        without querying them.
+        """
+        with CaptureQueriesContext(connection) as first:
+            self.assertEqual(self.client.get(self.url).status_code, 200)
+        with CaptureQueriesContext(connection) as second:
+            self.assertEqual(self.client.get(self.url).status_code, 200)
+        permission_queries = [
+            query['sql'] for query in second.captured_queries
+            if 'auth_permission' in query['sql']]
+        self.assertEqual(permission_queries, [])
+        self.assertLess(
+            len(second.captured_queries), len(first.captured_queries))
+
+    def test_group_change(self):
+        """Assert that removing the user from their group, or removing the
+        group's permissions, takes effect on the next request.
+        """
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.user.groups.remove(self.group)
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        self.user.groups.add(self.group)
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.group.permissions.clear()
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    def test_ownership_check(self):
+        """Assert that checking an album's owner doesn't load the owner."""
+        with CaptureQueriesContext(connection) as context:
+            self.client.get('/pm/album/{}'.format(self.album.pk))
+        user_queries = [
+            query['sql'] for query in context.captured_queries
+            if 'FROM "auth_user"' in query['sql']]
+        self.assertEqual(len(user_queries), 1)
+
+
+class TestAlbumDownload(TestCase):
+    """Test streaming an album's originals as a ZIP file."""
+    def setUp(self):
+        self.user = User.objects.create_user('test', password='test')
+        self.album = Album.objects.create(
+            title='Summer 2014', description='', author=self.user)
+        for i in range(2):
+            photo = Photo(author=self.user, image=File(open('test_image.jpg')))
+            photo.save()
+            self.album.add_photos(photo)
+        self.url = '/pm/album/{}/download'.format(self.album.pk)
+        self.client.login(username='test', password='test')
+
+    def tearDown(self):
+        zipstream.set_heartbeat(None)
+        zipstream.ZIP64_LIMIT = 0xFFFFFFFF
+        for photo in Photo.objects.filter(author=self.user):
+            photo.image.delete(save=False)
+
+    def download(self, **headers):
+        response = self.client.get(self.url, **headers)
+        return response, ''.join(response.streaming_content)
+
+    def assertArchive(self, content):
+        archive = zipfile.ZipFile(StringIO(content))
+        self.assertIsNone(archive.testzip())
+        with open('test_image.jpg', 'rb') as f:
+            original = f.read()
+        for info, photo in zip(archive.infolist(),
+                               self.album.photos.order_by('pk')):
+            self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(
+                info.filename, '%d-%s' % (
+                    photo.pk, os.path.basename(photo.image.name)))
+            self.assertEqual(archive.read(info), original)
+
+    def test_download(self):
+        """Download an album and assert that the archive holds each of its
+        photos' originals, and is as long as it was said to be.
+        """
+        response, content = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        self.assertEqual(int(response['Content-Length']), len(content))
+        self.assertIn('filename="summer-2014.zip"',
+                      response['Content-Disposition'])
+        self.assertArchive(content)
+
+    def test_checksums_recorded(self):
+        """Assert that uploading a photo records its checksums, and that a
+        download works them out for photos without them.
+        """
+        photo = Photo(author=self.user, image=File(open('test_image.jpg')))
+        photo.save()
+        process_photo(photo)
+        photo = Photo.objects.get(pk=photo.pk)
+        with open('test_image.jpg', 'rb') as f:
+            original = f.read()
+        self.assertEqual(photo.image_size, len(original))
+        self.assertEqual(photo.image_crc32, zlib.crc32(original) & 0xFFFFFFFF)
+
+        self.assertTrue(Photo.objects.filter(
+            album=self.album, image_crc32=None).exists())
+        self.assertArchive(self.download()[1])
+        self.assertFalse(Photo.objects.filter(
+            album=self.album, image_crc32=None).exists())
+
+    def test_resume(self):
+        """Resume a download part way through, and assert that the rest of
+        the archive is sent, unless the album has changed since.
+        """
+        response, content = self.download()
+        etag = response['ETag']
+        response, rest = self.download(
+            HTTP_RANGE='bytes=1000-', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 1000-%d/%d' % (
+            len(content) - 1, len(content)))
+        self.assertEqual(content[:1000] + rest, content)
+
+        response, part = self.download(HTTP_RANGE='bytes=10-19')
+        self.assertEqual(part, content[10:20])
+
+        self.album.remove_photos(self.album.photos.all()[0])
+        response, changed = self.download(
+            HTTP_RANGE='bytes=1000-', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertArchive(changed)
+
+    def test_unsatisfiable_range(self):
+        """Assert that a range past the end of the archive is refused."""
+        response, content = self.download()
+        response = self.client.get(
+            self.url, HTTP_RANGE='bytes=%d-' % len(content))
+        self.assertEqual(response.status_code, 416)
+
+    def test_zip64(self):
+        """Assert that archives past the classic format's limits use its
+        ZIP64 extensions, by lowering those limits.
+        """
+        zipstream.ZIP64_LIMIT = 1000
+        self.assertArchive(self.download()[1])
+
+    def test_heartbeat(self):
+        """Assert that the worker is kept alive while the archive streams."""
+        beats = []
+        zipstream.set_heartbeat(lambda: beats.append(None))
+        self.download()
+        self.assertGreaterEqual(len(beats), 2)
+
+    def test_heartbeat_while_checksumming(self):
+        """Assert that the worker is kept alive while the checksums of
+        photos uploaded before they were recorded are worked out, before
+        the archive's first byte is sent.
+        """
+        beats = []
+        zipstream.set_heartbeat(lambda: beats.append(None))
+        zipstream.get_entries(self.album)
+        self.assertGreaterEqual(len(beats), 2)
+
+    def test_wrong_user(self):
+        """Try to download another user's album."""
+        User.objects.create_user('other', password='other')
+        self.client.login(username='other', password='other')
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+
+class TestBackups(TestCase):
+    """Test backing up and restoring the library."""
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.user = User.objects.create_user('test', password='test')
+        self.user.groups.add(Group.objects.create(name='Members'))
+        self.tag = Tag.objects.create(text='beach')
+        self.album = Album.objects.create(
+            title='Backed up', description='', author=self.user)
+        for i in range(2):
+            photo = Photo(author=self.user, image=File(open('test_image.jpg')))
+            photo.save()
+            photo.tags.add(self.tag)
+            self.album.add_photos(photo)
+        self.names = sorted(
+            Photo.objects.values_list('image', flat=True))
+
+    def tearDown(self):
+        rmtree(self.root)
+        for name in self.names:
+            default_storage.delete(name)
+
+    def get_blobs(self):
+        return [name for directory, dirs, files in
+                os.walk(os.path.join(self.root, 'blobs')) for name in files]
+
+    def test_backup_and_restore(self):
+        """Back up the library, delete it, and assert that restoring the
+        backup brings back its rows, relations and files.
+        """
+        call_command('backup_library', self.root, stdout=StringIO())
+        Album.objects.all().delete()
+        Photo.objects.all().delete()
+        Tag.objects.all().delete()
+        User.objects.all().delete()
+        for name in self.names:
+            default_storage.delete(name)
+
+        call_command('restore_library', self.root, stdout=StringIO())
+        album = Album.objects.get(title='Backed up')
+        self.assertEqual(album.author.username, 'test')
+        self.assertTrue(album.author.check_password('test'))
+        self.assertEqual(
+            [group.name for group in album.author.groups.all()], ['Members'])
+        self.assertEqual(
+            sorted(photo.image.name for photo in album.photos.all()),
+            self.names)
+        self.assertEqual(Tag.objects.get().photo_set.count(), 2)
+        with open('test_image.jpg', 'rb') as f:
+            original = f.read()
+        for name in self.names:
+            self.assertEqual(default_storage.open(name).read(), original)
+
+    def test_restore_quota(self):
+        """Assert that a user's own limits survive a restore, and that
+        their usage is recounted from the restored photos.
+        """
+        Usage.objects.filter(pk=self.user.pk).update(
+            max_bytes=10 ** 9, max_photos=5, bytes=1, photos=100)
+        backups.backup(self.root)
+        User.objects.all().delete()
+        backups.restore(self.root, backups.load_manifest(self.root))
+        usage = Usage.objects.get(pk=self.user.pk)
+        self.assertEqual((usage.max_bytes, usage.max_photos), (10 ** 9, 5))
+        self.assertEqual(
+            (usage.bytes, usage.photos),
+            (sum(Photo.objects.values_list('image_size', flat=True)), 2))
+
+    def test_restore_pyramids(self):
+        """Assert that photos are restored without pyramids that aren't in
+        storage, so that they are built again, and keep the ones that are.
+        """
+        kept, lost = Photo.objects.order_by('pk')
+        dzi = default_storage.save('deepzoom/test/kept.dzi', ContentFile(''))
+        try:
+            Photo.objects.filter(pk=kept.pk).update(deep_zoom=dzi)
+            Photo.objects.filter(pk=lost.pk).update(
+                deep_zoom='deepzoom/test/lost.dzi')
+            backups.backup(self.root)
+            Photo.objects.all().delete()
+            backups.restore(self.root, backups.load_manifest(self.root))
+            self.assertEqual(Photo.objects.get(pk=kept.pk).deep_zoom, dzi)
+            self.assertEqual(Photo.objects.get(pk=lost.pk).deep_zoom, '')
+        finally:
+            default_storage.delete(dzi)
+
+    def test_incremental(self):
+        """Assert that blobs are stored once per distinct content, and
+        that a second backup only copies the photos added since the first.
+        """
+        self.assertEqual(backups.backup(self.root)[1], 2)
+        # Both photos are the same image; the rows make the other blob.
+        self.assertEqual(len(self.get_blobs()), 2)
+        self.assertEqual(backups.backup(self.root)[1], 0)
+
+        photo = Photo(author=self.user, image=File(open('test_image.jpg')))
+        photo.save()
+        self.names.append(photo.image.name)
+        name, copied = backups.backup(self.root)
+        self.assertEqual(copied, 1)
+        self.assertEqual(len(backups.get_manifest_names(self.root)), 3)
+        self.assertEqual(len(backups.load_manifest(self.root)['files']), 3)
+
+    def test_corrupt_blob(self):
+        """Corrupt a blob of a backup and assert that restoring it fails
+        without changing anything.
+        """
+        backups.backup(self.root)
+        manifest = backups.load_manifest(self.root)
+        digest = manifest['files'][self.names[0]]['sha256']
+        with open(backups.get_blob_path(self.root, digest), 'ab') as f:
+            f.write('corrupt')
+        Photo.objects.all().delete()
+        with self.assertRaisesRegexp(CommandError, digest):
+            call_command('restore_library', self.root, verify_only=True)
+        with self.assertRaises(CommandError):
+            call_command('restore_library', self.root, stdout=StringIO())
+        self.assertFalse(Photo.objects.exists())
+
+
+class TestGalleryExport(TestCase):
+    """Test exporting an album as a static site."""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.user = User.objects.create_user('test', password='test')
+        self.album = Album.objects.create(
+            title='Gallery', description='Public photos', author=self.user)
+        self.photos = []
+        for i in range(3):
+            self.photos.append(self.add_photo())
+
+    def tearDown(self):
+        rmtree(self.directory)
+        for photo in Photo.objects.filter(author=self.user):
+            photo.image.delete(save=False)
+
+    def add_photo(self):
+        photo = Photo(author=self.user, image=File(open('test_image.jpg')),
+                      description='Photo %d' % Photo.objects.count())
+        photo.save()
+        self.album.add_photos(photo)
+        return photo
+
+    def export(self):
+        out = StringIO()
+        call_command('export_gallery', str(self.album.pk), self.directory,
+                     stdout=out)
+        return galleries.load_state(self.directory)
+
+    def read(self, name):
+        with open(os.path.join(self.directory, name)) as f:
+            return f.read()
+
+    def test_export(self):
+        """Export an album and assert that the grid links to every photo's
+        page, and that each page shows its photo's display rendition.
+        """
+        self.export()
+        index = self.read('index.html')
+        self.assertIn('Public photos', index)
+        for photo in self.photos:
+            self.assertIn('href="photos/%d.html"' % photo.pk, index)
+            self.assertIn('src="images/%d-thumbnail.jpg"' % photo.pk, index)
+            page = self.read('photos/%d.html' % photo.pk)
+            self.assertIn('src="../images/%d.jpg"' % photo.pk, page)
+            self.assertIn(photo.description, page)
+            Image.open(os.path.join(
+                self.directory, 'images', '%d.jpg' % photo.pk)).verify()
+        self.assertNotIn('Previous', self.read(
+            'photos/%d.html' % self.photos[0].pk))
+        self.assertIn('href="%d.html">Next' % self.photos[1].pk, self.read(
+            'photos/%d.html' % self.photos[0].pk))
+
+    def test_incremental(self):
+        """Assert that exporting again only rewrites the files of photos
+        that have changed, and removes those of photos that have left.
+        """
+        self.export()
+        written, removed, skipped = galleries.export_album(
+            self.album, self.directory)
+        self.assertEqual((written, removed), ([], []))
+
+        self.photos[1].description = 'Changed'
+        self.photos[1].save()
+        written, removed, skipped = galleries.export_album(
+            self.album, self.directory)
+        self.assertEqual(written, ['photos/%d.html' % self.photos[1].pk])
+
+        photo = self.add_photo()
+        written, removed, skipped = galleries.export_album(
+            self.album, self.directory)
+        self.assertEqual(sorted(written), sorted([
+            'images/%d-thumbnail.jpg' % photo.pk, 'images/%d.jpg' % photo.pk,
+            'index.html', 'photos/%d.html' % photo.pk,
+            'photos/%d.html' % self.photos[2].pk]))
+
+        self.album.remove_photos(photo)
+        written, removed, skipped = galleries.export_album(
+            self.album, self.directory)
+        self.assertEqual(sorted(removed), sorted([
+            'images/%d-thumbnail.jpg' % photo.pk, 'images/%d.jpg' % photo.pk,
+            'photos/%d.html' % photo.pk]))
+        self.assertFalse(os.path.exists(os.path.join(
+            self.directory, 'photos', '%d.html' % photo.pk)))
+
+
+class TestSharedAlbums(TestCase):
+    """Test sharing albums through public links that caches can serve."""
+    def setUp(self):
+        self.user = User.objects.create_user('test', password='test')
+        self.user.user_permissions.add(
+            Permission.objects.get(codename='change_album'))
+        self.album = Album.objects.create(
+            title='Shared', description='For everyone', author=self.user)
+        self.photo = Photo.objects.create(
+            author=self.user, image=File(open('test_image.jpg')),
+            description='A shared photo')
+        self.album.add_photos(self.photo)
+        self.client.login(username='test', password='test')
+        self.share_url = '/pm/album/{}/share'.format(self.album.pk)
+        self.purged = []
+        self.urlopen = urllib2.urlopen
+        urllib2.urlopen = lambda url, timeout: self.purged.append(url)
+
+    def tearDown(self):
+        urllib2.urlopen = self.urlopen
+        sharing.SHARE_PURGE_URLS = ()
+        default_storage.delete(self.photo.image.name)
+
+    def share(self):
+        self.client.post(self.share_url, {'share': '1'})
+        self.album = Album.objects.get(pk=self.album.pk)
+        return '/pm/shared/{}/'.format(self.album.share_token)
+
+    def assertPublic(self, response):
+        self.assertEqual(response.status_code, 200)
+        cache_control = response['Cache-Control']
+        self.assertIn('public', cache_control)
+        self.assertIn('s-maxage=%d' % sharing.SHARE_CACHE_MAX_AGE,
+                      cache_control)
+        self.assertIn('album-%d' % self.album.pk, response['Surrogate-Key'])
+        self.assertNotIn('Cookie', response.get('Vary', ''))
+        self.assertEqual(response.cookies.keys(), [])
+
+    def test_share_and_revoke(self):
+        """Share an album, assert that its page shows the link, and that
+        the link stops working once sharing is turned off.
+        """
+        url = self.share()
+        self.assertEqual(len(self.album.share_token), 32)
+        response = self.client.get('/pm/album/{}'.format(self.album.pk))
+        self.assertIn('http://testserver' + url, response.content)
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        self.client.post(self.share_url)
+        self.assertIsNone(Album.objects.get(pk=self.album.pk).share_token)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_share_wrong_user(self):
+        """Try to share another user's album."""
+        other = User.objects.create_user('other', password='other')
+        other.user_permissions.add(
+            Permission.objects.get(codename='change_album'))
+        self.client.login(username='other', password='other')
+        response = self.client.post(self.share_url, {'share': '1'})
+        self.assertEqual(response.status_code, 403)
+        self.assertIsNone(Album.objects.get(pk=self.album.pk).share_token)
+
+    def test_anonymous_and_cacheable(self):
+        """Assert that shared pages are the same for anonymous and logged
+        in visitors, and can be kept by any cache.
+        """
+        url = self.share()
+        photo_url = url + 'photo/{}'.format(self.photo.pk)
+        for client in (self.client, Client()):
+            response = client.get(url)
+            self.assertPublic(response)
+            self.assertIn('For everyone', response.content)
+            self.assertIn(photo_url, response.content)
+            response = client.get(photo_url)
+            self.assertPublic(response)
+            self.assertIn('A shared photo', response.content)
+            self.assertIn('photo-%d' % self.photo.pk,
+                          response['Surrogate-Key'])
+
+    def test_large_album(self):
+        """Share an album of several hundred photos, and assert that its
+        page's headers stay small enough for nginx and CDNs to take.
+        """
+        self.album.add_photos(*[
+            Photo.objects.create(author=self.user, image=self.photo.image.name)
+            for i in range(400)])
+        response = Client().get(self.share())
+        self.assertPublic(response)
+        self.assertEqual(response['Surrogate-Key'], 'album-%d' % self.album.pk)
+        self.assertLess(len(str(response.serialize_headers())), 1024)
+
+    def test_photo_outside_album(self):
+        """Assert that a link only reaches the photos of its album."""
+        url = self.share()
+        other = Photo.objects.create(
+            author=self.user, image=self.photo.image.name)
+        self.assertEqual(
+            Client().get(url + 'photo/{}'.format(other.pk)).status_code, 404)
+        self.assertEqual(
+            Client().get('/pm/shared/nosuchtoken/').status_code, 404)
+
+    def test_purge(self):
+        """Assert that changing a shared album, or its photos, purges its
+        pages from the caches, and that revoking its link purges the
+        pages shared under the old token.
+        """
+        sharing.SHARE_PURGE_URLS = ('http://cache/purge',)
+        url = self.share()
+        expected = 'http://cache/purge%s*' % url
+        self.assertEqual(self.purged, [expected])
+
+        changes = [
+            lambda: setattr(self.album, 'title', 'Renamed') or
+            self.album.save(),
+            lambda: self.album.remove_photos(self.photo),
+            lambda: self.album.add_photos(self.photo),
+            lambda: setattr(self.photo, 'description', 'Changed') or
+            self.photo.save(),
+            lambda: self.album.clear_photos(),
+        ]
+        for change in changes:
+            del self.purged[:]
+            change()
+            self.assertEqual(self.purged, [expected])
+
+        self.album.add_photos(self.photo)
+        del self.purged[:]
+        self.photo.delete()
+        self.assertEqual(self.purged, [expected])
+
+        del self.purged[:]
+        self.client.post(self.share_url)
+        self.assertEqual(self.purged, [expected])
+
+
+class TestMediaGC(TestCase):
+    """Test collecting the files in storage that nothing refers to."""
+    def setUp(self):
+        # The files of fixtures are orphans here, so keep clear of their
+        # author's directory.
+        self.user = User.objects.create(pk=4242, username='test')
+        self.kept = Photo.objects.create(
+            author=self.user, image=File(open('test_image.jpg')))
+        self.deleted = Photo.objects.create(
+            author=self.user, image=File(open('test_image.jpg')))
+        # Thumbnails recorded by earlier tests are still in the cache.
+        for photo in (self.kept, self.deleted):
+            delete(photo.image, delete_file=False)
+        self.thumbnails = [
+            [thumbnail.name for thumbnail in generate_renditions(
+                photo.image, sizes=('100x100',))]
+            for photo in (self.kept, self.deleted)]
+        self.deleted.delete()
+        self.stray = default_storage.save(
+            '%d/stray.jpg' % self.user.pk, ContentFile('stray'))
+        self.get_media_directories = orphans.get_media_directories
+
+    def tearDown(self):
+        orphans.get_media_directories = self.get_media_directories
+        for name in sum(self.thumbnails, []):
+            default_storage.delete(name)
+        rmtree(os.path.join(settings.MEDIA_ROOT, str(self.user.pk)),
+               ignore_errors=True)
+
+    def get_orphans(self, min_age=None):
+        return list(orphans.find_orphans(
+            orphans.find_references()[0], min_age=min_age))
+
+    def test_find_orphans(self):
+        """Assert that the originals and thumbnails of deleted photos, and
+        files no photo was saved for, are found, and that the files of
+        existing photos aren't.
+        """
+        found = self.get_orphans()
+        for name in [self.deleted.image.name, self.stray] + \
+                self.thumbnails[1]:
+            self.assertIn(name, found)
+        for name in [self.kept.image.name] + self.thumbnails[0]:
+            self.assertNotIn(name, found)
+        self.assertEqual(
+            self.get_orphans(timedelta(hours=1)), [])
+
+    def test_stale_keys(self):
+        """Assert that the key-value store's entries for a deleted photo
+        are found, and those of an existing one aren't.
+        """
+        stale_keys = orphans.find_references()[1]
+        prefix = orphans.get_kv_prefix('thumbnails')
+        self.assertIn(prefix + ImageFile(self.deleted.image).key, stale_keys)
+        self.assertNotIn(prefix + ImageFile(self.kept.image).key, stale_keys)
+
+    def test_gc_media(self):
+        """Run the command, first as a dry run, and assert that it only
+        deletes orphans old enough to collect.
+        """
+        # Keep to the files this test made.
+        orphans.get_media_directories = lambda storage: [str(self.user.pk)]
+        out = StringIO()
+        call_command('gc_media', dry_run=True, min_age=0, stdout=out)
+        self.assertIn('Would delete 2 orphaned files', out.getvalue())
+        self.assertTrue(default_storage.exists(self.stray))
+        self.assertTrue(default_storage.exists(self.deleted.image.name))
+
+        call_command('gc_media', stdout=StringIO())
+        self.assertTrue(default_storage.exists(self.stray))
+
+        out = StringIO()
+        call_command('gc_media', min_age=0, batch_size=1, stdout=out)
+        self.assertIn('Deleted 2 orphaned files', out.getvalue())
+        self.assertFalse(default_storage.exists(self.stray))
+        self.assertFalse(default_storage.exists(self.deleted.image.name))
+        self.assertTrue(default_storage.exists(self.kept.image.name))
+        self.assertEqual(orphans.find_references()[1], [])
+
+
+class TestUploadLayouts(TestCase):
+    """Test laying out uploaded originals in storage, and moving existing
+    ones to a new layout.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user('test', password='test')
+        with open('test_image.jpg', 'rb') as f:
+            self.digest = hashlib.sha256(f.read()).hexdigest()
+        self.photos = []
+
+    def tearDown(self):
+        uploads.UPLOAD_LAYOUT = 'author'
+        for photo in Photo.objects.filter(pk__in=self.photos):
+            delete(photo.image)
+
+    def upload(self):
+        photo = Photo.objects.create(
+            author=self.user, image=File(open('test_image.jpg')))
+        self.photos.append(photo.pk)
+        return photo
+
+    def test_layouts(self):
+        """Assert that uploads are named for the hash of their contents
+        under the sharded layouts.
+        """
+        uploads.UPLOAD_LAYOUT = 'hash'
+        name = self.upload().image.name
+        self.assertEqual(name, 'photos/%s/%s/%s.jpg' % (
+            self.digest[:2], self.digest[2:4], self.digest))
+        self.assertTrue(uploads.is_laid_out(name, 'hash'))
+        self.assertFalse(uploads.is_laid_out(name, 'date'))
+
+        uploads.UPLOAD_LAYOUT = 'date'
+        name = self.upload().image.name
+        self.assertEqual(name, datetime.now().strftime(
+            'photos/%Y/%m/%d/') + self.digest + '.jpg')
+        self.assertTrue(uploads.is_laid_out(name, 'date'))
+
+    def test_identical_uploads_share_a_file(self):
+        """Upload the same photo twice under the hash layout, and assert
+        that both photos share one file rather than the second being saved
+        under another name.
+        """
+        uploads.UPLOAD_LAYOUT = 'hash'
+        first, second = self.upload().image.name, self.upload().image.name
+        self.assertEqual(first, second)
+        self.assertTrue(uploads.is_laid_out(second, 'hash'))
+        directory, name = os.path.split(first)
+        self.assertEqual(default_storage.listdir(directory)[1], [name])
+
+    def test_relocate(self):
+        """Move photos to the hash layout, and assert that they point at
+        copies of their originals, which are shared by identical photos,
+        and that the old files and their thumbnails are gone.
+        """
+        photos = [self.upload(), self.upload()]
+        old_names = [photo.image.name for photo in photos]
+        thumbnail = get_thumbnail(photos[0].image, '100x100')
+        out = StringIO()
+        call_command('relocate_uploads', layout='hash', workers=2,
+                     batch_size=1, stdout=out)
+        self.assertIn('Moved 2 photos to the hash layout', out.getvalue())
+        names = [Photo.objects.get(pk=pk).image.name for pk in self.photos]
+        self.assertEqual(names[0], names[1])
+        self.assertTrue(uploads.is_laid_out(names[0], 'hash'))
+        with default_storage.open(names[0]) as f:
+            self.assertEqual(hashlib.sha256(f.read()).hexdigest(),
+                             self.digest)
+        for name in old_names + [thumbnail.name]:
+            self.assertFalse(default_storage.exists(name))
+
+        out = StringIO()
+        call_command('relocate_uploads', layout='hash', stdout=out)
+        self.assertIn('Moved 0 photos', out.getvalue())
+        self.assertRaises(CommandError, call_command, 'relocate_uploads',
+                          layout='flat', stdout=StringIO())
+
+
+class TestQuotas(TestCase):
+    """Test users' storage quotas, and the running totals they're checked
+    against.
+    """
+    fixtures = ['test_auth.json', 'test_photo_manager.json']
+
+    def setUp(self):
+        self.client.login(username='django', password='djangopass')
+        self.user = User.objects.get(username='django')
+        self.album = Album.objects.get(title='Test Album')
+        self.size = os.path.getsize('test_image.jpg')
+        self.photos = []
+
+    def tearDown(self):
+        quotas.QUOTA_BYTES = quotas.QUOTA_PHOTOS = None
+        for photo in Photo.objects.filter(description='Quota Test Photo'):
+            delete(photo.image)
+        for photo in self.photos:
+            default_storage.delete(photo.image.name)
+
+    def upload(self):
+        return self.client.post('/pm/photo/create', {
+            'description': 'Quota Test Photo',
+            'image': File(open('test_image.jpg')),
+            'album': self.album.pk,
+        })
+
+    def get_usage(self):
+        usage = Usage.objects.get(pk=self.user.pk)
+        return usage.bytes, usage.photos
+
+    def test_running_totals(self):
+        """Assert that photos are added to, and taken off, their author's
+        usage as they're created and deleted.
+        """
+        for i in range(2):
+            self.photos.append(Photo.objects.create(
+                author=self.user, image=File(open('test_image.jpg'))))
+        self.assertEqual(self.get_usage(), (2 * self.size, 2))
+        self.photos[0].delete()
+        self.assertEqual(self.get_usage(), (self.size, 1))
+
+    def test_upload(self):
+        """Upload a photo, and assert that it's counted once."""
+        self.assertEqual(self.upload().status_code, 302)
+        self.assertEqual(self.get_usage(), (self.size, 1))
+        response = self.client.get('/pm/album/modify/{}'.format(
+            self.album.pk))
+        self.assertIn('You have 1 photo,', response.content)
+
+    def test_over_quota(self):
+        """Assert that uploads past either limit are refused, by the
+        default limits or a user's own, and that nothing is stored.
+        """
+        # Room for the photo, and the rest of the request it comes in.
+        quotas.QUOTA_BYTES = self.size + 1024
+        self.assertEqual(self.upload().status_code, 302)
+        response = self.upload()
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('You may store at most', response.content)
+
+        Usage.objects.filter(pk=self.user.pk).update(max_photos=1)
+        quotas.QUOTA_BYTES = None
+        self.assertEqual(self.upload().status_code, 413)
+        self.assertEqual(self.get_usage(), (self.size, 1))
+        self.assertEqual(
+            Photo.objects.filter(description='Quota Test Photo').count(), 1)
+
+    def test_upload_filling_quota(self):
+        """Upload a photo that exactly fills the room left, and assert
+        that the rest of the form doesn't get it refused.
+        """
+        quotas.QUOTA_BYTES = self.size
+        self.assertEqual(self.upload().status_code, 302)
+        self.assertEqual(self.get_usage(), (self.size, 1))
+
+    def test_reserve(self):
+        """Assert that room is only reserved when there's enough of it."""
+        quotas.QUOTA_BYTES = 100
+        quotas.reserve(self.user.pk, 60)
+        self.assertRaises(
+            quotas.QuotaExceeded, quotas.reserve, self.user.pk, 60)
+        quotas.reserve(self.user.pk, 40)
+        self.assertEqual(self.get_usage(), (100, 2))
+
+    def test_reconcile(self):
+        """Throw the totals off, and assert that reconciling corrects
+        them from the photos.
+        """
+        self.photos.append(Photo.objects.create(
+            author=self.user, image=File(open('test_image.jpg'))))
+        Usage.objects.filter(pk=self.user.pk).update(bytes=5, photos=9)
+        out = StringIO()
+        call_command('reconcile_usage', stdout=out)
+        self.assertIn('Corrected the usage of', out.getvalue())
+        total = Photo.objects.filter(author=self.user).aggregate(
+            Sum('image_size'))['image_size__sum']
+        self.assertEqual(self.get_usage(), (
+            total, Photo.objects.filter(author=self.user).count()))
+        self.assertEqual(quotas.reconcile(), [])
+
+
+class TestAlbumOrder(TestCase):
+    """Test the order of the photos in an album, and moving them."""
+    def setUp(self):
+        self.user = User.objects.create_user('test', password='test')
+        self.user.user_permissions.add(
+            Permission.objects.get(codename='change_album'))
+        self.album = Album.objects.create(
+            title='Ordered', description='', author=self.user)
+        self.photos = [
+            Photo.objects.create(author=self.user, image='%d.jpg' % i)
+            for i in range(5)]
+        self.album.add_photos(*reversed(self.photos))
+        self.url = '/pm/album/{}/reorder'.format(self.album.pk)
+
+    def get_order(self):
+        return [self.photos.index(photo)
+                for photo in self.album.get_photos()]
+
+    def test_add_photos(self):
+        """Assert that photos are listed in the order they were added,
+        and that adding a photo again leaves it where it was.
+        """
+        self.assertEqual(self.get_order(), [4, 3, 2, 1, 0])
+        self.album.add_photos(self.photos[4])
+        self.album.set_photos(self.photos[1:])
+        self.assertEqual(self.get_order(), [4, 3, 2, 1])
+        other = Album.objects.create(
+            title='Other', description='', author=self.user)
+        other.add_photos(*self.photos)
+        self.assertEqual(self.get_order(), [4, 3, 2, 1])
+
+    def test_move_photo(self):
+        """Move photos around, and assert that each move only writes the
+        moved photo's row.
+        """
+        self.assertEqual(ordering.move_photo(
+            self.album, self.photos[0], self.photos[4]), 1)
+        self.assertEqual(self.get_order(), [4, 0, 3, 2, 1])
+        self.assertEqual(ordering.move_photo(
+            self.album, self.photos[1], None), 1)
+        self.assertEqual(self.get_order(), [1, 4, 0, 3, 2])
+        self.assertEqual(ordering.move_photo(
+            self.album, self.photos[1], self.photos[2]), 1)
+        self.assertEqual(self.get_order(), [4, 0, 3, 2, 1])
+        self.assertRaises(
+            AlbumPhoto.DoesNotExist, ordering.move_photo, self.album,
+            Photo.objects.create(author=self.user, image='other.jpg'))
+
+    def test_respace(self):
+        """Pack positions together, and assert that a move spreads out
+        only as many of the photos after it as it needs to.
+        """
+        for i, photo in enumerate(self.photos):
+            AlbumPhoto.objects.filter(photo=photo).update(position=i)
+        AlbumPhoto.objects.filter(photo=self.photos[4]).update(position=100)
+        written = ordering.move_photo(
+            self.album, self.photos[3], self.photos[0])
+        self.assertTrue(1 < written < 5)
+        self.assertEqual(self.get_order(), [0, 3, 1, 2, 4])
+        positions = list(AlbumPhoto.objects.filter(album=self.album).
+                         order_by('position').values_list('position',
+                                                          flat=True))
+        self.assertEqual(positions, sorted(set(positions)))
+        self.assertEqual(positions[-1], 100)
+
+    def test_reorder_view(self):
+        """Move a photo through the view, and assert that only the
+        album's owner can, and only with photos in the album.
+        """
+        self.client.login(username='test', password='test')
+        response = self.client.post(self.url, {
+            'photo': self.photos[4].pk, 'after': self.photos[0].pk})
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.get_order(), [3, 2, 1, 0, 4])
+        self.assertEqual(self.client.post(self.url, {
+            'photo': self.photos[4].pk, 'after': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url).status_code, 405)
+
+        other = User.objects.create_user('other', password='other')
+        other.user_permissions.add(
+            Permission.objects.get(codename='change_album'))
+        self.client.login(username='other', password='other')
+        self.assertEqual(self.client.post(self.url, {
+            'photo': self.photos[4].pk}).status_code, 403)
+
+
+class TestBatchPhotos(TestCase):
+    """Test applying one set of changes to many photos at once."""
+    def setUp(self):
+        self.user = User.objects.create_user('test', password='test')
+        self.user.user_permissions.add(*Permission.objects.filter(
+            codename__in=['change_photo', 'delete_photo', 'change_album']))
+        self.other = User.objects.create_user('other', password='other')
+        self.photos = [
+            Photo.objects.create(author=self.user, image='%d.jpg' % i)
+            for i in range(3)]
+        self.others_photo = Photo.objects.create(
+            author=self.other, image='other.jpg')
+        self.tags = [Tag.objects.create(text='trip'),
+                     Tag.objects.create(text='beach')]
+        self.album = Album.objects.create(
+            title='Trip', description='', author=self.user)
+        self.client.login(username='test', password='test')
+
+    def post(self, data):
+        return self.client.post('/pm/photo/batch', json.dumps(data),
+                                content_type='application/json')
+
+    def test_batch(self):
+        """Tag, describe and file a selection of photos in one request,
+        and assert that each photo's result is reported, and that only
+        the user's own photos are changed.
+        """
+        self.photos[0].tags.add(self.tags[1])
+        ids = [photo.pk for photo in self.photos]
+        response = self.post({
+            'photos': ids + [self.others_photo.pk, 9999],
+            'add_tags': [self.tags[0].pk],
+            'remove_tags': [self.tags[1].pk],
+            'description': 'At the beach',
+            'add_to_albums': [self.album.pk],
+        })
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.content)['results']
+        self.assertEqual([result['result'] for result in results], [
+            'updated', 'updated', 'updated', 'forbidden', 'not found'])
+        for photo in Photo.objects.filter(pk__in=ids):
+            self.assertEqual(photo.description, 'At the beach')
+            self.assertEqual(
+                list(photo.tags.values_list('text', flat=True)), ['trip'])
+        self.assertEqual([photo.pk for photo in self.album.get_photos()], ids)
+        self.assertEqual(Photo.objects.get(
+            pk=self.others_photo.pk).description, '')
+
+        self.post({'photos': ids[:1], 'remove_from_albums': [self.album.pk]})
+        self.assertEqual(
+            [photo.pk for photo in self.album.get_photos()], ids[1:])
+
+        # More ids than fit in one query.
+        response = self.post({
+            'photos': ids + range(10000, 11000), 'add_tags': [self.tags[1].pk],
+            'add_to_albums': [self.album.pk]})
+        self.assertEqual(len(json.loads(response.content)['results']), 1003)
+        self.assertEqual(Photo.objects.filter(tags=self.tags[1]).count(), 3)
+
+    def test_delete(self):
+        """Delete a selection of photos, and assert that they're gone from
+        their albums too.
+        """
+        self.album.add_photos(*self.photos)
+        response = self.post({
+            'photos': [photo.pk for photo in self.photos[:2]],
+            'delete': True})
+        self.assertEqual(
+            [result['result'] for result in
+             json.loads(response.content)['results']],
+            ['deleted', 'deleted'])
+        self.assertEqual(list(self.album.get_photos()), self.photos[2:])
+        self.assertEqual(Photo.objects.filter(author=self.user).count(), 1)
+
+    def test_delete_queries(self):
+        """Delete batches of 10 and of 40 shared photos, and assert that
+        both take the same number of queries, and that the photos come off
+        their author's usage.
+        """
+        Album.objects.filter(pk=self.album.pk).update(share_token='trip')
+        photos = [Photo.objects.create(
+            author=self.user, image='bulk%d.jpg' % i, image_size=100)
+            for i in range(50)]
+        self.album.add_photos(*photos)
+        usage = Usage.objects.get(pk=self.user.pk)
+        urlopen = urllib2.urlopen
+        urllib2.urlopen = lambda url, timeout: None
+        sharing.SHARE_PURGE_URLS = ('http://cache',)
+        counts = []
+        try:
+            # Warm the session and permission caches.
+            self.post({'photos': []})
+            for batch in (photos[:10], photos[10:]):
+                with CaptureQueriesContext(connection) as context:
+                    self.post({'photos': [photo.pk for photo in batch],
+                               'delete': True})
+                counts.append(len(context.captured_queries))
+        finally:
+            urllib2.urlopen = urlopen
+            sharing.SHARE_PURGE_URLS = ()
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(
+            Usage.objects.filter(pk=self.user.pk).values_list(
+                'bytes', 'photos').get(),
+            (usage.bytes - 5000, usage.photos - 50))
+        self.assertFalse(Photo.objects.filter(
+            pk__in=[photo.pk for photo in photos]).exists())
+
+    def test_purge_after_commit(self):
+        """Add photos to a shared album, and delete others from another,
+        and assert that each album is purged once, after the batch's
+        transaction has committed.
+        """
+        purged = []
+        urlopen = urllib2.urlopen
+        urllib2.urlopen = lambda url, timeout: purged.append(
+            (url, len(connection.savepoint_ids)))
+        sharing.SHARE_PURGE_URLS = ('http://cache',)
+        try:
+            other_album = Album.objects.create(
+                title='Old', description='', author=self.user,
+                share_token='old')
+            other_album.add_photos(self.photos[2])
+            Album.objects.filter(pk=self.album.pk).update(share_token='trip')
+            del purged[:]
+            self.post({'photos': [self.photos[0].pk],
+                       'add_to_albums': [self.album.pk]})
+            self.post({'photos': [self.photos[2].pk], 'delete': True})
+        finally:
+            urllib2.urlopen = urlopen
+            sharing.SHARE_PURGE_URLS = ()
+        self.assertEqual(purged, [
+            ('http://cache/pm/shared/trip/*', 0),
+            ('http://cache/pm/shared/old/*', 0)])
+
+    def test_invalid(self):
+        """Send malformed batches, and batches that would change things
+        the user doesn't own, and assert that nothing is changed.
+        """
+        ids = [photo.pk for photo in self.photos]
+        other_album = Album.objects.create(
+            title='Theirs', description='', author=self.other)
+        for data in [
+                {'photos': 'all'},
+                {'photos': ids, 'add_tags': [9999]},
+                {'photos': ids, 'rename': 'x'},
+                {'photos': ids, 'description': 1},
+                {'photos': ids, 'add_to_albums': [other_album.pk]},
+                {'photos': range(batch.BATCH_MAX_PHOTOS + 1)}]:
+            self.assertEqual(self.post(data).status_code, 400)
+        self.assertEqual(self.client.post(
+            '/pm/photo/batch', 'nonsense',
+            content_type='application/json').status_code, 400)
+        self.assertEqual(other_album.photos.count(), 0)
+
+        self.user.user_permissions.remove(
+            Permission.objects.get(codename='delete_photo'))
+        self.user = User.objects.get(pk=self.user.pk)
+        self.assertEqual(
+            self.post({'photos': ids, 'delete': True}).status_code, 403)
+        self.assertEqual(Photo.objects.filter(author=self.user).count(), 3)
+
+
+class TestTagging(TestCase):
+    """Test tagging photos by the texts of their tags."""
+    def setUp(self):
+        self.user = User.objects.create_user('test', password='test')
+        self.find_tags = tagging.find_tags
+
+    def tearDown(self):
+        tagging.find_tags = self.find_tags
+
+    def test_get_or_create_tags(self):
+        """Ask for tags that exist and tags that don't, and assert that
+        the existing ones are used and the rest created, once each.
+        """
+        trip = Tag.objects.create(text='trip')
+        tags = tagging.get_or_create_tags(
+            [' trip', 'beach', 'beach ', '', 'sunset'])
+        self.assertEqual(sorted(tags), ['beach', 'sunset', 'trip'])
+        self.assertEqual(tags['trip'], trip.pk)
+        self.assertEqual(Tag.objects.count(), 3)
+        self.assertEqual(tagging.get_or_create_tags(['beach', 'trip']),
+                         {'beach': tags['beach'], 'trip': trip.pk})
+        self.assertRaises(ValueError, tagging.get_or_create_tags,
+                          ['x' * (tagging.TAG_MAX_LENGTH + 1)])
+
+    def test_concurrent_create(self):
+        """Create a tag as if another request had created it between
+        looking it up and inserting it, and assert that the insert is
+        tried again and the other request's tag used.
+        """
+        calls = []
+
+        def find_tags(texts):
+            calls.append(texts)
+            if len(calls) == 1:
+                Tag.objects.create(text='beach')
+                return {}
+            return self.find_tags(texts)
+
+        tagging.find_tags = find_tags
+        tags = tagging.get_or_create_tags(['beach', 'trip'])
+        self.assertEqual(
+            tags, dict(Tag.objects.values_list('text', 'pk')))
+        self.assertEqual(Tag.objects.count(), 2)
+
+    def test_tag_photos(self):
+        """Tag 500 photos with 5 tags, some of which they already have,
+        and assert that it takes a handful of queries and leaves each
+        photo with each tag once.
+        """
+        Photo.objects.bulk_create([
+            Photo(author=self.user, image='%d.jpg' % i) for i in range(500)])
+        ids = list(Photo.objects.filter(author=self.user).
+                   values_list('pk', flat=True))
+        texts = ['tag%d' % i for i in range(5)]
+        tagging.tag_photos(ids[:10], texts[:2])
+        with CaptureQueriesContext(connection) as context:
+            tags = tagging.tag_photos(ids, texts)
+        # SQLite inserts at most 499 of the 2500 rows per query.
+        queries = [query['sql'] for query in context.captured_queries
+                   if 'SAVEPOINT' not in query['sql']]
+        self.assertLessEqual(len(queries), 10)
+        through = Photo.tags.through
+        self.assertEqual(through.objects.filter(photo__in=ids).count(), 2500)
+        self.assertEqual(sorted(tags), texts)
+        tagging.tag_photos(ids, texts)
+        self.assertEqual(through.objects.filter(photo__in=ids).count(), 2500)
+
+    def test_batch_tag_names(self):
+        """Tag photos by tag text through the batch endpoint, and assert
+        that doing so needs permission to add tags.
+        """
+        self.user.user_permissions.add(*Permission.objects.filter(
+            codename__in=['change_photo']))
+        photo = Photo.objects.create(author=self.user, image='0.jpg')
+        self.client.login(username='test', password='test')
+        data = json.dumps({'photos': [photo.pk],
+                           'add_tag_names': ['beach', 'trip']})
+        response = self.client.post('/pm/photo/batch', data,
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+        self.user.user_permissions.add(
+            Permission.objects.get(codename='add_tag'))
+        self.user = User.objects.get(pk=self.user.pk)
+        response = self.client.post('/pm/photo/batch', data,
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(photo.tags.values_list('text', flat=True)),
+                         ['beach', 'trip'])
+        response = self.client.post(
+            '/pm/photo/batch',
+            json.dumps({'photos': [photo.pk], 'add_tag_names': [1]}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 400)
@@ -0,0 +1,154 @@
+import hashlib
+import posixpath
+import re
+from datetime import datetime
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import get_storage_class
+from django.db import transaction
+from django.utils.functional import LazyObject
+from sorl.thumbnail import delete
+from sorl.thumbnail.images import ImageFile
+
+
+# How uploaded originals are laid out in storage. 'author' puts each
+# user's photos in a directory of their own, under their original names.
+# 'hash' and 'date' name photos for the SHA-256 of their contents, and
+# shard them into directories by the first characters of that hash, or
+# by the day they were uploaded.
+UPLOAD_LAYOUT = getattr(settings, 'PHOTOMANAGER_UPLOAD_LAYOUT', 'author')
+
+UPLOAD_LAYOUTS = ('author', 'hash', 'date')
+
+# The directory that sharded layouts keep originals under.
+UPLOAD_DIRECTORY = 'photos'
+
+LAYOUT_PATTERNS = {
+    'author': re.compile(r'^\d+/[^/]+$'),
+    'hash': re.compile(
+        r'^%s/([0-9a-f]{2})/([0-9a-f]{2})/\1\2[0-9a-f]{60}(\.\w+)?$' %
+        UPLOAD_DIRECTORY),
+    'date': re.compile(
+        r'^%s/\d{4}/\d{2}/\d{2}/[0-9a-f]{64}(\.\w+)?$' % UPLOAD_DIRECTORY),
+}
+
+# How many files are copied at once when relocating originals to a new
+# layout.
+RELOCATE_WORKERS = getattr(settings, 'PHOTOMANAGER_RELOCATE_WORKERS', 8)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def get_content_hash(f):
+    """The SHA-256 of a file's contents, read a chunk at a time."""
+    sha256 = hashlib.sha256()
+    for chunk in f.chunks(CHUNK_SIZE):
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_upload_name(photo, filename, layout=None):
+    """The name in storage of a photo's original under a layout. Sharded
+    names are made from the hash of the photo's contents, so a name is
+    only ever taken by an identical file, and storage finds a free name
+    at the first try instead of counting up past a user's other photos of
+    the same name.
+    """
+    layout = layout or UPLOAD_LAYOUT
+    if layout == 'author':
+        return '%d/%s' % (photo.author_id, filename)
+    if layout not in UPLOAD_LAYOUTS:
+        raise ImproperlyConfigured('Unknown upload layout %r' % layout)
+    digest = get_content_hash(photo.image)
+    if layout == 'hash':
+        directory = posixpath.join(UPLOAD_DIRECTORY, digest[:2], digest[2:4])
+    else:
+        date = photo.date_created or datetime.now()
+        directory = posixpath.join(
+            UPLOAD_DIRECTORY, date.strftime('%Y/%m/%d'))
+    extension = posixpath.splitext(filename)[1].lower()
+    return posixpath.join(directory, digest + extension)
+
+
+def is_laid_out(name, layout=None):
+    """Whether a name in storage already follows a layout."""
+    return bool(LAYOUT_PATTERNS[layout or UPLOAD_LAYOUT].match(name))
+
+
+def is_shared(name):
+    """Whether a name follows one of the sharded layouts, under which a
+    name is only ever taken by a file of the contents it's named for.
+    """
+    return is_laid_out(name, 'hash') or is_laid_out(name, 'date')
+
+
+class SharedNamesMixin(object):
+    """Saves a file under a sharded layout's name that's already taken by
+    reusing the file already there, which has the same contents, rather
+    than saving a copy under another name.
+    """
+    def save(self, name, content):
+        if name is not None and is_shared(name) and self.exists(name):
+            return name
+        saved = super(SharedNamesMixin, self).save(name, content)
+        if name is not None and saved != name and is_shared(name):
+            # Another upload of the same contents was saved first.
+            self.delete(saved)
+            return name
+        return saved
+
+
+class UploadStorage(LazyObject):
+    """The default storage, sharing the files of identical uploads."""
+    def _setup(self):
+        # Named for the class it extends, since sorl-thumbnail keys, and
+        # names, thumbnails by the class of their source's storage.
+        storage_class = get_storage_class()
+        self._wrapped = type(
+            storage_class.__name__, (SharedNamesMixin, storage_class),
+            {'__module__': storage_class.__module__})()
+
+
+upload_storage = UploadStorage()
+
+
+def copy_to_layout(photo, layout, storage=upload_storage):
+    """Copy a photo's original to its name under a layout, returning that
+    name. Under the sharded layouts, a file that's already there has the
+    same contents, and is shared rather than copied again.
+    """
+    name = get_upload_name(
+        photo, posixpath.basename(photo.image.name), layout)
+    photo.image.close()
+    if layout != 'author' and storage.exists(name):
+        return name
+    with storage.open(photo.image.name, 'rb') as f:
+        return storage.save(name, f)
+
+
+def relocate(photos, layout=None, storage=upload_storage, pool=None):
+    """Move the originals of a batch of photos to a layout, copying them
+    with a pool of threads if given one, then pointing the photos at
+    their new names in one transaction. Old files, and their thumbnails,
+    are deleted once nothing refers to them. A photo whose image changed
+    while it was being copied keeps its new image; the copy is left for
+    gc_media. Returns how many photos were moved.
+    """
+    from models import Photo
+    layout = layout or UPLOAD_LAYOUT
+    photos = [photo for photo in photos
+              if not is_laid_out(photo.image.name, layout)]
+    copy = lambda photo: copy_to_layout(photo, layout, storage)
+    names = pool.map(copy, photos) if pool is not None else map(copy, photos)
+
+    moved = 0
+    with transaction.atomic():
+        for photo, name in zip(photos, names):
+            moved += Photo.objects.filter(
+                pk=photo.pk, image=photo.image.name).update(image=name)
+    old_names = set(photo.image.name for photo in photos) - set(names)
+    in_use = set(Photo.objects.filter(image__in=old_names).
+                 values_list('image', flat=True))
+    for name in old_names - in_use:
+        delete(ImageFile(name, storage))
+    return moved
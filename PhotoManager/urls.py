@@ -7,9 +7,16 @@ urlpatterns = patterns(
     url(r'^album/(?P<id>\d+)$', 'album_view', name='pm-album'),
     url(r'^album/create$', 'create_album_view', name='pm-create_album'),
     url(r'^album/modify/(?P<id>\d+)$', 'modify_album_view', name='pm-modify_album'),
+    url(r'^album/(?P<id>\d+)/download$', 'download_album_view', name='pm-download_album'),
+    url(r'^album/(?P<id>\d+)/share$', 'share_album_view', name='pm-share_album'),
+    url(r'^album/(?P<id>\d+)/reorder$', 'reorder_album_view', name='pm-reorder_album'),
+    url(r'^shared/(?P<token>\w+)/$', 'shared_album_view', name='pm-shared_album'),
+    url(r'^shared/(?P<token>\w+)/photo/(?P<id>\d+)$', 'shared_photo_view', name='pm-shared_photo'),
     url(r'^photo/(?P<id>\d+)$', 'photo_view', name='pm-photo'),
     url(r'^photo/create$', 'create_photo_view', name='pm-create_photo'),
     url(r'^photo/modify/(?P<id>\d+)$', 'modify_photo_view', name='pm-modify_photo'),
+    url(r'^photo/batch$', 'batch_photos_view', name='pm-batch_photos'),
     url(r'^tag/(?P<id>\d+)$', 'tag_view', name='pm-tag'),
     url(r'^tag/create$', 'create_tag_view', name='pm-create_tag'),
+    url(r'^metrics$', 'metrics_view', name='pm-metrics'),
 )
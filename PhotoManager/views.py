@@ -1,10 +1,34 @@
+import json
 from django.shortcuts import render
-from django.forms import ModelForm
-from django.http import HttpResponseRedirect, HttpResponseForbidden, \
-    HttpResponseNotAllowed
+from django.forms import ModelForm, ModelMultipleChoiceField, \
+    ValidationError
+from django.http import HttpResponse, HttpResponseRedirect, \
+    HttpResponseForbidden, HttpResponseNotAllowed, HttpResponseBadRequest, \
+    StreamingHttpResponse, Http404
+from django.template.loader import render_to_string
 from django.core.urlresolvers import reverse
 from django.contrib.auth.decorators import login_required, permission_required
-from models import Tag, Photo, Album
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.utils.text import slugify
+from models import Tag, Photo, Album, AlbumPhoto, get_chunks
+from ingest import process_photo
+from quotas import QuotaExceeded, check_quota, reserve, update_usage, \
+    get_usage, get_limits, format_size, UPLOAD_OVERHEAD
+from decoding import governor
+from renditions import get_decode_scale
+import batch
+import contactsheets
+import metrics
+import ordering
+import sharing
+import tagging
+import zipstream
+from galleries import GALLERY_DISPLAY_SIZE
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
 
 
 class TagForm(ModelForm):
@@ -21,6 +45,26 @@ class CreatePhotoForm(ModelForm):
         model = Photo
         fields = ['image', 'description', 'tags']
 
+    def clean_image(self):
+        """Refuse images too large to ever be decoded, judging by their
+        headers alone. JPEGs are judged by the reduced scale that their
+        renditions are decoded at, rather than at full resolution.
+        """
+        image = self.cleaned_data['image']
+        image.seek(0)
+        header = Image.open(image)
+        width, height = header.size
+        image.seek(0)
+        scale = 1
+        if header.format == 'JPEG':
+            scale = get_decode_scale((width, height))
+        max_pixels = governor.get_max_pixels(scale)
+        if width * height > max_pixels:
+            raise ValidationError(
+                'Images may have at most %.1f megapixels.' %
+                (max_pixels / 1000000.0))
+        return image
+
 
 class EditPhotoForm(ModelForm):
     """The EditPhotoForm does not allow users to change the image associated
@@ -32,6 +76,9 @@ class EditPhotoForm(ModelForm):
 
 
 class AlbumForm(ModelForm):
+    photos = ModelMultipleChoiceField(
+        queryset=Photo.objects.none(), required=False)
+
     def __init__(self, *args, **kwargs):
         """Custom constructor that filters the queryset available to the
         photos form to restrict it to the currently logged-in user.
@@ -40,10 +87,23 @@ class AlbumForm(ModelForm):
         super(AlbumForm, self).__init__(*args, **kwargs)
         self.fields['photos'].queryset = \
             Photo.objects.filter(author=authorized_user)
+        if self.instance.pk:
+            self.initial.setdefault('photos', list(
+                self.instance.photos.values_list('pk', flat=True)))
 
     class Meta(object):
         model = Album
-        fields = ['title', 'description', 'photos']
+        fields = ['title', 'description']
+
+    def save(self, commit=True):
+        """Save the album, and with it the photos chosen for it. Photos
+        are ordered within the album, so they're kept in place, and new
+        ones added to the end.
+        """
+        album = super(AlbumForm, self).save(commit)
+        if commit:
+            album.set_photos(self.cleaned_data['photos'])
+        return album
 
 
 def frontpage_view(request):
@@ -57,10 +117,22 @@ def frontpage_view(request):
 @login_required
 def home_view(request):
     """View the home page.
-    Shows a list of the user's albums with title and description.
+    Shows a list of the user's albums with title and description, each
+    with a thumbnail of its first photo, in the album's order, as a cover.
     """
-    albums = Album.objects.\
-        filter(author__exact=request.user.pk).order_by('-date_created')
+    albums = list(Album.objects.
+                  filter(author__exact=request.user.pk).
+                  order_by('-date_created'))
+    cover_ids = {}
+    for chunk in get_chunks([album.pk for album in albums]):
+        memberships = AlbumPhoto.objects.filter(album__in=chunk).\
+            order_by('album', 'position', 'photo').\
+            values_list('album', 'photo')
+        for album_id, photo_id in memberships:
+            cover_ids.setdefault(album_id, photo_id)
+    covers = Photo.objects.in_bulk(cover_ids.values())
+    for album in albums:
+        album.cover = covers.get(cover_ids.get(album.pk))
     context = {'albums': albums}
     return render(request, 'PhotoManager/homepage.html', context)
 
@@ -73,12 +145,142 @@ def album_view(request, id):
     """
     # import pdb; pdb.set_trace()
     album = Album.objects.get(pk=id)
-    if album.author.pk != request.user.pk:
+    if album.author_id != request.user.pk:
         return HttpResponseForbidden("403 Forbidden")
     context = {'album': album}
+    if album.share_token:
+        context['share_url'] = request.build_absolute_uri(reverse(
+            'PhotoManager:pm-shared_album',
+            kwargs={'token': album.share_token}))
+    if contactsheets.CONTACT_SHEETS:
+        context['contact_sheets'] = album.contact_sheets.all()
+    else:
+        context['photos'] = album.get_photos()
     return render(request, 'PhotoManager/album.html', context)
 
 
+@login_required
+@permission_required('PhotoManager.change_album', raise_exception=True)
+def share_album_view(request, id):
+    """View that turns an album's public link on or off.
+    A POST with share set gives the album a link, if it doesn't have one;
+    a POST without it revokes the album's link.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(
+            ['POST'], content='405 Method Not Allowed')
+    album = Album.objects.get(pk=id)
+    if album.author_id != request.user.pk:
+        return HttpResponseForbidden("403 Forbidden")
+    if request.POST.get('share'):
+        album.share_token = album.share_token or sharing.create_token()
+    else:
+        album.share_token = None
+    album.save()
+    return HttpResponseRedirect(
+        reverse('PhotoManager:pm-album', args=[album.pk]))
+
+
+@login_required
+@permission_required('PhotoManager.change_album', raise_exception=True)
+def reorder_album_view(request, id):
+    """View that moves one of an album's photos, as it's dragged into
+    place. A POST moves the photo given by photo to just after the one
+    given by after, or to the front of the album if after is left out.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(
+            ['POST'], content='405 Method Not Allowed')
+    album = Album.objects.get(pk=id)
+    if album.author_id != request.user.pk:
+        return HttpResponseForbidden("403 Forbidden")
+    try:
+        ordering.move_photo(album, int(request.POST['photo']),
+                            int(request.POST.get('after') or 0) or None)
+    except (KeyError, ValueError, AlbumPhoto.DoesNotExist):
+        return HttpResponseBadRequest('400 Bad Request')
+    album.save()
+    if contactsheets.CONTACT_SHEETS:
+        contactsheets.update_contact_sheets(album)
+    return HttpResponse(status=204)
+
+
+def get_shared_album(token):
+    try:
+        return Album.objects.get(share_token=token)
+    except Album.DoesNotExist:
+        raise Http404
+
+
+def shared_album_view(request, token):
+    """View a shared album, without logging in.
+    The page doesn't depend on who asks for it, and never touches the
+    session, so that caches can serve it to everyone. It reads from the
+    primary, since a replica that lagged behind a purge would have its
+    stale copy of the album cached until the next one.
+    """
+    album = get_shared_album(token)
+    photos = album.get_photos()
+    response = HttpResponse(render_to_string(
+        'PhotoManager/shared/album.html', {'album': album, 'photos': photos}))
+    return sharing.make_public(response, album)
+
+
+def shared_photo_view(request, token, id):
+    """View a photo of a shared album, without logging in."""
+    album = get_shared_album(token)
+    try:
+        photo = album.photos.get(pk=id)
+    except Photo.DoesNotExist:
+        raise Http404
+    response = HttpResponse(render_to_string(
+        'PhotoManager/shared/photo.html', {
+            'album': album, 'photo': photo,
+            'display_size': GALLERY_DISPLAY_SIZE}))
+    return sharing.make_public(response, album, photo)
+
+
+@login_required
+def download_album_view(request, id):
+    """Download the originals of an album's photos as a ZIP file.
+    The archive is streamed as its photos are read from storage. An
+    interrupted download can be resumed with a Range request, as long as
+    the album's photos haven't changed since it started.
+    """
+    album = Album.objects.get(pk=id)
+    if album.author_id != request.user.pk:
+        return HttpResponseForbidden("403 Forbidden")
+    archive = zipstream.ZipStream(zipstream.get_entries(album))
+
+    start, end = 0, archive.size
+    header = request.META.get('HTTP_RANGE')
+    if header and request.META.get('HTTP_IF_RANGE', archive.etag) == \
+            archive.etag:
+        try:
+            requested = zipstream.parse_range(header, archive.size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % archive.size
+            return response
+        if requested is not None:
+            start, end = requested
+
+    response = StreamingHttpResponse(
+        archive.iter_range(start, end), content_type='application/zip')
+    if (start, end) != (0, archive.size):
+        response.status_code = 206
+        response['Content-Range'] = 'bytes %d-%d/%d' % (
+            start, end - 1, archive.size)
+    response['Content-Length'] = str(end - start)
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = archive.etag
+    response['Content-Disposition'] = 'attachment; filename="%s.zip"' % (
+        slugify(album.title) or 'album')
+    # Stream straight through nginx rather than spooling to its disk.
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @login_required
 def photo_view(request, id):
     """View a single photo.
@@ -88,7 +290,7 @@ def photo_view(request, id):
     that the user is adding a tag to this photo.
     """
     photo = Photo.objects.get(pk=id)
-    if photo.author.pk != request.user.pk:
+    if photo.author_id != request.user.pk:
         return HttpResponseForbidden("403 Forbidden")
     context = {'photo': photo}
     return render(request, 'PhotoManager/photo.html', context)
@@ -119,8 +321,7 @@ def create_album_view(request):
             new_album = form.save(commit=False)
             new_album.author = request.user
             new_album.save()
-            for photo in form.cleaned_data['photos']:
-                new_album.photos.add(photo)
+            new_album.add_photos(*form.cleaned_data['photos'])
             new_album.save()
             return HttpResponseRedirect(
                 reverse('PhotoManager:pm-album', args=[new_album.pk]))
@@ -139,7 +340,7 @@ def modify_album_view(request, id):
     description or add or remove photos.
     """
     album = Album.objects.get(pk=id)
-    if album.author.pk != request.user.pk:
+    if album.author_id != request.user.pk:
         return HttpResponseForbidden("403 Forbidden")
 
     if request.method == 'POST':
@@ -154,41 +355,77 @@ def modify_album_view(request, id):
         form = AlbumForm(instance=album, authorized_user=request.user)
 
     photo_form = CreatePhotoForm()
-    context = {'form': form, 'album': album, 'photo_form': photo_form}
+    usage = get_usage(request.user.pk)
+    max_bytes, max_photos = get_limits(usage)
+    context = {'form': form, 'album': album, 'photo_form': photo_form,
+               'usage': usage, 'used': format_size(usage.bytes),
+               'max_bytes': max_bytes and format_size(max_bytes),
+               'max_photos': max_photos}
     return render(request, 'PhotoManager/modify_album.html', context)
 
 
+@csrf_exempt
 @login_required
 @permission_required('PhotoManager.add_photo', raise_exception=True)
 def create_photo_view(request):
-    """View that allows the user to create a new photo."""
+    """View that allows the user to create a new photo. Uploads the user
+    has no room for are refused by their declared size, less what the rest
+    of the form may take, before their body is read; since checking the
+    CSRF token reads the body, that's done afterwards instead of by the
+    middleware.
+    """
     if request.method == 'POST':
-        album = Album.objects.get(pk=request.POST['album'])
-        if album.author.pk != request.user.pk:
-            return HttpResponseForbidden("403 Forbidden")
-
-        form = CreatePhotoForm(request.POST, request.FILES)
-        if form.is_valid():
-            new_photo = form.save(commit=False)
-            new_photo.author = request.user
-            new_photo.save()
-            album.photos.add(new_photo)
-            album.save()
-
-        return HttpResponseRedirect(
-            reverse('PhotoManager:pm-modify_album', args=[album.pk]))
+        try:
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+            check_quota(request.user.pk, max(length - UPLOAD_OVERHEAD, 0))
+        except (QuotaExceeded, ValueError), e:
+            return HttpResponse(
+                u'413 Request Entity Too Large: %s' % e, status=413)
+        return upload_photo(request)
 
     else:
         return HttpResponseNotAllowed(
             ['POST'], content='405 Method Not Allowed')
 
 
+@csrf_protect
+def upload_photo(request):
+    album = Album.objects.get(pk=request.POST['album'])
+    if album.author_id != request.user.pk:
+        return HttpResponseForbidden("403 Forbidden")
+
+    form = CreatePhotoForm(request.POST, request.FILES)
+    if form.is_valid():
+        new_photo = form.save(commit=False)
+        new_photo.author = request.user
+        size = new_photo.image.size
+        try:
+            reserve(request.user.pk, size)
+        except QuotaExceeded, e:
+            return HttpResponse(
+                u'413 Request Entity Too Large: %s' % e, status=413)
+        new_photo._usage_counted = True
+        try:
+            new_photo.save()
+        except:
+            update_usage(request.user.pk, -size, -1)
+            raise
+        metrics.uploads.inc()
+        metrics.stored_bytes.inc(size)
+        process_photo(new_photo)
+        album.add_photos(new_photo)
+        album.save()
+
+    return HttpResponseRedirect(
+        reverse('PhotoManager:pm-modify_album', args=[album.pk]))
+
+
 @login_required
 @permission_required('PhotoManager.change_photo', raise_exception=True)
 def modify_photo_view(request, id):
     """View that allows the user to modify a photo."""
     photo = Photo.objects.get(pk=id)
-    if photo.author.pk != request.user.pk:
+    if photo.author_id != request.user.pk:
         return HttpResponseForbidden("403 Forbidden")
 
     if request.method == 'POST':
@@ -206,22 +443,59 @@ def modify_photo_view(request, id):
     return render(request, 'PhotoManager/modify_photo.html', context)
 
 
+@login_required
+@permission_required('PhotoManager.change_photo', raise_exception=True)
+def batch_photos_view(request):
+    """View that applies one set of changes to many photos at once.
+    A POST of a JSON object holding a list of photo ids, as photos, and
+    any of add_tags and remove_tags (lists of tag ids), add_tag_names (a
+    list of tag texts, created if need be), description,
+    add_to_albums and remove_from_albums (lists of album ids) and delete,
+    applies them all in one transaction. Responds with a JSON list of the
+    result for each photo.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(
+            ['POST'], content='405 Method Not Allowed')
+    try:
+        photo_ids, changes = batch.parse_batch(json.loads(request.body))
+        if changes.get('delete') and \
+                not request.user.has_perm('PhotoManager.delete_photo'):
+            return HttpResponseForbidden("403 Forbidden")
+        if changes.get('add_tag_names') and \
+                not request.user.has_perm('PhotoManager.add_tag'):
+            return HttpResponseForbidden("403 Forbidden")
+        if (changes.get('add_to_albums') or
+                changes.get('remove_from_albums')) and \
+                not request.user.has_perm('PhotoManager.change_album'):
+            return HttpResponseForbidden("403 Forbidden")
+        results = batch.apply_batch(request.user, photo_ids, changes)
+    except (ValueError, batch.BatchError), e:
+        return HttpResponseBadRequest(
+            json.dumps({'error': str(e)}), content_type='application/json')
+    return HttpResponse(json.dumps({'results': results}),
+                        content_type='application/json')
+
+
 @login_required
 @permission_required('PhotoManager.add_tag', raise_exception=True)
 def create_tag_view(request):
-    """View that allows the user to create a new tag.
-    This view is only reachable from the modify photo view, and so redirects
-    there.
+    """View that allows the user to tag a photo, creating the tag if it
+    doesn't exist yet. Tagging a photo with a tag it already has changes
+    nothing. This view is only reachable from the modify photo view, and so
+    redirects there.
     """
     if request.method == 'POST':
         photo = Photo.objects.get(pk=request.POST['photo'])
-        if photo.author.pk != request.user.pk:
+        if photo.author_id != request.user.pk:
             return HttpResponseForbidden("403 Forbidden")
 
-        form = TagForm(request.POST)
-        if form.is_valid():
-            new_tag = form.save()
-            photo.tags.add(new_tag)
+        try:
+            tags = tagging.tag_photos(
+                [photo.pk], [request.POST.get('text', '')])
+        except ValueError:
+            tags = None
+        if tags:
             photo.save()
 
         return HttpResponseRedirect(
@@ -229,3 +503,14 @@ def create_tag_view(request):
     else:
         return HttpResponseNotAllowed(
             ['POST'], content='405 Method Not Allowed')
+
+
+def metrics_view(request):
+    """View that reports the app's metrics, summed across every worker,
+    for Prometheus to scrape.
+    """
+    if request.META.get('REMOTE_ADDR') not in metrics.METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden("403 Forbidden")
+    return HttpResponse(
+        metrics.registry.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8')
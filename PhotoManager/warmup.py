@@ -0,0 +1,123 @@
+import logging
+import os
+from collections import OrderedDict
+from time import time
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.urlresolvers import get_resolver
+from django.db import connections
+from django.template.base import TemplateDoesNotExist
+from django.template.loader import get_template
+from django.template.loader_tags import ExtendsNode, ConstantIncludeNode
+from django.template.loaders.app_directories import app_template_dirs
+from django.utils.functional import empty
+from sorl.thumbnail import default
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_template_dirs():
+    """The project's template directories and its apps' templates
+    directories.
+    """
+    return tuple(settings.TEMPLATE_DIRS) + app_template_dirs
+
+
+def get_template_names(directories=None):
+    """The names of every template in the given directories, or in all
+    of the template directories.
+    """
+    names = set()
+    for directory in directories or get_template_dirs():
+        for root, dirs, files in os.walk(directory):
+            for filename in files:
+                if not filename.startswith('.'):
+                    names.add(os.path.relpath(
+                        os.path.join(root, filename), directory))
+    return sorted(names)
+
+
+def check_template(name):
+    """Compile a template, along with the templates that it extends or
+    includes by name, raising any error that the first render would.
+    """
+    template = get_template(name)
+    for node in template.nodelist.get_nodes_by_type(ExtendsNode):
+        if isinstance(node.parent_name.var, basestring):
+            check_template(node.parent_name.var)
+    for node in template.nodelist.get_nodes_by_type(ConstantIncludeNode):
+        if node.template is None:
+            raise TemplateDoesNotExist(
+                'An included template of %s does not exist.' % name)
+    return template
+
+
+def import_views(handler=None):
+    """Load the middleware and import every view that a URL points to."""
+    if handler is not None and handler._request_middleware is None:
+        with handler.initLock:
+            if handler._request_middleware is None:
+                handler.load_middleware()
+    patterns = list(get_resolver(None).url_patterns)
+    while patterns:
+        pattern = patterns.pop()
+        if hasattr(pattern, 'url_patterns'):
+            patterns.extend(pattern.url_patterns)
+        else:
+            pattern.callback
+
+
+def compile_templates(handler=None):
+    """Compile every template, which also imports their tag libraries."""
+    for name in get_template_names():
+        try:
+            check_template(name)
+        except Exception:
+            logger.exception('Could not compile template %s.', name)
+
+
+def open_connections(handler=None):
+    """Connect to every database and to the cache."""
+    for connection in connections.all():
+        connection.ensure_connection()
+    cache.get('photomanager-warm-up')
+
+
+def prime_caches(handler=None):
+    """Set up the lazily created objects that the first requests would."""
+    Image.init()
+    for lazy in (default.backend, default.engine, default.kvstore,
+                 default.storage):
+        if lazy._wrapped is empty:
+            lazy._setup()
+    try:
+        Site.objects.get_current()
+    except Site.DoesNotExist:
+        pass
+
+
+WARM_UP_STEPS = (import_views, compile_templates, open_connections,
+                 prime_caches)
+
+
+def warm_up(handler=None):
+    """Do the work that a fresh worker would otherwise do during its first
+    requests, given the worker's WSGI handler. Returns how long each step
+    took, in seconds.
+    """
+    timings = OrderedDict()
+    for step in WARM_UP_STEPS:
+        start = time()
+        step(handler)
+        timings[step.__name__] = time() - start
+    logger.info('Warmed up process %d in %.3fs: %s.', os.getpid(),
+                sum(timings.values()), ', '.join(
+                    '%s %.3fs' % item for item in timings.items()))
+    return timings
@@ -0,0 +1,237 @@
+import hashlib
+import json
+import os
+import re
+import struct
+import zlib
+from collections import namedtuple
+from django.core.files.storage import default_storage
+from models import Photo
+
+
+# How much of a file is read from storage, and sent, at a time.
+CHUNK_SIZE = 64 * 1024
+
+# Sizes, offsets and counts from which on the classic ZIP format's fields
+# hold a placeholder, and the real value goes in a ZIP64 extension.
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+END_OF_CENTRAL_DIRECTORY = struct.Struct('<IHHHHIIH')
+ZIP64_END_OF_CENTRAL_DIRECTORY = struct.Struct('<IQHHIIQQQQ')
+ZIP64_LOCATOR = struct.Struct('<IIQI')
+
+VERSION = 20
+ZIP64_VERSION = 45
+UTF8_FLAG = 0x800
+FILE_ATTRIBUTES = 0100644 << 16
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+# One file of an archive: its name in the archive, its name in storage, and
+# the size, CRC-32 and modification time of its contents.
+Entry = namedtuple('Entry', 'name path size crc32 date_time')
+
+
+_heartbeat = None
+
+
+def set_heartbeat(func):
+    """Have long downloads call func as they go, to tell the server that
+    the worker sending them is still alive.
+    """
+    global _heartbeat
+    _heartbeat = func
+
+
+def get_checksums(image_field):
+    """The size and CRC-32 of an image's file, reading it from storage a
+    chunk at a time. This happens before a download sends its first byte,
+    so the heartbeat is kept up meanwhile.
+    """
+    size = crc32 = 0
+    with image_field.storage.open(image_field.name, 'rb') as f:
+        for chunk in f.chunks(CHUNK_SIZE):
+            size += len(chunk)
+            crc32 = zlib.crc32(chunk, crc32)
+            if _heartbeat is not None:
+                _heartbeat()
+    return size, crc32 & 0xFFFFFFFF
+
+
+def get_entries(album):
+    """The manifest of an album's archive: an entry for each of its
+    photos' originals. Photos uploaded before their checksums were
+    recorded have them worked out now, once.
+    """
+    entries = []
+    photos = album.get_photos().only(
+        'image', 'image_size', 'image_crc32', 'date_created')
+    for photo in photos:
+        if photo.image_crc32 is None:
+            photo.image_size, photo.image_crc32 = get_checksums(photo.image)
+            Photo.objects.filter(pk=photo.pk).update(
+                image_size=photo.image_size, image_crc32=photo.image_crc32)
+        entries.append(Entry(
+            u'%d-%s' % (photo.pk, os.path.basename(photo.image.name)),
+            photo.image.name, photo.image_size, photo.image_crc32,
+            photo.date_created.timetuple()[:6]))
+    return entries
+
+
+def get_dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time
+    year = min(max(year, 1980), 2107)
+    return ((year - 1980) << 9 | month << 5 | day,
+            hour << 11 | minute << 5 | second // 2)
+
+
+def get_zip64_extra(*values):
+    if not values:
+        return ''
+    return struct.pack('<HH', 1, 8 * len(values)) + \
+        struct.pack('<%dQ' % len(values), *values)
+
+
+class ZipStream(object):
+    """A store-mode ZIP archive of files in storage, which is never held
+    in memory or written anywhere. Since the size and CRC-32 of every file
+    is known in advance, the archive's layout is too: any byte range of it
+    can be produced on its own, which lets interrupted downloads resume.
+    """
+    def __init__(self, entries, storage=default_storage):
+        self.entries = entries
+        self.storage = storage
+        self.segments = []
+        self.size = 0
+        central_directory = []
+        for entry in entries:
+            offset = self.size
+            self.add(self.get_local_header(entry))
+            self.add(entry.size, entry.path)
+            central_directory.append(self.get_central_header(entry, offset))
+        offset = self.size
+        self.add(''.join(central_directory))
+        self.add(self.get_end(len(entries), self.size - offset, offset))
+        # Identifies the archive's contents, so that a download is only
+        # resumed if the archive hasn't changed since it began.
+        self.etag = '"%s"' % hashlib.md5(json.dumps(entries)).hexdigest()
+
+    def add(self, data, path=None):
+        """Append a segment to the archive: either bytes, or a size and
+        the name of the file in storage with that many bytes.
+        """
+        size = data if path is not None else len(data)
+        self.segments.append((self.size, size, data, path))
+        self.size += size
+
+    def get_name(self, entry):
+        flags = 0
+        name = entry.name
+        if isinstance(name, unicode):
+            try:
+                name = name.encode('ascii')
+            except UnicodeEncodeError:
+                name = name.encode('utf-8')
+                flags |= UTF8_FLAG
+        return name, flags
+
+    def get_local_header(self, entry):
+        name, flags = self.get_name(entry)
+        date, time = get_dos_date_time(entry.date_time)
+        if entry.size >= ZIP64_LIMIT:
+            extra = get_zip64_extra(entry.size, entry.size)
+            version, size = ZIP64_VERSION, 0xFFFFFFFF
+        else:
+            extra = ''
+            version, size = VERSION, entry.size
+        return LOCAL_HEADER.pack(
+            0x04034b50, version, flags, 0, time, date, entry.crc32,
+            size, size, len(name), len(extra)) + name + extra
+
+    def get_central_header(self, entry, offset):
+        name, flags = self.get_name(entry)
+        date, time = get_dos_date_time(entry.date_time)
+        zip64 = []
+        size = entry.size
+        if size >= ZIP64_LIMIT:
+            zip64.extend((size, size))
+            size = 0xFFFFFFFF
+        if offset >= ZIP64_LIMIT:
+            zip64.append(offset)
+            offset = 0xFFFFFFFF
+        extra = get_zip64_extra(*zip64)
+        version = ZIP64_VERSION if zip64 else VERSION
+        return CENTRAL_HEADER.pack(
+            0x02014b50, 3 << 8 | version, version, flags, 0, time, date,
+            entry.crc32, size, size, len(name), len(extra), 0, 0, 0,
+            FILE_ATTRIBUTES, offset) + name + extra
+
+    def get_end(self, count, size, offset):
+        end = ''
+        if count >= ZIP64_COUNT_LIMIT or size >= ZIP64_LIMIT or \
+                offset >= ZIP64_LIMIT:
+            end = ZIP64_END_OF_CENTRAL_DIRECTORY.pack(
+                0x06064b50, ZIP64_END_OF_CENTRAL_DIRECTORY.size - 12,
+                ZIP64_VERSION, ZIP64_VERSION, 0, 0, count, count, size,
+                offset) + ZIP64_LOCATOR.pack(0x07064b50, 0, self.size, 1)
+            if count >= ZIP64_COUNT_LIMIT:
+                count = 0xFFFF
+            if size >= ZIP64_LIMIT:
+                size = 0xFFFFFFFF
+            if offset >= ZIP64_LIMIT:
+                offset = 0xFFFFFFFF
+        return end + END_OF_CENTRAL_DIRECTORY.pack(
+            0x06054b50, 0, 0, count, count, size, offset, 0)
+
+    def iter_range(self, start=0, end=None):
+        """Yield the bytes of the archive from start up to end."""
+        if end is None:
+            end = self.size
+        for offset, size, data, path in self.segments:
+            if offset + size <= start:
+                continue
+            if offset >= end:
+                return
+            first, last = max(start - offset, 0), min(end - offset, size)
+            if path is None:
+                yield data[first:last]
+            else:
+                for chunk in self.read(path, first, last):
+                    yield chunk
+
+    def read(self, path, start, end):
+        with self.storage.open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise IOError('%s is shorter than its recorded size' % path)
+                remaining -= len(chunk)
+                if _heartbeat is not None:
+                    _heartbeat()
+                yield chunk
+
+
+def parse_range(header, size):
+    """The start and end of the single byte range asked for by a Range
+    header, or None if the whole file should be sent instead. Raises
+    ValueError if the range lies outside the file.
+    """
+    match = RANGE_PATTERN.match(header.strip())
+    if match is None or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        if int(last) == 0:
+            raise ValueError('Empty suffix range')
+        return max(size - int(last), 0), size
+    if last and int(last) < int(first):
+        return None
+    if int(first) >= size:
+        raise ValueError('Range starts past the end of the file')
+    return int(first), min(int(last) + 1, size) if last else size
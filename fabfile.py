@@ -232,6 +232,8 @@ def _deploy():
         # sudo('export DJANGO_SETTINGS_MODULE=`pwd`/dev_settings.py')
         sudo('python manage.py syncdb')
         sudo('python manage.py migrate')
+        sudo('python manage.py compile_templates')
+        sudo('python manage.py build_static')
         sudo('mv nginx_config /etc/nginx/sites-available/default')
         sudo('cp photomanager.conf /etc/supervisor/conf.d')
 
@@ -0,0 +1,147 @@
+/*
+ * A minimal Deep Zoom (DZI) viewer. Each element with class "deepzoom"
+ * and a data-dzi attribute pointing at a .dzi descriptor is turned into a
+ * scrollable viewport that only fetches the tiles currently in view.
+ */
+(function () {
+    'use strict';
+
+    function DeepZoom(element) {
+        this.element = element;
+        this.url = element.getAttribute('data-dzi');
+        this.tilesUrl = this.url.replace(/\.dzi$/, '_files/');
+        this.tiles = {};
+        this.load();
+    }
+
+    DeepZoom.prototype.load = function () {
+        var self = this;
+        var request = new XMLHttpRequest();
+        request.onload = function () {
+            var image = request.responseXML.documentElement;
+            var size = image.getElementsByTagName('Size')[0];
+            self.tileSize = parseInt(image.getAttribute('TileSize'), 10);
+            self.overlap = parseInt(image.getAttribute('Overlap'), 10);
+            self.format = image.getAttribute('Format');
+            self.width = parseInt(size.getAttribute('Width'), 10);
+            self.height = parseInt(size.getAttribute('Height'), 10);
+            self.maxLevel = Math.ceil(
+                Math.log(Math.max(self.width, self.height)) / Math.LN2);
+            self.start();
+        };
+        request.open('GET', this.url);
+        request.send();
+    };
+
+    DeepZoom.prototype.start = function () {
+        var self = this;
+        var scheduled = false;
+
+        this.canvas = document.createElement('div');
+        this.canvas.style.position = 'relative';
+        this.element.appendChild(this.canvas);
+        this.addControls();
+
+        // Start at the smallest level that fills the viewport's width.
+        this.level = this.maxLevel;
+        while (this.level > 0 &&
+                this.levelSize(this.level - 1)[0] >= this.element.clientWidth) {
+            this.level -= 1;
+        }
+        this.setLevel(this.level, 0.5, 0.5);
+
+        this.element.addEventListener('scroll', function () {
+            if (!scheduled) {
+                scheduled = true;
+                window.requestAnimationFrame(function () {
+                    scheduled = false;
+                    self.render();
+                });
+            }
+        });
+    };
+
+    DeepZoom.prototype.addControls = function () {
+        var self = this;
+        var controls = document.createElement('div');
+        controls.className = 'deepzoom-controls';
+        [['+', 1], ['-', -1]].forEach(function (control) {
+            var button = document.createElement('button');
+            button.textContent = control[0];
+            button.addEventListener('click', function () {
+                self.zoom(control[1]);
+            });
+            controls.appendChild(button);
+        });
+        this.element.parentNode.insertBefore(controls, this.element);
+        this.element.parentNode.style.position = 'relative';
+    };
+
+    DeepZoom.prototype.levelSize = function (level) {
+        var scale = Math.pow(2, this.maxLevel - level);
+        return [Math.ceil(this.width / scale), Math.ceil(this.height / scale)];
+    };
+
+    DeepZoom.prototype.zoom = function (direction) {
+        var level = Math.min(
+            Math.max(this.level + direction, 0), this.maxLevel);
+        var size = this.levelSize(this.level);
+        var element = this.element;
+        this.setLevel(
+            level,
+            (element.scrollLeft + element.clientWidth / 2) / size[0],
+            (element.scrollTop + element.clientHeight / 2) / size[1]);
+    };
+
+    DeepZoom.prototype.setLevel = function (level, centerX, centerY) {
+        var size = this.levelSize(level);
+        var key;
+        for (key in this.tiles) {
+            if (this.tiles.hasOwnProperty(key)) {
+                this.canvas.removeChild(this.tiles[key]);
+            }
+        }
+        this.tiles = {};
+        this.level = level;
+        this.canvas.style.width = size[0] + 'px';
+        this.canvas.style.height = size[1] + 'px';
+        this.element.scrollLeft = centerX * size[0] - this.element.clientWidth / 2;
+        this.element.scrollTop = centerY * size[1] - this.element.clientHeight / 2;
+        this.render();
+    };
+
+    DeepZoom.prototype.render = function () {
+        var element = this.element;
+        var size = this.levelSize(this.level);
+        var tileSize = this.tileSize;
+        var firstCol = Math.floor(element.scrollLeft / tileSize);
+        var firstRow = Math.floor(element.scrollTop / tileSize);
+        var lastCol = Math.min(
+            Math.floor((element.scrollLeft + element.clientWidth) / tileSize),
+            Math.ceil(size[0] / tileSize) - 1);
+        var lastRow = Math.min(
+            Math.floor((element.scrollTop + element.clientHeight) / tileSize),
+            Math.ceil(size[1] / tileSize) - 1);
+        var col, row, key, tile;
+
+        for (col = firstCol; col <= lastCol; col += 1) {
+            for (row = firstRow; row <= lastRow; row += 1) {
+                key = col + '_' + row;
+                if (!this.tiles.hasOwnProperty(key)) {
+                    tile = document.createElement('img');
+                    tile.style.left = (col * tileSize - (col ? this.overlap : 0)) + 'px';
+                    tile.style.top = (row * tileSize - (row ? this.overlap : 0)) + 'px';
+                    tile.src = this.tilesUrl + this.level + '/' + key + '.' + this.format;
+                    this.canvas.appendChild(tile);
+                    this.tiles[key] = tile;
+                }
+            }
+        }
+    };
+
+    Array.prototype.forEach.call(
+        document.querySelectorAll('.deepzoom[data-dzi]'),
+        function (element) {
+            return new DeepZoom(element);
+        });
+}());